@@ -36,20 +36,72 @@ def seed_demo_data():
     seed_demo_data(ConnectionManager().get_session())
 
 
+@cli.command(short_help="Seed a synthetic manual, far bigger than the demo ones, for stress testing")
+@click.option('--steps', type=int, default=1000, help='About how many rating steps to generate')
+@click.option('--condition-depth', type=int, default=3, help='How deep to nest the conditions on arithmetic steps')
+@click.option('--loop-depth', type=int, default=1, help='How many loops over sub-risks to nest')
+@click.option('--factor-tables', type=int, default=20)
+@click.option('--factor-rows', type=int, default=1000, help='The number of rows in each factor table')
+@click.option('--zip-rows', type=int, default=100000, help='The number of rows in the ZIP code to territory table')
+@click.option('--seed', type=int, default=0)
+def seed_stress_manual(steps, condition_depth, loop_depth, factor_tables, factor_rows, zip_rows, seed):
+    """Seed a synthetic manual into the database, with bulk inserts, and print its id"""
+    from aspire.app.demo import seed_stress_manual
+    from aspire.app.database.engine import ConnectionManager
+
+    print(seed_stress_manual(ConnectionManager().get_session(), steps, condition_depth, loop_depth, factor_tables,
+                             factor_rows, zip_rows, seed=seed))
+
+
 @cli.command(short_help="Run the Rater, using a CSV as input")
 @click.argument('rating-manual-id', type=int)
 @click.argument('file_path')
-def rate_from_csv(rating_manual_id, file_path):
+@click.option('--code-cache-dir', default=None, help='Rate with generated code, cached in this directory')
+def rate_from_csv(rating_manual_id, file_path, code_cache_dir):
     """This script opens a CSV and attempts to read each line to use as input for rating against the manual
     with the provided ID. """
     from aspire.app.rating import rate_from_csv
-    rate_from_csv(rating_manual_id, file_path)
+    rate_from_csv(rating_manual_id, file_path, code_cache_dir)
+
+
+@cli.command(short_help="Generate synthetic rating inputs for a manual")
+@click.argument('rating-manual-id', type=int)
+@click.argument('file_path')
+@click.option('--rows', type=int, default=1000)
+@click.option('--seed', type=int, default=None)
+@click.option('--json-lines', is_flag=True, help='Write one JSON object per row, rather than a CSV')
+def generate_inputs(rating_manual_id, file_path, rows, seed, json_lines):
+    """Write rows of synthetic inputs to the manual with the provided ID, generated from its rating variables"""
+    from aspire.app.database.engine import ConnectionManager
+    from aspire.app.repository.rating_manual_repository import RatingManualRepository
+    from aspire.app.synthetic import InputGenerator
+
+    rating_manual = RatingManualRepository(ConnectionManager().get_session()).get(rating_manual_id)
+    generator = InputGenerator(rating_manual, seed)
+    if json_lines:
+        generator.write_json_lines(file_path, rows)
+    else:
+        generator.write_csv(file_path, rows)
+
+
+@cli.command(short_help="Benchmark rating the demo manuals")
+@click.option('--output', default=None, help='Write the results as JSON to this file, rather than to stdout')
+@click.option('--quotes', type=int, default=1000, help='The number of single quotes to time for each manual')
+@click.option('--batch-rows', type=int, default=10000, help='The number of rows to rate in each batch')
+@click.option('--seed', type=int, default=0)
+def benchmark(output, quotes, batch_rows, seed):
+    """Seed the demo manuals into a temporary SQLite database, time rating them, and write the results as JSON"""
+    from aspire.benchmark.benchmarks import run_benchmarks, write_results
+    write_results(run_benchmarks(quotes, batch_rows, seed=seed), output)
 
 
 cli.add_command(run_webapp)
 cli.add_command(build_database)
 cli.add_command(seed_demo_data)
+cli.add_command(seed_stress_manual)
 cli.add_command(rate_from_csv)
+cli.add_command(generate_inputs)
+cli.add_command(benchmark)
 
 if __name__ == '__main__':
     cli()
@@ -1,6 +1,10 @@
-from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean
-from sqlalchemy.orm import relationship, RelationshipProperty
-from typing import List, Union
+import itertools
+import threading
+import weakref
+from sqlalchemy import Table, Column, Integer, String, Text, DateTime, ForeignKey, Numeric, Boolean, MetaData, event, inspect
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, RelationshipProperty, Session
+from typing import Dict, List, Union
 from .engine import Base
 
 
@@ -10,6 +14,7 @@ class RatingManual(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     description = Column(String)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created = Column(DateTime)
 
     rating_steps = relationship("RatingStep", back_populates="rating_manual")
@@ -30,7 +35,7 @@ class RatingStep(Base):
     description = Column(String(255))
     step_order = Column(Integer)
     target = Column(String(50))
-    conditions = Column(String(512))
+    conditions = Column(Text)
     rate_loop_rating_step_id = Column(Integer, ForeignKey('rating_steps.id'))
     created = Column(DateTime)
 
@@ -112,12 +117,73 @@ class RatingFactor(Base):
     rating_manual = relationship("RatingManual")
 
 
+def changed_rating_manual_ids(session: Session, instance) -> set:
+    """The ids of the saved manuals which a change to a manual, or to one of its steps, parameters, variables or
+    factors, changes (both of them, where it's moved from one to another)"""
+    if isinstance(instance, RatingManual):
+        return {instance.id} if instance.id is not None else set()
+
+    state = inspect(instance)
+    ids = set()
+    if isinstance(instance, (RatingStep, RatingStepParameter, RatingVariable, RatingFactor)):
+        ids.update(state.attrs.rating_manual_id.history.sum())
+        manual = getattr(instance, 'rating_manual', None)
+        if manual is not None:
+            ids.add(manual.id)
+
+    # the steps within a loop, and parameters, may only be tied to a manual through the step they belong to
+    parent_ids = ()
+    if isinstance(instance, RatingStep):
+        parent_ids = state.attrs.rate_loop_rating_step_id.history.sum()
+    elif isinstance(instance, RatingStepParameter):
+        parent_ids = state.attrs.rating_step_id.history.sum()
+    for parent_id in parent_ids:
+        parent = session.query(RatingStep).get(parent_id) if parent_id is not None else None
+        if parent is not None:
+            ids |= changed_rating_manual_ids(session, parent)
+
+    ids.discard(None)
+    return ids
+
+
+@event.listens_for(Session, 'before_flush')
+def increment_changed_rating_manual_versions(session: Session, flush_context, instances):
+    """Increment the version of every saved manual which is changed (through the ORM) along with the flush, so that
+    whatever is cached by version (raters, their factors, compiled code and results) is replaced. Changes made outside
+    the ORM, e.g. to custom factor tables, need `RatingManualRepository.increment_version`."""
+    with session.no_autoflush:
+        changed = set()
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            if instance in session.dirty and not session.is_modified(instance):
+                continue
+            changed |= changed_rating_manual_ids(session, instance)
+
+        for rating_manual_id in changed:
+            manual = session.query(RatingManual).get(rating_manual_id)
+            if manual is None or manual in session.deleted or inspect(manual).attrs.version.history.has_changes():
+                continue
+            manual.version = (manual.version or 1) + 1
+
+
+# the models of custom rating factor tables, by the engine they were reflected from, then by table name
+custom_rating_factors_models = weakref.WeakKeyDictionary()  # type: Dict[object, Dict[str, type]]
+custom_rating_factors_models_lock = threading.Lock()
+
+
 def get_custom_rating_factors_model(table_name: str, engine):
-    class CustomModel(Base):
-        __table__ = Table(
-            table_name,
-            Base.metadata,
-            autoload_with=engine
-        )
-
-    return CustomModel
+    """A model of a custom rating factors table, reflected the first time it's needed on each engine. Each model has a
+    declarative base of its own, so that tables of the same name on different engines don't clash. A table changed
+    after it's been reflected needs a new engine (or clearing `custom_rating_factors_models`) to be seen."""
+    with custom_rating_factors_models_lock:
+        models = custom_rating_factors_models.setdefault(engine, {})
+        model = models.get(table_name)
+        if model is None:
+            class CustomModel(declarative_base()):
+                __table__ = Table(
+                    table_name,
+                    MetaData(),
+                    autoload_with=engine
+                )
+
+            model = models[table_name] = CustomModel
+        return model
@@ -1,4 +1,6 @@
 import json
+import random
+from typing import Iterable, Iterator, List, Optional
 from aspire.app.database.models import RatingManual, RatingStep, RatingStepParameter, RatingFactor, RatingVariable
 from aspire.app.domain.rating_step import RatingStepType as RatingStepTypeEnum
 from aspire.app.domain.rating_step_parameter import RatingStepParameterType as RatingStepParameterTypeEnum
@@ -868,6 +870,214 @@ def seed_auto_manual(session):
     session.commit()
 
 
+def seed_stress_manual(session, steps: int = 1000, condition_depth: int = 3, loop_depth: int = 1,
+                       factor_tables: int = 20, factor_rows: int = 1000, zip_rows: int = 100000,
+                       territories: int = 50, inputs: int = 10, seed: int = 0, name: str = 'Stress Manual') -> int:
+    """Seed a synthetic manual far bigger than the demo ones, to find what only slows down at scale, returning its id.
+
+    About `steps` steps (lookups and interpolations into `factor_tables` tables of `factor_rows` rows each, and
+    arithmetic on their results) are split evenly between the top level and `loop_depth` loops, each nested in the
+    last. Sub-risks at depth k are labelled `level_k`. Arithmetic steps have conditions `condition_depth` deep. The
+    territory is looked up by ZIP code from a table of `zip_rows` rows (or is an input, given none).
+
+    The steps are inserted one by one, for the database to assign their ids, and everything else in bulk, in chunks,
+    so that millions of rows of factors take seconds rather than minutes."""
+    rating_manual = RatingManual(name=name, description='Synthetic manual for stress testing')
+    session.add(rating_manual)
+    session.flush()
+
+    builder = StressManualBuilder(random.Random(seed), rating_manual.id, factor_tables, factor_rows, condition_depth,
+                                  inputs)
+    builder.build(steps, loop_depth, zip_rows, territories)
+
+    # each loop step comes before the steps within it, so has its id by the time they're inserted
+    step_ids = []
+    insert = RatingStep.__table__.insert()
+    for step in builder.steps:
+        loop_step = step['rate_loop_rating_step_id']
+        step = dict(step, rate_loop_rating_step_id=step_ids[loop_step] if loop_step is not None else None)
+        step_ids.append(session.execute(insert, step).inserted_primary_key[0])
+
+    bulk_insert(session, RatingStepParameter, (dict(parameter, rating_step_id=step_ids[parameter['rating_step_id']])
+                                               for parameter in builder.parameters))
+    bulk_insert(session, RatingVariable, builder.variables)
+    bulk_insert(session, RatingFactor, builder.factors(zip_rows, territories))
+    session.commit()
+    return rating_manual.id
+
+
+def bulk_insert(session, model, rows: Iterable[dict], chunk_size: int = 50000):
+    """Insert rows into a model's table with one executemany per chunk, bypassing the ORM"""
+    insert = model.__table__.insert()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            session.execute(insert, chunk)
+            chunk = []
+    if chunk:
+        session.execute(insert, chunk)
+
+
+class StressManualBuilder(object):
+    """Builds the rows of a synthetic manual's steps, parameters, variables and factors. Until they're inserted, steps
+    are referred to (by the steps in their loop, and by their parameters) by their index in `steps`."""
+
+    def __init__(self, rng: random.Random, rating_manual_id: int, factor_tables: int, factor_rows: int,
+                 condition_depth: int, inputs: int):
+        self.rng = rng
+        self.rating_manual_id = rating_manual_id
+        self.factor_tables = max(1, factor_tables)
+        self.factor_rows = max(2, factor_rows)
+        self.condition_depth = condition_depth
+        self.inputs = max(1, inputs)
+        self.steps = []
+        self.parameters = []
+        self.variables = []
+
+    def build(self, steps: int, loop_depth: int, zip_rows: int, territories: int):
+        if zip_rows:
+            self.variable('zip_code', 'integer', constraints='0,%d' % (zip_rows - 1))
+            self.step(RatingStepTypeEnum.LOOKUP, 'Lookup Territory by ZIP Code', 'territory',
+                      [literal('rating_factor_type', 'zip_territory'), variable('num_col_1', 'zip_code')])
+        else:
+            self.variable('territory', 'integer', constraints='1,%d' % territories)
+        self.step(RatingStepTypeEnum.LOOKUP, 'Lookup Territory Factor', 'territory_factor',
+                  [literal('rating_factor_type', 'territory'), variable('num_col_1', 'territory')])
+
+        self.segment(steps // (loop_depth + 1), loop_depth, ['territory_factor'])
+        self.step(RatingStepTypeEnum.ROUND, 'Round Rate', 'rate', [variable('rate', 'rate'), literal('precision', '2')])
+
+    def segment(self, count: int, loop_depth: int, factors: List[str] = (), level: int = 0, loop_step_id: int = None):
+        """Add steps which work out a rate for one level: the top level's `rate`, or each sub-risk's `level_k_rate`"""
+        prefix = 'level_%d_' % level if level else ''
+        sub_risk_label = 'level_%d' % level if level else None
+        rate = prefix + 'rate'
+        input_names = [prefix + 'input_%d' % i for i in range(self.inputs)]
+        for input_name in input_names:
+            self.variable(input_name, 'integer', sub_risk_label, '1,%d' % self.factor_rows)
+        amount = prefix + 'amount'
+        self.variable(amount, 'decimal', sub_risk_label, '1,%d' % self.factor_rows, default='1', length='10,2')
+
+        self.step(RatingStepTypeEnum.SET, 'Set Base Rate', rate, [literal('base rate', '100')], loop_step_id)
+        for factor in factors:
+            self.step(RatingStepTypeEnum.MULTIPLY, 'Apply ' + factor, rate,
+                      [variable(rate, rate), variable(factor, factor)], loop_step_id)
+
+        factor = None
+        for i in range(count):
+            table = 'factor_%d' % (i % self.factor_tables)
+            kind = i % 5
+            if kind in (0, 2):
+                factor = prefix + 'factor_%d' % i
+                if kind == 0:
+                    self.step(RatingStepTypeEnum.LOOKUP, 'Lookup %s' % table, factor,
+                              [literal('rating_factor_type', table),
+                               variable('num_col_1', input_names[i % len(input_names)])], loop_step_id)
+                else:
+                    self.step(RatingStepTypeEnum.LINEAR_INTERPOLATE, 'Interpolate %s' % table, factor,
+                              [literal('rating_factor_type', table), literal('options', 'interpolate:' + amount),
+                               variable('num_col_1', amount)], loop_step_id)
+            elif kind in (1, 3):
+                self.step(RatingStepTypeEnum.MULTIPLY, 'Apply ' + factor, rate,
+                          [variable(rate, rate), variable(factor, factor)], loop_step_id, self.conditions(input_names))
+            else:
+                self.step(RatingStepTypeEnum.ADD, 'Add Surcharge', rate,
+                          [variable(rate, rate), literal('surcharge', str(self.rng.randint(1, 25)))], loop_step_id,
+                          self.conditions(input_names))
+
+        if level < loop_depth:
+            sub_risks = 'level_%d' % (level + 1)
+            loop = self.step(RatingStepTypeEnum.LOOP, 'Loop over ' + sub_risks, None,
+                             [literal('Sub Risk Label', sub_risks)], loop_step_id)
+            self.segment(count, loop_depth, level=level + 1, loop_step_id=loop)
+            total = prefix + 'sub_risk_rates'
+            self.step(RatingStepTypeEnum.SUB_RISK_SUM, 'Sum %s rates' % sub_risks, total,
+                      [literal('sub risk label', sub_risks), literal('sub risk variable', sub_risks + '_rate')],
+                      loop_step_id)
+            self.step(RatingStepTypeEnum.ADD, 'Add %s rates' % sub_risks, rate,
+                      [variable(rate, rate), variable(total, total)], loop_step_id)
+
+    def step(self, rating_step_type: RatingStepTypeEnum, name: str, target: Optional[str], parameters: List[tuple],
+             loop_step_id: int = None, conditions: dict = None) -> int:
+        step_id = len(self.steps)
+        self.steps.append({
+            'rating_manual_id': None if loop_step_id is not None else self.rating_manual_id,
+            'rating_step_type_id': int(rating_step_type),
+            'name': name,
+            'description': None,
+            'step_order': len(self.steps) + 1,
+            'target': target,
+            'conditions': json.dumps(conditions) if conditions else None,
+            'rate_loop_rating_step_id': loop_step_id,
+        })
+        for parameter_order, (label, value, parameter_type) in enumerate(parameters, 1):
+            self.parameters.append({
+                'rating_step_id': step_id,
+                'parameter_order': parameter_order,
+                'label': label,
+                'value': value,
+                'parameter_type': int(parameter_type),
+            })
+        return step_id
+
+    def variable(self, name: str, variable_type: str, sub_risk_label: str = None, constraints: str = None,
+                 default: str = None, length: str = None):
+        self.variables.append({
+            'rating_manual_id': self.rating_manual_id,
+            'name': name,
+            'description': None,
+            'variable_type': variable_type,
+            'sub_risk_label': sub_risk_label,
+            'is_input': True,
+            'is_required': True,
+            'default': default,
+            'constraints': constraints,
+            'length': length,
+        })
+
+    def conditions(self, input_names: List[str]) -> Optional[dict]:
+        """A chain of `condition_depth` random comparisons of inputs, each joined to the rest by AND, OR or NOT"""
+        def comparison():
+            name = self.rng.choice(input_names)
+            return {self.rng.choice(['<', '<=', '>', '>=', '!=']): [
+                {'label': name, 'value': name, 'type': 'VARIABLE'},
+                {'label': 'threshold', 'value': str(self.rng.randint(1, self.factor_rows)), 'type': 'LITERAL'},
+            ]}
+
+        if self.condition_depth < 1:
+            return None
+        condition = comparison()
+        for _ in range(self.condition_depth - 1):
+            operator = self.rng.choice(['AND', 'OR', 'OR', 'NOT'])
+            condition = {operator: [condition] if operator == 'NOT' else [comparison(), condition]}
+        return condition
+
+    def factors(self, zip_rows: int, territories: int) -> Iterator[dict]:
+        """The rows of every factor table, generated as they're inserted so that big tables needn't fit in memory"""
+        rng = self.rng
+
+        def factor(rating_factor_type: str, key: int, value: str) -> dict:
+            return {'rating_manual_id': self.rating_manual_id, 'type': rating_factor_type, 'num_col_1': key,
+                    'value': value}
+
+        for zip_code in range(zip_rows):
+            yield factor('zip_territory', zip_code, str(rng.randint(1, territories)))
+        for territory in range(1, territories + 1):
+            yield factor('territory', territory, '%.4f' % rng.uniform(0.8, 1.2))
+        for table in range(self.factor_tables):
+            for key in range(1, self.factor_rows + 1):
+                yield factor('factor_%d' % table, key, '%.4f' % rng.uniform(0.98, 1.02))
+
+
+def literal(label: str, value: str) -> tuple:
+    return label, value, RatingStepParameterTypeEnum.LITERAL
+
+
+def variable(label: str, value: str) -> tuple:
+    return label, value, RatingStepParameterTypeEnum.VARIABLE
+
+
 def generate_demo_rating_input_csv(file_path="demo_input.csv"):
     import os
     from csv import DictWriter
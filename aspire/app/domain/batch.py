@@ -0,0 +1,496 @@
+from functools import reduce
+from itertools import repeat
+from typing import Callable, List
+import operator
+import numpy as np
+from .rating_step import AbstractRatingStep, BaseArithmeticRatingStep, AbstractSubRiskReduce, Set, Round, Lookup, \
+    LinearInterpolate, Loop
+from .rating_step_condition import AbstractRatingStepCondition, ComparisonOperation, LogicalOperation, equal_values
+from .rating_step_parameter import RatingStepParameter
+from .rating_variable import convert_to_number
+
+# Columns hold one value per rated input. A value of None marks a variable which has not been set for that input
+# (the equivalent of a missing key in row-at-a-time rating).
+
+UFUNCS = {
+    operator.add: np.add,
+    operator.sub: np.subtract,
+    operator.mul: np.multiply,
+    operator.truediv: np.divide,
+}
+
+
+def as_column(values) -> np.ndarray:
+    if isinstance(values, np.ndarray):
+        column = values
+    else:
+        values = list(values)
+        if any(isinstance(value, (list, tuple, dict)) for value in values):
+            column = np.empty(len(values), dtype=object)
+            for i, value in enumerate(values):
+                column[i] = value
+        else:
+            column = np.asarray(values)
+
+    # fixed-width string arrays silently truncate longer values written into them
+    if column.dtype.kind in 'US':
+        column = column.astype(object)
+    return column
+
+
+def broadcast(values, size: int) -> np.ndarray:
+    if isinstance(values, np.ndarray) and values.shape == (size,):
+        return values
+    if isinstance(values, np.ndarray):
+        return np.broadcast_to(values, (size,))
+    column = np.empty(size, dtype=object if not isinstance(values, (int, float, bool)) else type(values))
+    column[:] = values
+    return column
+
+
+def to_float(values):
+    if isinstance(values, np.ndarray):
+        return values if values.dtype == np.float64 else values.astype(np.float64)
+    return float(values)
+
+
+def as_mask(result, size: int) -> np.ndarray:
+    return np.broadcast_to(np.asarray(result, dtype=bool), (size,))
+
+
+def equal_columns(left, right):
+    """Compare two values (each a column or a constant) for equality row by row. As calculated values are kept as
+    numbers, a number is compared with a string (such as a literal) as numbers, just as `equal_values` does."""
+    if not isinstance(left, np.ndarray) and not isinstance(right, np.ndarray):
+        return equal_values(left, right)
+    if isinstance(right, np.ndarray) and not isinstance(left, np.ndarray):
+        left, right = right, left
+
+    if left.dtype.kind in 'fiub':
+        number = convert_to_number(right) if isinstance(right, str) else right
+        if isinstance(number, (int, float, bool, np.number)) or \
+                (isinstance(number, np.ndarray) and number.dtype.kind in 'fiub'):
+            return left == number
+
+    size = len(left)
+    rights = right.tolist() if isinstance(right, np.ndarray) else repeat(right, size)
+    return np.fromiter((equal_values(a, b) for a, b in zip(left.tolist(), rights)), dtype=bool, count=size)
+
+
+class ColumnFrame(object):
+    """The rating variables of a whole batch of inputs, stored as one column per variable"""
+
+    def __init__(self, columns: dict, size: int):
+        self.columns = columns
+        self.size = size
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        self.columns[name] = broadcast(values, self.size)
+
+    def set_rows(self, name, rows: np.ndarray, values):
+        values = broadcast(values, len(rows))
+        column = self.columns.get(name)
+        if column is None:
+            column = np.full(self.size, None, dtype=object)
+        elif column.dtype == values.dtype or (column.dtype.kind in 'fiub' and values.dtype.kind in 'fiub'
+                                              and np.can_cast(values.dtype, column.dtype)):
+            column = column.copy()
+        else:
+            column = column.astype(object)
+
+        column[rows] = values
+        self.columns[name] = column
+
+    def subset(self, rows: np.ndarray):
+        return FrameSubset(self, rows)
+
+
+class FrameSubset(object):
+    """A view of some rows of a frame, used to run a step on only the inputs which meet its conditions"""
+
+    def __init__(self, frame, rows: np.ndarray):
+        self.frame = frame
+        self.rows = rows
+        self.size = len(rows)
+        self.cache = {}
+
+    def __contains__(self, name):
+        return name in self.frame
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            self.cache[name] = self.frame[name][self.rows]
+        return self.cache[name]
+
+    def __setitem__(self, name, values):
+        self.frame.set_rows(name, self.rows, values)
+        self.cache.pop(name, None)
+
+    def set_rows(self, name, rows: np.ndarray, values):
+        self.frame.set_rows(name, self.rows[rows], values)
+        self.cache.pop(name, None)
+
+    def subset(self, rows: np.ndarray):
+        return FrameSubset(self, rows)
+
+
+class ParentWrite(Exception):
+    """Raised when a loop body updates a variable of the parent risk while its sub-risks are rated all at once"""
+
+    def __init__(self, frame, name: str):
+        super().__init__("Loop updates the parent risk's '%s'" % name)
+        self.frame = frame
+        self.name = name
+
+
+class LoopFrame(ColumnFrame):
+    """One row per sub-risk. Variables of the parent risk are read through to the parent (taking precedence over
+    the sub-risk's own variables, as in row-at-a-time rating); variables written in the loop belong to the sub-risk.
+
+    Updates to the parent's variables depend on the order the sub-risks are rated in, so they're only made (through
+    to the parent) with `writes_parent`, where each parent has at most one sub-risk in the frame; otherwise they raise
+    ParentWrite."""
+
+    def __init__(self, parent, parent_index: np.ndarray, columns: dict, writes_parent: bool = False):
+        super().__init__(columns, len(parent_index))
+        self.parent = parent
+        self.parent_index = parent_index
+        self.writes_parent = writes_parent
+        self.cache = {}
+
+    def __contains__(self, name):
+        return name in self.columns or name in self.parent
+
+    def __getitem__(self, name):
+        if name in self.parent:
+            if name not in self.cache:
+                self.cache[name] = self.parent[name][self.parent_index]
+            return self.cache[name]
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        if name in self.parent:
+            self.set_parent_rows(name, self.parent_index, values)
+        else:
+            super().__setitem__(name, values)
+
+    def set_rows(self, name, rows: np.ndarray, values):
+        if name in self.parent:
+            self.set_parent_rows(name, self.parent_index[rows], values)
+        else:
+            super().set_rows(name, rows, values)
+
+    def set_parent_rows(self, name, parent_rows: np.ndarray, values):
+        if not self.writes_parent:
+            raise ParentWrite(self, name)
+        self.parent.set_rows(name, parent_rows, values)
+        self.cache.pop(name, None)
+
+
+def explode(sub_risks: np.ndarray):
+    lengths = np.fromiter((len(risks) for risks in sub_risks), dtype=np.intp, count=len(sub_risks))
+    parent_index = np.repeat(np.arange(len(sub_risks)), lengths)
+    flattened = [sub_risk for risks in sub_risks for sub_risk in risks]
+    return flattened, lengths, parent_index
+
+
+def map_unique(size: int, values: list, fn: Callable) -> np.ndarray:
+    """Call `fn` once with every distinct combination of values (each value being a column or a constant) for a list
+    of their results, and spread the results back out into a column"""
+    keys = zip(*[value.tolist() if isinstance(value, np.ndarray) else repeat(value, size) for value in values])
+    index = {}
+    codes = np.fromiter((index.setdefault(key, len(index)) for key in keys), dtype=np.intp, count=size)
+
+    results = np.empty(len(index), dtype=object)
+    results[:] = fn(list(index)) if index else []
+    return results[codes]
+
+
+def group_by_first(keys: List[tuple]) -> dict:
+    """The indices of the keys with each distinct first value"""
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key[0], []).append(i)
+    return groups
+
+
+def group_rows(size: int, values: list):
+    """The rows with each distinct combination of values (each value being a column or a constant)"""
+    keys = zip(*[value.tolist() if isinstance(value, np.ndarray) else repeat(value, size) for value in values])
+    index = {}
+    codes = np.fromiter((index.setdefault(key, len(index)) for key in keys), dtype=np.intp, count=size)
+    if len(index) == 1:
+        return [(next(iter(index)), np.arange(size))]
+    return [(key, np.flatnonzero(codes == i)) for key, i in index.items()]
+
+
+class BatchPlan(object):
+    """Rating steps compiled to run over whole columns of inputs at once: arithmetic becomes array operations,
+    conditions become boolean masks, and lookups are made once per distinct set of lookup parameters."""
+
+    def __init__(self, rating_steps: List[AbstractRatingStep]):
+        self.executors = compile_batch_steps(rating_steps)
+
+    def run(self, columns: dict) -> dict:
+        columns = {name: as_column(values) for name, values in columns.items()}
+        sizes = set(len(column) for column in columns.values())
+        if len(sizes) > 1:
+            raise ValueError("All input columns must have the same length")
+
+        frame = ColumnFrame(columns, sizes.pop() if sizes else 0)
+        run_batch_steps(self.executors, frame)
+        return frame.columns
+
+
+def run_batch_steps(executors: List[Callable], frame):
+    for execute in executors:
+        execute(frame)
+
+
+def compile_batch_steps(rating_steps: List[AbstractRatingStep]) -> List[Callable]:
+    return [compile_batch_step(rating_step) for rating_step in rating_steps]
+
+
+def compile_batch_step(rating_step: AbstractRatingStep) -> Callable:
+    execute = compile_batch_apply(rating_step)
+    if not rating_step.conditions:
+        return execute
+    return compile_run_if(rating_step.conditions, execute)
+
+
+def compile_batch_apply(rating_step: AbstractRatingStep) -> Callable:
+    if isinstance(rating_step, Loop):
+        return compile_loop(rating_step)
+    if isinstance(rating_step, AbstractSubRiskReduce):
+        return compile_sub_risk_reduce(rating_step)
+    if isinstance(rating_step, BaseArithmeticRatingStep):
+        return compile_arithmetic(rating_step)
+    if isinstance(rating_step, Set):
+        return compile_set(rating_step)
+    if isinstance(rating_step, Round):
+        return compile_round(rating_step)
+    if isinstance(rating_step, Lookup):
+        return compile_lookup(rating_step)
+    if isinstance(rating_step, LinearInterpolate):
+        return compile_linear_interpolate(rating_step)
+    raise TypeError("Unable to batch rate step %s" % rating_step.__class__.__name__)
+
+
+def compile_run_if(conditions: AbstractRatingStepCondition, execute: Callable) -> Callable:
+    """Run a step on only the rows which meet its conditions"""
+    condition = compile_batch_condition(conditions)
+
+    def run_if(frame):
+        mask = as_mask(condition(frame), frame.size)
+        if mask.all():
+            execute(frame)
+        elif mask.any():
+            execute(frame.subset(np.flatnonzero(mask)))
+    return run_if
+
+
+def compile_value(rating_step_parameter: RatingStepParameter) -> Callable:
+    # parameters evaluate against a frame just as they do against a dict, giving a column or a constant
+    return rating_step_parameter.compile()
+
+
+def compile_arithmetic(rating_step: BaseArithmeticRatingStep):
+    operation = rating_step.operation
+    target = rating_step.target
+    operands = [compile_value(operand) for operand in rating_step.operands]
+
+    def execute(frame):
+        frame[target] = reduce(operation, [to_float(operand(frame)) for operand in operands])
+    return execute
+
+
+def compile_set(rating_step: Set):
+    target = rating_step.target
+    value = compile_value(rating_step.value)
+
+    def execute(frame):
+        frame[target] = value(frame)
+    return execute
+
+
+def compile_round(rating_step: Round):
+    target = rating_step.target
+    value = compile_value(rating_step.value)
+    places = compile_value(rating_step.places)
+
+    def execute(frame):
+        values = to_float(value(frame))
+        decimal_places = places(frame)
+        if not isinstance(decimal_places, np.ndarray):
+            frame[target] = np.round(values, int(decimal_places))
+            return
+
+        rounded = np.empty(frame.size, dtype=np.float64)
+        values = broadcast(values, frame.size)
+        decimal_places = decimal_places.astype(int)
+        for places_value in np.unique(decimal_places):
+            rows = decimal_places == places_value
+            rounded[rows] = np.round(values[rows], int(places_value))
+        frame[target] = rounded
+    return execute
+
+
+def compile_lookup(rating_step: Lookup):
+    target = rating_step.target
+    lookup_many = rating_step.rating_factor_repository.lookup_many
+    rating_factor_type = compile_value(rating_step.inputs[0])
+    options, inputs = rating_step.parse_inputs()
+    labels = [rating_step_parameter.label for rating_step_parameter in inputs]
+    inputs = [compile_value(rating_step_parameter) for rating_step_parameter in inputs]
+
+    def lookup_keys(keys: List[tuple]) -> list:
+        # the factors of each type are looked up together
+        results = {}
+        for rating_factor_type_value, rows in group_by_first(keys).items():
+            values = lookup_many(rating_factor_type_value, [dict(zip(labels, keys[i][1:])) for i in rows], options)
+            results.update(zip(rows, values))
+        return [results[i] for i in range(len(keys))]
+
+    def execute(frame):
+        values = [rating_factor_type(frame)] + [evaluate(frame) for evaluate in inputs]
+        frame[target] = map_unique(frame.size, values, lookup_keys)
+    return execute
+
+
+def compile_linear_interpolate(rating_step: LinearInterpolate):
+    target = rating_step.target
+    rating_factor_repository = rating_step.rating_factor_repository
+    rating_factor_type = compile_value(rating_step.params[0])
+    params, interpolate_column = rating_step.parse_params()
+    labels = [rating_step_parameter.label for rating_step_parameter in params]
+    params = [compile_value(rating_step_parameter) for rating_step_parameter in params]
+
+    def execute(frame):
+        if interpolate_column is None:
+            raise Exception("Missing input for interpolation")
+
+        values = [evaluate(frame) for evaluate in params]
+        # as when the params are put in a dict, the last with the interpolated column's label is the one used
+        xs = broadcast([value for label, value in zip(labels, values) if label == interpolate_column][-1], frame.size)
+        fixed_labels = [label for label in labels if label != interpolate_column]
+        fixed = [rating_factor_type(frame)] + [value for label, value in zip(labels, values)
+                                                if label != interpolate_column]
+
+        # each group of rows with the same factor type and other params is interpolated at once
+        result = np.empty(frame.size, dtype=np.float64)
+        for key, rows in group_rows(frame.size, fixed):
+            result[rows] = rating_factor_repository.interpolate_many(
+                key[0], dict(zip(fixed_labels, key[1:])), interpolate_column, xs[rows].tolist()
+            )
+        frame[target] = result
+    return execute
+
+
+def compile_loop(rating_step: Loop):
+    sub_risk_label = compile_value(rating_step.sub_risk_label)
+    body = compile_batch_steps(rating_step.rating_steps)
+    sequential = False
+
+    def execute(frame):
+        nonlocal sequential
+        label = sub_risk_label(frame)
+        flattened, lengths, parent_index = explode(frame[label])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        if not sequential:
+            try:
+                updated = rate_sub_risks(body, frame, parent_index, flattened)
+            except ParentWrite as error:
+                if error.frame.parent is not frame:
+                    raise
+                # the loop updates the parent risk, which from now on is rated as in row-at-a-time rating
+                sequential = True
+
+        if sequential:
+            # the sub-risks at each position are rated together, after those before them and so seeing their updates
+            updated = [None] * len(flattened)
+            for position in range(lengths.max() if len(lengths) else 0):
+                parents = np.flatnonzero(lengths > position)
+                indices = (offsets[parents] + position).tolist()
+                sub_risks = rate_sub_risks(body, frame, parents, [flattened[i] for i in indices], writes_parent=True)
+                for i, sub_risk in zip(indices, sub_risks):
+                    updated[i] = sub_risk
+
+        sub_risks = np.empty(frame.size, dtype=object)
+        for i in range(frame.size):
+            sub_risks[i] = updated[offsets[i]:offsets[i + 1]]
+        frame[label] = sub_risks
+    return execute
+
+
+def rate_sub_risks(body: List[Callable], frame, parent_index: np.ndarray, sub_risks: List[dict],
+                   writes_parent: bool = False) -> List[dict]:
+    """Run a loop body over sub-risks (each of the parent row at the same position in `parent_index`). As in
+    row-at-a-time rating, each sub-risk ends up with its own (unshadowed) variables plus those written."""
+    if not sub_risks:
+        return []
+
+    names = list(dict.fromkeys(name for sub_risk in sub_risks for name in sub_risk))
+    columns = {name: as_column([sub_risk.get(name) for sub_risk in sub_risks]) for name in names}
+    sub_frame = LoopFrame(frame, parent_index, columns, writes_parent)
+    run_batch_steps(body, sub_frame)
+
+    names = [name for name in sub_frame.columns if name not in frame]
+    values = zip(*[sub_frame.columns[name].tolist() for name in names]) if names else repeat((), len(sub_risks))
+    return [{name: value for name, value in zip(names, row) if value is not None} for row in values]
+
+
+def compile_sub_risk_reduce(rating_step: AbstractSubRiskReduce):
+    ufunc = UFUNCS[rating_step.operation]
+    target = rating_step.target
+    sub_risk_label = compile_value(rating_step.sub_risk_label)
+    sub_risk_variable = compile_value(rating_step.sub_risk_variable)
+
+    def execute(frame):
+        name = sub_risk_variable(frame)
+        flattened, lengths, _ = explode(frame[sub_risk_label(frame)])
+        values = np.fromiter((float(sub_risk[name]) for sub_risk in flattened), dtype=np.float64, count=len(flattened))
+
+        # as in row-at-a-time rating, an input without any sub-risks has nothing to reduce
+        if not lengths.all():
+            raise TypeError("reduce() of empty sequence with no initial value")
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        frame[target] = ufunc.reduceat(values, starts) if frame.size else np.empty(0)
+    return execute
+
+
+def compile_batch_condition(condition: AbstractRatingStepCondition) -> Callable:
+    if isinstance(condition, ComparisonOperation):
+        operands = [compile_value(operand) for operand in (condition.operands or [])]
+        if condition.operator in ['<', '<=', '>', '>=']:
+            compare = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}[condition.operator]
+            left, right = operands[0], operands[1]
+            return lambda frame: compare(to_float(left(frame)), to_float(right(frame)))
+        if condition.operator in ['==', '!=']:
+            left, right = operands[0], operands[1]
+            if condition.operator == '==':
+                return lambda frame: equal_columns(left(frame), right(frame))
+            return lambda frame: np.logical_not(equal_columns(left(frame), right(frame)))
+        if condition.operator == 'BETWEEN':
+            value, lower, upper = operands[0], operands[1], operands[2]
+            return lambda frame: np.logical_and(to_float(lower(frame)) <= to_float(value(frame)),
+                                                to_float(value(frame)) <= to_float(upper(frame)))
+        return lambda frame: False
+
+    if isinstance(condition, LogicalOperation):
+        operands = [compile_batch_condition(operand) for operand in (condition.operands or [])]
+        if condition.operator == 'AND':
+            return lambda frame: reduce(np.logical_and, [operand(frame) for operand in operands])
+        if condition.operator == 'OR':
+            return lambda frame: reduce(np.logical_or, [operand(frame) for operand in operands])
+        if condition.operator == 'NOT':
+            return lambda frame: np.logical_not(operands[0](frame))
+        return lambda frame: False
+
+    raise TypeError("Unable to batch rate condition %s" % condition.__class__.__name__)
@@ -0,0 +1,185 @@
+from functools import reduce
+from types import CodeType
+from typing import Callable, List
+import hashlib
+import operator
+from ..repository.rating_factor_repository import AbstractRatingFactorRepository
+from .rating_manual import RatingManual
+from .rating_step import AbstractRatingStep, BaseArithmeticRatingStep, AbstractSubRiskReduce, Set, Round, Lookup, \
+    LinearInterpolate, Loop
+from .rating_step_condition import AbstractRatingStepCondition, ComparisonOperation, LogicalOperation
+from .rating_step_parameter import RatingStepParameter, RatingStepParameterType
+
+FUNCTION_NAME = 'rate_manual'
+
+
+def generator_fingerprint() -> str:
+    """A hash of this module's source, on which generated code depends as much as on the manual it's generated from"""
+    with open(__file__, 'rb') as source:
+        return hashlib.sha1(source.read()).hexdigest()[:12]
+
+
+GENERATOR_FINGERPRINT = generator_fingerprint()
+
+ARITHMETIC_OPERATORS = {
+    operator.add: '+',
+    operator.sub: '-',
+    operator.mul: '*',
+    operator.truediv: '/',
+}
+
+REDUCE_OPERATORS = {
+    operator.add: 'add',
+    operator.mul: 'mul',
+}
+
+NUMERIC_COMPARISONS = ['<', '<=', '>', '>=']
+
+
+class SourceGenerator(object):
+    """Emits a rating manual as the source of a single straight-line Python function. Each rating step becomes a
+    statement (guarded by an `if` for its conditions), and each loop becomes an inline `for` over its sub-risks."""
+
+    def __init__(self):
+        self.lines = []
+
+    def generate(self, rating_manual: RatingManual) -> str:
+        self.lines = []
+        self.emit(0, 'def %s(rv0):' % FUNCTION_NAME)
+        self.emit_steps(rating_manual.rating_steps, 1, 0)
+        self.emit(1, 'return rv0')
+        return '\n'.join(self.lines) + '\n'
+
+    def emit(self, indent: int, line: str):
+        self.lines.append('    ' * indent + line)
+
+    def emit_steps(self, rating_steps: List[AbstractRatingStep], indent: int, depth: int):
+        for rating_step in rating_steps:
+            self.emit_step(rating_step, indent, depth)
+
+    def emit_step(self, rating_step: AbstractRatingStep, indent: int, depth: int):
+        scope = 'rv%d' % depth
+        if rating_step.name:
+            self.emit(indent, '# %s' % ' '.join(str(rating_step.name).split()))
+
+        if rating_step.conditions:
+            self.emit(indent, 'if %s:' % condition_source(rating_step.conditions, scope))
+            indent += 1
+
+        if isinstance(rating_step, Loop):
+            self.emit_loop(rating_step, indent, depth)
+        elif isinstance(rating_step, AbstractSubRiskReduce):
+            self.emit(indent, '%s[%r] = reduce(%s, [float(sub_risk[%s]) for sub_risk in %s[%s]])' % (
+                scope, rating_step.target, REDUCE_OPERATORS[rating_step.operation],
+                value_source(rating_step.sub_risk_variable, scope), scope,
+                value_source(rating_step.sub_risk_label, scope)
+            ))
+        elif isinstance(rating_step, BaseArithmeticRatingStep):
+            padded = ' %s ' % ARITHMETIC_OPERATORS[rating_step.operation]
+            expression = padded.join('float(%s)' % value_source(o, scope) for o in rating_step.operands)
+            self.emit(indent, '%s[%r] = str(%s)' % (scope, rating_step.target, expression))
+        elif isinstance(rating_step, Set):
+            self.emit(indent, '%s[%r] = str(%s)' % (scope, rating_step.target, value_source(rating_step.value, scope)))
+        elif isinstance(rating_step, Round):
+            self.emit(indent, '%s[%r] = str(round(float(%s), int(%s)))' % (
+                scope, rating_step.target, value_source(rating_step.value, scope),
+                value_source(rating_step.places, scope)
+            ))
+        elif isinstance(rating_step, Lookup):
+            self.emit_lookup(rating_step, indent, scope)
+        elif isinstance(rating_step, LinearInterpolate):
+            self.emit_linear_interpolate(rating_step, indent, scope)
+        else:
+            raise TypeError("Unable to generate source for rating step %s" % rating_step.__class__.__name__)
+
+    def emit_lookup(self, rating_step: Lookup, indent: int, scope: str):
+        options, inputs = rating_step.parse_inputs()
+        self.emit(indent, '%s[%r] = rating_factor_repository.lookup(%s, %s, %r)' % (
+            scope, rating_step.target, value_source(rating_step.inputs[0], scope), params_source(inputs, scope), options
+        ))
+
+    def emit_linear_interpolate(self, rating_step: LinearInterpolate, indent: int, scope: str):
+        params, interpolate_column = rating_step.parse_params()
+        if interpolate_column is None:
+            self.emit(indent, 'raise Exception("Missing input for interpolation")')
+            return
+
+        self.emit(indent, '%s[%r] = str(rating_factor_repository.interpolate(%s, %s, %r))' % (
+            scope, rating_step.target, value_source(rating_step.params[0], scope), params_source(params, scope),
+            interpolate_column
+        ))
+
+    def emit_loop(self, rating_step: Loop, indent: int, depth: int):
+        scope = 'rv%d' % depth
+        sub_scope = 'rv%d' % (depth + 1)
+        sub_risks = 'sub_risks_%d' % depth
+        i = 'i_%d' % depth
+        k = 'k_%d' % depth
+
+        self.emit(indent, '%s = %s[%s]' % (sub_risks, scope, value_source(rating_step.sub_risk_label, scope)))
+        self.emit(indent, 'for %s, sub_risk_vars in enumerate(%s):' % (i, sub_risks))
+        self.emit(indent + 1, '%s = {**sub_risk_vars, **%s}' % (sub_scope, scope))
+        self.emit_steps(rating_step.rating_steps, indent + 1, depth + 1)
+        self.emit(indent + 1, 'for %s in %s.keys():' % (k, scope))
+        self.emit(indent + 2, '%s[%s] = %s[%s]' % (scope, k, sub_scope, k))
+        self.emit(indent + 1, '%s[%s] = {%s: v for %s, v in %s.items() if %s not in %s}' % (
+            sub_risks, i, k, k, sub_scope, k, scope
+        ))
+
+
+def value_source(rating_step_parameter: RatingStepParameter, scope: str) -> str:
+    if rating_step_parameter.parameter_type == RatingStepParameterType.VARIABLE:
+        return '%s[%r]' % (scope, rating_step_parameter.value)
+    if rating_step_parameter.parameter_type == RatingStepParameterType.LITERAL:
+        return repr(rating_step_parameter.value)
+    return 'None'
+
+
+def params_source(rating_step_parameters: List[RatingStepParameter], scope: str) -> str:
+    return '{' + ', '.join('%r: %s' % (p.label, value_source(p, scope)) for p in rating_step_parameters) + '}'
+
+
+def condition_source(condition: AbstractRatingStepCondition, scope: str) -> str:
+    if isinstance(condition, ComparisonOperation):
+        operands = [value_source(operand, scope) for operand in (condition.operands or [])]
+        if condition.operator in NUMERIC_COMPARISONS:
+            return '(float(%s) %s float(%s))' % (operands[0], condition.operator, operands[1])
+        if condition.operator in ['==', '!=']:
+            return '(%s %s %s)' % (operands[0], condition.operator, operands[1])
+        if condition.operator == 'BETWEEN':
+            return '(float(%s) <= float(%s) <= float(%s))' % (operands[1], operands[0], operands[2])
+        return 'False'
+
+    if isinstance(condition, LogicalOperation):
+        operands = [condition_source(operand, scope) for operand in (condition.operands or [])]
+        if condition.operator == 'AND':
+            return '(' + ' and '.join(operands) + ')'
+        if condition.operator == 'OR':
+            return '(' + ' or '.join(operands) + ')'
+        if condition.operator == 'NOT':
+            return '(not %s)' % operands[0]
+        return 'False'
+
+    raise TypeError("Unable to generate source for condition %s" % condition.__class__.__name__)
+
+
+def generate_source(rating_manual: RatingManual) -> str:
+    return SourceGenerator().generate(rating_manual)
+
+
+def compile_rating_manual(rating_manual: RatingManual) -> CodeType:
+    filename = '<rating manual %s v%s>' % (rating_manual.id, rating_manual.version)
+    return compile(generate_source(rating_manual), filename, 'exec')
+
+
+def load_rate_function(code: CodeType, rating_factor_repository: AbstractRatingFactorRepository) -> Callable[[dict], dict]:
+    """Execute generated code and return its rating function. Every lookup in the generated function is made against
+    the given rating factor repository."""
+    namespace = {
+        'rating_factor_repository': rating_factor_repository,
+        'reduce': reduce,
+        'add': operator.add,
+        'mul': operator.mul,
+    }
+    exec(code, namespace)
+    return namespace[FUNCTION_NAME]
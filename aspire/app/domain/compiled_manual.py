@@ -0,0 +1,277 @@
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Tuple
+from .rating_frame import FrameLayout, UNSET
+from .instrumentation import RatingMetrics
+from .parallel import LoopRegistry, ParallelLoops
+from .prefetch import PrefetchPlan
+from .tracing import Tracer
+from .rating_manual import RatingManual
+from .rating_step import AbstractRatingStep, Loop, skip
+from .rating_variable import RatingVariable, copy_value
+from .step_graph import StepGraph
+
+# the kinds of record made when a manual is run with a record of what each step did
+INPUT, STEP, LOOP, ITERATION = range(4)
+
+
+class CompiledStep(object):
+    __slots__ = ('step', 'execute', 'writes', 'sub_plan', 'check', 'iterate')
+
+    def __init__(self, step: AbstractRatingStep, execute: Callable, writes: tuple = (),
+                 sub_plan: List['CompiledStep'] = None, check: Callable = None, iterate: Callable = None):
+        self.step = step
+        self.execute = execute
+        self.writes = writes
+        self.sub_plan = sub_plan
+        self.check = check
+        self.iterate = iterate
+
+
+class RatingState(object):
+    """What rating one set of inputs left behind, so that it can be re-rated once some of them change: the inputs as
+    given, and the values which each top-level step left in the variables it writes"""
+    __slots__ = ('inputs', 'written')
+
+    def __init__(self, inputs: dict, written: List[tuple]):
+        self.inputs = inputs
+        self.written = written
+
+
+def compile_rating_steps(rating_steps: List[AbstractRatingStep], layout: FrameLayout,
+                         native_types: bool = False) -> List[CompiledStep]:
+    plan = []
+    for rating_step in rating_steps:
+        compiled_step = CompiledStep(rating_step, rating_step.compile(layout, native_types))
+        target = getattr(rating_step, 'target', None)
+        if target is not None:
+            compiled_step.writes = ((target, layout.slot(target)),)
+        if isinstance(rating_step, Loop):
+            compiled_step.sub_plan = compile_rating_steps(rating_step.rating_steps, layout, native_types)
+            compiled_step.iterate, _ = rating_step.compile_iteration(layout, native_types)
+            if rating_step.conditions:
+                compiled_step.check = rating_step.conditions.compile(layout)
+        plan.append(compiled_step)
+    return plan
+
+
+def typed_rating_variables(rating_manual: RatingManual) -> Dict[str, Dict[str, RatingVariable]]:
+    """The manual's rating variables which have a native type to convert inputs to, keyed by sub-risk label"""
+    typed = {}
+    for sub_risk_label, rating_variables in rating_manual.get_rating_variables_by_sub_risk().items():
+        typed[sub_risk_label] = {
+            rating_variable.name: rating_variable for rating_variable in rating_variables
+            if rating_variable is not None and type(rating_variable).coerce is not RatingVariable.coerce
+        }
+    return typed
+
+
+class CompiledManual(object):
+    """A rating manual whose steps, parameters and conditions have been bound into a flat list of callables once,
+    so that any number of inputs can be rated against it without re-interpreting the step objects.
+
+    By default every calculated value is formatted as a string, as it always has been. With `native_types`, inputs
+    are converted once according to the manual's rating variable definitions and values stay numeric throughout,
+    leaving any formatting to whatever outputs them.
+
+    Given `parallel`, the sub-risks of top-level loops may be rated on a pool of workers (see ParallelLoops).
+
+    Given `memo_size`, each lookup remembers the factors for up to that many distinct sets of parameters, for as long
+    as the compiled manual is used, or until `clear_memos`.
+
+    Given `metrics`, every step records how often it's run and how long it takes (see RatingMetrics). Given a `tracer`
+    with subscribers, its hooks are called around each rating, step, lookup and loop iteration (see Tracer).
+
+    Lookups which depend on the inputs alone are made together as each rating starts, where the repository they're
+    made against batches lookups (see PrefetchPlan).
+
+    When only some output variables are wanted, only the steps they depend on are run."""
+    rating_manual: RatingManual
+    layout: FrameLayout
+    plan: List[CompiledStep]
+
+    def __init__(self, rating_manual: RatingManual, native_types: bool = False, parallel: ParallelLoops = None,
+                 memo_size: int = None, metrics: RatingMetrics = None, tracer: Tracer = None):
+        self.rating_manual = rating_manual
+        self.native_types = native_types
+        self.typed_rating_variables = typed_rating_variables(rating_manual) if native_types else {}
+        self.metrics = metrics
+        # hooks are only compiled in for a tracer with subscribers
+        self.tracer = tracer if tracer is not None and tracer.subscribers else None
+        self.layout = FrameLayout(memo_size=memo_size, metrics=metrics, tracer=self.tracer, native_types=native_types)
+        prefetch = PrefetchPlan(rating_manual.rating_steps, self.layout)
+        self.prefetch = self.layout.prefetch = prefetch if prefetch.steps else None
+        self.plan = compile_rating_steps(rating_manual.rating_steps, self.layout, native_types)
+        self.executors = [compiled_step.execute for compiled_step in self.plan]
+        # loops run in worker processes are registered for as long as the manual is in use
+        self.loops = LoopRegistry() if parallel is not None and parallel.use_processes else None
+        if parallel is not None:
+            for i, compiled_step in enumerate(self.plan):
+                if compiled_step.sub_plan is not None:
+                    self.executors[i] = parallel.compile_loop(compiled_step, self.layout, self.loops)
+        # steps whose conditions can never be met are left out of the executors actually run
+        self.runnable = [execute for execute in self.executors if execute is not skip]
+        self.batch_plan = None
+        self.graph = StepGraph(rating_manual.rating_steps)
+        self.selected_plans = {}
+        self.incremental_plan = None
+        if self.tracer is not None:
+            self.run = self.tracer.trace_rating(rating_manual, self.run)
+            self.run_keeping_state = self.tracer.trace_rating(rating_manual, self.run_keeping_state)
+            self.rate_batch = self.tracer.trace_rating(rating_manual, self.rate_batch)
+
+    def select(self, outputs: Iterable[str]) -> Tuple[List[CompiledStep], List[Callable]]:
+        """The part of the plan (and its executors) needed to calculate the given output variables"""
+        outputs = frozenset(outputs)
+        selected = self.selected_plans.get(outputs)
+        if selected is None:
+            required = self.graph.required(outputs)
+            selected = ([self.plan[i] for i in required],
+                        [self.executors[i] for i in required if self.executors[i] is not skip])
+            self.selected_plans[outputs] = selected
+        return selected
+
+    def run(self, rating_variables: dict, record: list = None, outputs: Iterable[str] = None):
+        """Rate the given rating variables in place. When given a `record` list, the inputs and then what each step
+        wrote are appended to it, from which the rating variables after each step can be rebuilt. Given `outputs`,
+        only the steps needed to calculate those variables are run."""
+        if self.metrics is not None:
+            start = perf_counter()
+            try:
+                return self.run_steps(rating_variables, record, outputs)
+            finally:
+                self.metrics.record_rating(perf_counter() - start)
+        return self.run_steps(rating_variables, record, outputs)
+
+    def run_steps(self, rating_variables: dict, record: list = None, outputs: Iterable[str] = None):
+        if self.native_types:
+            self.coerce_inputs(rating_variables)
+
+        plan, executors = (self.plan, self.runnable) if outputs is None else self.select(outputs)
+        layout = self.layout
+        frame = layout.load(rating_variables)
+        prefetch = self.prefetch
+        if prefetch is not None:
+            prefetch.prefetch(frame, [compiled_step.step for compiled_step in plan])
+        try:
+            if record is None:
+                for execute in executors:
+                    execute(frame)
+            else:
+                record.append((INPUT, copy_value(rating_variables)))
+                run_recorded(plan, frame, record)
+        finally:
+            if prefetch is not None:
+                prefetch.clear()
+        return layout.unload(frame, rating_variables)
+
+    def run_keeping_state(self, rating_variables: dict, state: RatingState = None, changed: Iterable[str] = None):
+        """Rate the given rating variables in place, also returning the state they leave behind. Given the state left
+        by rating earlier inputs, and the names of those inputs which have since changed, only the steps which depend
+        on them are run; every other step's values are restored from that state instead."""
+        inputs = copy_value(rating_variables)
+        if self.native_types:
+            self.coerce_inputs(rating_variables)
+
+        if self.incremental_plan is None:
+            self.incremental_plan = self.plan_increments()
+
+        layout = self.layout
+        frame = layout.load(rating_variables)
+        changed = None if state is None else set(changed)
+        previously_written = state.written if state is not None else [()] * len(self.executors)
+        written = []
+        for execute, reads, writes, slots, previous in zip(self.executors, *self.incremental_plan, previously_written):
+            if changed is None or reads is None or not changed.isdisjoint(reads):
+                execute(frame)
+                if changed is not None:
+                    if reads is None:
+                        # this step's effects can't be known, so every step after it must run too
+                        changed = None
+                    else:
+                        changed |= writes
+            else:
+                for slot, value in previous:
+                    frame[slot] = copy_value(value)
+
+            written.append(tuple((slot, copy_value(frame[slot])) for slot in slots))
+        return layout.unload(frame, rating_variables), RatingState(inputs, written)
+
+    def plan_increments(self) -> tuple:
+        """For each top-level step: the names which must have changed for it to need running again (or None when it
+        must always run), the names it may write, and their slots"""
+        slots = self.layout.slots
+        reads, writes, write_slots = [], [], []
+        for rating_step in self.rating_manual.rating_steps:
+            names = rating_step.writes()
+            step_reads = rating_step.reads()
+            if step_reads is not None and (rating_step.conditions or isinstance(rating_step, Loop)):
+                # a step which may not write its target leaves whatever an earlier step wrote
+                step_reads = step_reads | names
+            reads.append(step_reads)
+            writes.append(names)
+            write_slots.append(tuple(slots[name] for name in names if name in slots))
+        return reads, writes, write_slots
+
+    def rerate(self, state: RatingState, changed_inputs: dict) -> Tuple[dict, RatingState]:
+        """Re-rate the inputs which left the given state, with some of them changed"""
+        rating_variables = copy_value(state.inputs)
+        changed = {name for name, value in changed_inputs.items() if rating_variables.get(name, UNSET) != value}
+        rating_variables.update(copy_value(changed_inputs))
+        return self.run_keeping_state(rating_variables, state, changed)
+
+    def memo_stats(self) -> List[dict]:
+        """How often each memoized step's result has been reused"""
+        stats = []
+        for rating_step, evaluate in self.layout.memos.items():
+            info = evaluate.cache_info()
+            stats.append({'step': str(rating_step), 'target': rating_step.target, 'hits': info.hits,
+                          'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize})
+        return stats
+
+    def clear_memos(self):
+        for evaluate in self.layout.memos.values():
+            evaluate.cache_clear()
+
+    def coerce_inputs(self, rating_variables: dict):
+        for sub_risk_label, typed in self.typed_rating_variables.items():
+            if sub_risk_label is None:
+                risks = [rating_variables]
+            else:
+                risks = rating_variables.get(sub_risk_label) or []
+
+            for risk in risks:
+                for name, rating_variable in typed.items():
+                    if name in risk:
+                        risk[name] = rating_variable.coerce(risk[name])
+
+    def rate(self, rate_inputs: dict, outputs: Iterable[str] = None):
+        if outputs is None:
+            return self.run(rate_inputs)['rate']
+
+        rating_variables = self.run(rate_inputs, outputs=outputs)
+        return {output: rating_variables.get(output) for output in outputs}
+
+    def rate_batch(self, columns: dict) -> dict:
+        if self.batch_plan is None:
+            from .batch import BatchPlan
+            self.batch_plan = BatchPlan(self.rating_manual.rating_steps)
+        return self.batch_plan.run(columns)
+
+
+def run_recorded(plan: List[CompiledStep], frame: list, record: list):
+    """Run a plan against a frame, recording the values written by each step, and the start of each loop and of each
+    iteration within it"""
+    for compiled_step in plan:
+        if compiled_step.sub_plan is None:
+            compiled_step.execute(frame)
+        elif compiled_step.check is None or compiled_step.check(frame):
+            sub_plan = compiled_step.sub_plan
+            record.append((LOOP, compiled_step.step))
+
+            def run_body(frame: list):
+                record.append((ITERATION,))
+                run_recorded(sub_plan, frame, record)
+            compiled_step.iterate(frame, run_body)
+
+        writes = {name: frame[slot] for name, slot in compiled_step.writes if frame[slot] is not UNSET}
+        record.append((STEP, compiled_step.step, writes))
@@ -0,0 +1,112 @@
+from time import perf_counter
+from typing import Callable, Dict
+import json
+from ..repository.rating_factor_repository import AbstractRatingFactorRepository
+
+
+class StepStats(object):
+    """How often one rating step has been reached, how often its conditions weren't met, and how long it took"""
+    __slots__ = ('calls', 'skipped', 'time', 'max_time', 'lookups', 'lookup_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.skipped = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class RatingMetrics(object):
+    """Call counts and wall times for each step of a compiled manual, and for each rating as a whole. Only a manual
+    compiled with metrics is instrumented at all, so there's no cost otherwise. Counts may be approximate where one
+    manual is rated on several threads at once."""
+
+    def __init__(self):
+        self.steps = {}  # type: Dict[object, StepStats]
+        self.ratings = 0
+        self.time = 0.0
+
+    def stats(self, rating_step) -> StepStats:
+        stats = self.steps.get(rating_step)
+        if stats is None:
+            stats = self.steps[rating_step] = StepStats()
+        return stats
+
+    def instrument_step(self, rating_step, execute: Callable, check: Callable = None) -> Callable:
+        """Wrap a compiled step (and its compiled conditions, if any) to record each time it's reached"""
+        stats = self.stats(rating_step)
+
+        def run(frame: list):
+            start = perf_counter()
+            stats.calls += 1
+            if check is not None and not check(frame):
+                stats.skipped += 1
+                stats.time += perf_counter() - start
+                return
+
+            execute(frame)
+            elapsed = perf_counter() - start
+            stats.time += elapsed
+            if elapsed > stats.max_time:
+                stats.max_time = elapsed
+        return run
+
+    def instrument_repository(self, rating_step, repository: AbstractRatingFactorRepository):
+        return TimedRatingFactorRepository(repository, self.stats(rating_step))
+
+    def record_rating(self, elapsed: float):
+        self.ratings += 1
+        self.time += elapsed
+
+    def reset(self):
+        for rating_step in self.steps:
+            self.steps[rating_step] = StepStats()
+        self.ratings = 0
+        self.time = 0.0
+
+    def to_dict(self, rating_manual=None) -> dict:
+        """Export the metrics, with each step listed by name and target"""
+        metrics = {'ratings': self.ratings, 'time': self.time, 'steps': [
+            dict(step=str(rating_step), target=getattr(rating_step, 'target', None), **stats.to_dict())
+            for rating_step, stats in self.steps.items()
+        ]}
+        if rating_manual is not None:
+            metrics = dict(manual_id=rating_manual.id, manual=rating_manual.name, version=rating_manual.version,
+                           **metrics)
+        return metrics
+
+    def to_json(self, rating_manual=None) -> str:
+        return json.dumps(self.to_dict(rating_manual))
+
+
+class TimedRatingFactorRepository(AbstractRatingFactorRepository):
+    """Times the lookups one rating step makes against a repository"""
+
+    def __init__(self, repository: AbstractRatingFactorRepository, stats: StepStats):
+        super().__init__()
+        self.repository = repository
+        self.stats = stats
+
+    def lookup(self, rating_factor_type: str, params: dict, options=None):
+        return self.timed(self.repository.lookup, rating_factor_type, params, options)
+
+    def get_factor(self, rating_factor_type: str, params: dict, options=None):
+        return self.timed(self.repository.get_factor, rating_factor_type, params, options)
+
+    def interpolate(self, rating_factor_type: str, params: dict, interpolate_column: str) -> float:
+        return self.timed(self.repository.interpolate, rating_factor_type, params, interpolate_column)
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    def timed(self, method: Callable, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.stats.lookups += 1
+            self.stats.lookup_time += perf_counter() - start
@@ -0,0 +1,175 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Set, Tuple
+import itertools
+import multiprocessing
+import os
+import threading
+import weakref
+from sqlalchemy.orm import scoped_session
+from ..repository.rating_factor_repository import AbstractRatingFactorRepository, IndexedRatingFactorRepository
+from .rating_frame import FrameLayout, SCOPE, UNSET
+from .rating_step import AbstractRatingStep, Loop, skip
+
+# the loops of each compiled manual which forked worker processes can run, by the key of the manual's registry, for
+# as long as the manual is in use
+LOOPS = weakref.WeakValueDictionary()  # type: Dict[int, LoopRegistry]
+registry_keys = itertools.count()
+
+
+class LoopRegistry(list):
+    """The compiled loops of one manual which may run in worker processes, each (iterate, run_body) at its index"""
+
+    def __init__(self):
+        super().__init__()
+        self.key = next(registry_keys)
+        LOOPS[self.key] = self
+
+    def add(self, iterate: Callable, run_body: Callable) -> Tuple[int, int]:
+        self.append((iterate, run_body))
+        return self.key, len(self) - 1
+
+
+def run_chunk(key: Tuple[int, int], frame: list, sub_risks: List[dict]) -> List[dict]:
+    """Run a registered loop over some of its sub-risks within a worker process, returning them once rated"""
+    registry_key, index = key
+    iterate, run_body = LOOPS[registry_key][index]
+    iterate(frame, run_body, sub_risks)
+    return sub_risks
+
+
+def repositories(rating_steps: List[AbstractRatingStep]) -> Iterator[AbstractRatingFactorRepository]:
+    """The rating factor repositories the given steps (and those within them) look factors up from"""
+    for rating_step in rating_steps:
+        repository = getattr(rating_step, 'rating_factor_repository', None)
+        if repository is not None:
+            yield repository
+        if isinstance(rating_step, Loop):
+            yield from repositories(rating_step.rating_steps)
+
+
+def uses_database(rating_steps: List[AbstractRatingStep]) -> bool:
+    """Whether any of the given steps (or those within them) looks factors up from a repository on a database session"""
+    return any(getattr(repository, 'db_session', None) is not None for repository in repositories(rating_steps))
+
+
+def shares_session(rating_steps: List[AbstractRatingStep]) -> bool:
+    """Whether any of the given steps (or those within them) looks factors up through a database session which can't
+    be used from several threads at once: any but a scoped session, unless the factors are indexed in memory"""
+    for repository in repositories(rating_steps):
+        db_session = getattr(repository, 'db_session', None)
+        if db_session is not None and not isinstance(db_session, scoped_session) \
+                and not isinstance(repository, IndexedRatingFactorRepository):
+            return True
+    return False
+
+
+def written_slots(plan: list) -> Set[int]:
+    slots = set()
+    for compiled_step in plan:
+        slots.update(slot for name, slot in compiled_step.writes)
+        if compiled_step.sub_plan is not None:
+            slots.update(written_slots(compiled_step.sub_plan))
+    return slots
+
+
+class ParallelLoops(object):
+    """Opt-in parallel execution of a manual's top-level loops. Once a loop has at least `min_sub_risks` sub-risks,
+    they are split into chunks which are rated on a pool of workers, and merged back in order.
+
+    Threads suit loop bodies which spend their time in lookups, given a rating factor repository which can be used
+    from several threads at once: one on a scoped session, or an IndexedRatingFactorRepository. Loops which look factors
+    up through any other session can't be run in threads at all. Processes suit CPU-bound bodies; workers are forked
+    so that they inherit the compiled manuals, which means they are only available where fork is. A forked worker
+    would share its parent's database connection, so loops which look factors up from the database can't be run in
+    processes at all.
+
+    A loop whose body changes any of its parent's variables has iterations which depend on each other, so it always
+    runs sequentially, as does any loop run while capturing step detail."""
+
+    def __init__(self, max_workers: int = None, use_processes: bool = False, min_sub_risks: int = 100,
+                 chunk_size: int = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.min_sub_risks = min_sub_risks
+        self.chunk_size = chunk_size
+        self.executor = None  # type: Executor
+        self.forked_loops = {}  # type: Dict[int, int]
+        self.lock = threading.Lock()
+
+    def get_executor(self, key: Tuple[int, int] = None) -> Executor:
+        """The pool of workers, which for processes must know the given loop"""
+        with self.lock:
+            if key is not None and self.executor is not None and key[1] >= self.forked_loops.get(key[0], 0):
+                # a loop compiled since the workers were forked is unknown to them
+                self.executor.shutdown()
+                self.executor = None
+
+            if self.executor is None:
+                if self.use_processes:
+                    self.forked_loops = {registry_key: len(loops) for registry_key, loops in LOOPS.items()}
+                    self.executor = ProcessPoolExecutor(self.max_workers, multiprocessing.get_context('fork'))
+                else:
+                    self.executor = ThreadPoolExecutor(self.max_workers)
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def compile_loop(self, compiled_step, layout: FrameLayout, loops: LoopRegistry = None) -> Callable[[list], None]:
+        """Wrap a compiled top-level loop, so that it runs on the pool when it has enough sub-risks. Loops to be run
+        in processes are added to the registry of the manual they belong to."""
+        loop = compiled_step.step
+        iterate = compiled_step.iterate
+        check = compiled_step.check
+        sub_risks = layout.reference(loop.sub_risk_label)
+        written = sorted(written_slots(compiled_step.sub_plan))
+        executors = [sub_step.execute for sub_step in compiled_step.sub_plan if sub_step.execute is not skip]
+
+        def run_body(frame: list):
+            for execute in executors:
+                execute(frame)
+
+        key = None
+        if self.use_processes:
+            if uses_database(loop.rating_steps):
+                raise Exception("Loops which look factors up from a database can't be rated in worker processes, "
+                                "which would share its connection; use threads instead")
+            key = loops.add(iterate, run_body)
+        elif shares_session(loop.rating_steps):
+            raise Exception("Loops which look factors up through a database session can't be rated in threads, which "
+                            "would share it; use a scoped session, or index the factors in memory")
+
+        def execute(frame: list):
+            if check is not None and not check(frame):
+                return
+
+            risks = sub_risks(frame)
+            if len(risks) < self.min_sub_risks or any(frame[slot] is not UNSET for slot in written):
+                iterate(frame, run_body)
+            elif key is None:
+                self.run_threads(iterate, run_body, frame, risks)
+            else:
+                self.run_processes(key, frame, risks)
+        return execute
+
+    def chunks(self, risks: List[dict]) -> List[List[dict]]:
+        size = self.chunk_size or max(1, -(-len(risks) // (self.max_workers * 4)))
+        return [risks[i:i + size] for i in range(0, len(risks), size)]
+
+    def run_threads(self, iterate, run_body, frame: list, risks: List[dict]):
+        # each chunk gets its own copy of the frame, and updates its sub-risks in place
+        executor = self.get_executor()
+        futures = [executor.submit(iterate, list(frame), run_body, chunk) for chunk in self.chunks(risks)]
+        for future in futures:
+            future.result()
+
+    def run_processes(self, key: int, frame: list, risks: List[dict]):
+        # only the names of unslotted variables matter to a loop, and its sub-risks are sent separately
+        worker_frame = [None if value is risks else value for value in frame]
+        worker_frame[SCOPE] = dict.fromkeys(frame[SCOPE])
+        executor = self.get_executor(key)
+        futures = [executor.submit(run_chunk, key, worker_frame, chunk) for chunk in self.chunks(risks)]
+        risks[:] = [sub_risk_vars for future in futures for sub_risk_vars in future.result()]
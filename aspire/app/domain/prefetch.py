@@ -0,0 +1,117 @@
+from typing import Callable, Dict, List, Tuple
+import threading
+from ..repository.rating_factor_repository import AbstractRatingFactorRepository, RatingFactorsNotFound
+from .rating_frame import FrameLayout, UNSET
+from .rating_step import AbstractRatingStep, Lookup, LinearInterpolate
+
+
+def lookup_key(rating_factor_type: str, params: dict, options: dict = None) -> tuple:
+    return rating_factor_type, tuple(sorted(params.items())), tuple(sorted((options or {}).items()))
+
+
+def reads_unset(lookup: tuple) -> bool:
+    rating_factor_type, params, options = lookup
+    return rating_factor_type is UNSET or any(value is UNSET for value in params.values())
+
+
+class PrefetchPlan(object):
+    """The lookups of a manual's top-level steps which depend on its inputs alone, i.e. which read nothing an earlier
+    step may write, so that each rating can make them all at once before any step runs: in one query for a repository
+    which batches lookups, rather than one query per step as each is reached. The steps are then served the factors
+    fetched for the rating on the calling thread, and look up any others (or any which couldn't be fetched) as before.
+
+    Lookups whose conditions aren't met by the inputs aren't fetched, nor are those of steps which remember their
+    results (given a memo size), or which look factors up from a repository which doesn't batch lookups."""
+
+    def __init__(self, rating_steps: List[AbstractRatingStep], layout: FrameLayout):
+        self.local = threading.local()
+        self.steps = {}  # type: Dict[AbstractRatingStep, Tuple[Callable, Callable]]
+        written = set()
+        for rating_step in rating_steps:
+            reads = rating_step.reads()
+            if reads is not None and reads.isdisjoint(written) and self.can_prefetch(rating_step, layout):
+                constant = rating_step.conditions.constant() if rating_step.conditions else True
+                if constant is not False:
+                    check = rating_step.conditions.compile(layout) if constant is None else None
+                    self.steps[rating_step] = (check, rating_step.compile_lookups(layout))
+            written |= rating_step.writes()
+
+    @staticmethod
+    def can_prefetch(rating_step: AbstractRatingStep, layout: FrameLayout) -> bool:
+        return isinstance(rating_step, (Lookup, LinearInterpolate)) \
+            and getattr(rating_step.rating_factor_repository, 'batches_lookups', False) \
+            and not (rating_step.memoizable and layout.memo_size)
+
+    def repository(self, rating_step: AbstractRatingStep, repository: AbstractRatingFactorRepository):
+        """The repository a step should be compiled to look its factors up from"""
+        if rating_step not in self.steps:
+            return repository
+        return PrefetchedRatingFactorRepository(repository, self.local)
+
+    def prefetch(self, frame: list, rating_steps: List[AbstractRatingStep]):
+        """Fetch the factors the given steps (those of them in the plan) will look up for a frame of inputs, for the
+        calling thread's rating"""
+        factors = {}
+        for repository, lookups in self.plan_lookups(frame, rating_steps).values():
+            try:
+                fetched = repository.get_factors_batch(lookups)
+            except RatingFactorsNotFound:
+                # each step looks its factors up for itself, failing just as it would have
+                continue
+            for lookup, factor in zip(lookups, fetched):
+                if factor is not None:
+                    factors[lookup_key(*lookup)] = factor
+        self.local.factors = factors
+
+    def plan_lookups(self, frame: list, rating_steps: List[AbstractRatingStep]) -> dict:
+        """The lookups the given steps will make for a frame of inputs, by repository. Those which read a missing
+        input are left to the step, which raises about it (if it's reached) as it always has"""
+        batches = {}
+        for rating_step in rating_steps:
+            planned = self.steps.get(rating_step)
+            if planned is None:
+                continue
+
+            check, lookups = planned
+            try:
+                if check is not None and not check(frame):
+                    continue
+                lookups = [lookup for lookup in lookups(frame) if not reads_unset(lookup)]
+            except (KeyError, TypeError, ValueError):
+                continue
+            repository = rating_step.rating_factor_repository
+            batches.setdefault(id(repository), (repository, []))[1].extend(lookups)
+        return batches
+
+    def clear(self):
+        self.local.factors = None
+
+
+class PrefetchedRatingFactorRepository(AbstractRatingFactorRepository):
+    """Serves one rating step the factors prefetched for the current rating, looking up any others from a repository"""
+
+    def __init__(self, repository: AbstractRatingFactorRepository, local: threading.local):
+        super().__init__()
+        self.repository = repository
+        self.local = local
+
+    def prefetched(self, rating_factor_type: str, params: dict, options=None):
+        factors = getattr(self.local, 'factors', None)
+        if not factors:
+            return None
+        return factors.get(lookup_key(rating_factor_type, params, options))
+
+    def lookup(self, rating_factor_type: str, params: dict, options=None):
+        factor = self.prefetched(rating_factor_type, params, options)
+        if factor is None:
+            return self.repository.lookup(rating_factor_type, params, options)
+        return factor.value
+
+    def get_factor(self, rating_factor_type: str, params: dict, options=None):
+        factor = self.prefetched(rating_factor_type, params, options)
+        if factor is None:
+            return self.repository.get_factor(rating_factor_type, params, options)
+        return factor
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
@@ -1,79 +1,111 @@
+from typing import Iterable
 from .rating_manual import RatingManual
-from .rating_step import Loop, AbstractRatingStep
-import copy
-from typing import List
+from .rating_result import RatingResult
+from .compiled_manual import CompiledManual
+from .instrumentation import RatingMetrics
+from .parallel import ParallelLoops
+from .tracing import Tracer
+from .result_cache import ResultCache
+import threading
 
 
 class Rater:
+    """Rates inputs against a compiled rating manual. Neither the rater nor the manual is modified by rating, so one
+    rater can be shared between threads; use `evaluate` to get each rating's result directly.
+
+    Given a `result_cache`, `rate` reuses the result of rating the same inputs before (see ResultCache). Results are
+    cached by the manual's id and version, so a cache should only be shared between raters of saved manuals. Given
+    `memo_size`, lookups remember their factors between ratings (see CompiledManual). Given `metrics`, each step's
+    calls and timings are recorded into it, and given a `tracer` its subscribers' hooks are called as it rates."""
     rating_manual: RatingManual = None
-    rating_variables: dict = None
-    detailed_results: list = None
+    compiled_manual: CompiledManual = None
+    result_cache: ResultCache = None
 
-    def __init__(self, rating_manual: RatingManual):
+    def __init__(self, rating_manual: RatingManual, native_types: bool = False, parallel: ParallelLoops = None,
+                 result_cache: ResultCache = None, memo_size: int = None, metrics: RatingMetrics = None,
+                 tracer: Tracer = None):
         self.rating_manual = rating_manual
-
-    def rate(self, rate_inputs, capture_details=False):
-        rating_variables = rate_inputs
-
-        if capture_details:
-            self.detailed_results = [{
-                'step': {'name': 'Initial Input'},
-                'rating_variables': copy.deepcopy(rating_variables)
-            }]
-
-        # apply each rating step sequentially to the rate inputs
-        rating_variables = self.run_steps(self.rating_manual.rating_steps, rating_variables, capture_details)
-
-        self.rating_variables = rating_variables
-        return rating_variables['rate']
-
-    def run_steps(self, rating_steps, rating_variables, capture_details):
-        for rating_step in rating_steps:
-            if isinstance(rating_step, Loop):
-                rating_variables = self.handle_rate_loop(rating_step, rating_variables, capture_details)
-            else:
-                rating_variables = copy.copy(rating_step).run(rating_variables)
-
-            if capture_details:
-                self.detailed_results.append({
-                    'step': copy.copy(rating_step),
-                    'rating_variables': copy.deepcopy(rating_variables)
-                })
-        return rating_variables
-
-    def handle_rate_loop(self, rating_step: Loop, rating_variables: dict, capture_details):
-        sub_risk_label = rating_step.sub_risk_label.evaluate(rating_variables)
-        sub_risks = rating_variables[sub_risk_label]  # type: List[dict]
-        original_rating_variables = rating_variables.keys()
-        for i, sub_risk_vars in enumerate(sub_risks):
-            rating_variables = self.run_steps(rating_step.rating_steps, {**sub_risk_vars, **rating_variables}, capture_details)
-            updated_sub_risk_vars = {k: rating_variables[k] for k in rating_variables.keys() - original_rating_variables}
-            rating_variables = {k: rating_variables[k] for k in original_rating_variables}
-            rating_variables[sub_risk_label][i] = updated_sub_risk_vars
-        return rating_variables
+        self.compiled_manual = self.compile(rating_manual, native_types, parallel, memo_size, metrics, tracer)
+        self.result_cache = result_cache
+        self.local = threading.local()
+
+    @staticmethod
+    def compile(rating_manual: RatingManual, native_types: bool = False, parallel: ParallelLoops = None,
+                memo_size: int = None, metrics: RatingMetrics = None, tracer: Tracer = None) -> CompiledManual:
+        return CompiledManual(rating_manual, native_types, parallel, memo_size, metrics, tracer)
+
+    def evaluate(self, rate_inputs: dict, capture_details=False, outputs: Iterable[str] = None,
+                 keep_state=False) -> RatingResult:
+        """Rate inputs, running only the steps needed for the given output variables when there are some. With
+        `keep_state`, the result can be passed to `rerate` later."""
+        if keep_state:
+            rating_variables, state = self.compiled_manual.run_keeping_state(rate_inputs)
+            return RatingResult(rating_variables, state=state)
+
+        if not capture_details:
+            # apply each rating step sequentially to the rate inputs
+            return RatingResult(self.compiled_manual.run(rate_inputs, outputs=outputs))
+
+        record = []
+        return RatingResult(self.compiled_manual.run(rate_inputs, record, outputs), record)
+
+    def rerate(self, previous: RatingResult, changed_inputs: dict) -> RatingResult:
+        """Rate the inputs of an earlier result (evaluated with `keep_state`) again with some of them changed, running
+        only the steps which depend on the changes, and reusing every other step's values (including lookups)"""
+        if previous.state is None:
+            raise Exception("Only results evaluated with keep_state can be re-rated")
+
+        rating_variables, state = self.compiled_manual.rerate(previous.state, changed_inputs)
+        return RatingResult(rating_variables, state=state)
+
+    def rate(self, rate_inputs, capture_details=False, outputs: Iterable[str] = None):
+        """Rate inputs, keeping the result (for the calling thread only) for `check_output` and friends. Returns the
+        rate, or a dict of the given output variables."""
+        if self.result_cache is None or capture_details:
+            result = self.evaluate(rate_inputs, capture_details, outputs)
+        else:
+            result = self.cached_evaluate(rate_inputs, outputs)
+        self.local.result = result
+        if outputs is None:
+            return result.rate
+        return {output: result.check_output(output) for output in outputs}
+
+    def cached_evaluate(self, rate_inputs: dict, outputs: Iterable[str] = None) -> RatingResult:
+        # a full rating answers any outputs, but only full ratings are cached
+        key = self.result_cache.key(self.rating_manual.id, self.rating_manual.version, rate_inputs, self.rating_manual)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self.evaluate(rate_inputs, outputs=outputs)
+            if outputs is None:
+                self.result_cache.put(key, result)
+        return result
+
+    def rate_batch(self, columns: dict) -> dict:
+        """Rate many inputs at once, given as a dict of columns (one list or numpy array of values per input variable).
+        Returns the rating variables as columns, with calculated values kept as numbers rather than strings."""
+        return self.compiled_manual.rate_batch(columns)
+
+    @property
+    def metrics(self) -> RatingMetrics:
+        return self.compiled_manual.metrics
+
+    def export_metrics(self) -> dict:
+        return self.metrics.to_dict(self.rating_manual) if self.metrics is not None else None
+
+    @property
+    def last_result(self) -> RatingResult:
+        return getattr(self.local, 'result', None)
+
+    @property
+    def rating_variables(self) -> dict:
+        return self.last_result.rating_variables if self.last_result else None
+
+    @property
+    def detailed_results(self) -> list:
+        return self.last_result.detailed_results if self.last_result else None
 
     def check_output(self, rating_variable: str):
-        if rating_variable in self.rating_variables:
-            return self.rating_variables[rating_variable]
-        return None
+        return self.last_result.check_output(rating_variable)
 
     def get_step_by_step_diff(self):
-        diffed_results = [self.detailed_results[0]]
-        for key, result in enumerate(self.detailed_results):
-            if key == 0:
-                continue
-
-            prev_vars = self.detailed_results[key - 1]['rating_variables']
-            current_vars = result['rating_variables']
-            diffed_vars = {}
-
-            for k in current_vars.keys():
-                if k not in prev_vars or prev_vars[k] != current_vars[k]:
-                    diffed_vars[k] = current_vars[k]
-
-            diffed_results.append({
-                'step': result['step'],
-                'rating_variables': diffed_vars
-            })
-
-        return diffed_results
+        return self.last_result.get_step_by_step_diff()
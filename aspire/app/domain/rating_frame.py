@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import Dict, List
+from .rating_step_parameter import RatingStepParameter, RatingStepParameterType
+
+
+class Unset(object):
+    def __repr__(self):
+        return 'UNSET'
+
+    def __reduce__(self):
+        # unpickled as the one UNSET, so frames can be sent to other processes
+        return 'UNSET'
+
+
+# marks a slot whose variable has not been set (the equivalent of a missing key in a dict of rating variables)
+UNSET = Unset()
+
+# the slot holding the variables in scope which have no slot of their own (e.g. inputs no step refers to), as a mapping
+SCOPE = 0
+
+
+class FrameLayout(object):
+    """Resolves each variable name used by a rating manual to a fixed integer slot when the manual is compiled, so that
+    rating variables can be held in a preallocated list (a frame) rather than a dict.
+
+    Given `memo_size`, steps compiled against the layout which look up rating factors remember the results for up to
+    that many distinct combinations of the values they read, each. Given `metrics`, steps compiled against the layout
+    record how often they run and how long they take, and given a `tracer` they call its hooks. Once it has a
+    `prefetch` plan, the steps it covers are compiled to look their factors up from what it fetches first. With
+    `native_types`, conditions are compiled for values held as numbers rather than strings."""
+    slots: Dict[str, int]
+    names: List[str]
+
+    def __init__(self, names: List[str] = None, memo_size: int = None, metrics=None, tracer=None,
+                 native_types: bool = False):
+        self.slots = {}
+        self.names = [None]
+        self.recorders = []
+        self.memo_size = memo_size
+        self.memos = {}
+        self.metrics = metrics
+        self.tracer = tracer
+        self.native_types = native_types
+        self.prefetch = None
+        for name in names or []:
+            self.slot(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def slot(self, name: str) -> int:
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+
+        for recorder in self.recorders:
+            recorder.add(slot)
+        return slot
+
+    @contextmanager
+    def recording(self):
+        """Collect the slots of every variable resolved while compiling, e.g. all those used within a loop"""
+        recorded = set()
+        self.recorders.append(recorded)
+        try:
+            yield recorded
+        finally:
+            self.recorders.remove(recorded)
+
+    def reference(self, rating_step_parameter: RatingStepParameter):
+        """A getter for the variable which a parameter names (such as a sub-risk label), rather than its own value"""
+        if rating_step_parameter.parameter_type == RatingStepParameterType.LITERAL:
+            return itemgetter(self.slot(rating_step_parameter.value))
+
+        name = rating_step_parameter.compile(self)
+        slots = self.slots
+        return lambda frame: frame[slots[name(frame)]]
+
+    def load(self, rating_variables: dict) -> list:
+        frame = [UNSET] * len(self.names)
+        frame[SCOPE] = rating_variables
+        slots = self.slots
+        for name, value in rating_variables.items():
+            slot = slots.get(name)
+            if slot is not None:
+                frame[slot] = value
+        return frame
+
+    def unload(self, frame: list, rating_variables: dict) -> dict:
+        """Write every variable which has been set in a frame into a dict"""
+        names = self.names
+        for slot in range(SCOPE + 1, len(frame)):
+            value = frame[slot]
+            if value is not UNSET:
+                rating_variables[names[slot]] = value
+        return rating_variables
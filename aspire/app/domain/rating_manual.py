@@ -4,13 +4,17 @@ from .rating_variable import RatingVariable
 
 
 class RatingManual(object):
+    id: int = None
+    version: int = None
     name: str
     description: str
     rating_steps: List[AbstractRatingStep] = []
     rating_variables: List[RatingVariable] = []
 
     def __init__(self, name, description, rating_steps: List[AbstractRatingStep],
-                 rating_variables: List[RatingVariable]):
+                 rating_variables: List[RatingVariable], id: int = None, version: int = None):
+        self.id = id
+        self.version = version
         self.name = name
         self.description = description
         self.rating_steps = rating_steps
@@ -0,0 +1,157 @@
+from typing import List
+from .compiled_manual import INPUT, STEP, LOOP, ITERATION, RatingState
+from .rating_variable import copy_value
+
+
+class Missing(object):
+    pass
+
+
+class Changed(object):
+    pass
+
+
+# the prior value of a variable which did not exist yet, or of a list of sub-risks which has since been changed in place
+MISSING = Missing()
+CHANGED = Changed()
+
+
+class RatingResult(object):
+    """The rating variables produced by rating one set of inputs. When step detail was captured, `record` holds only
+    the values each step wrote, and the rating variables after each step are rebuilt from it when first asked for.
+    When the rating's state was kept, the result can be re-rated with some of its inputs changed."""
+    rating_variables: dict
+    record: list
+    state: RatingState
+
+    def __init__(self, rating_variables: dict, record: list = None, state: RatingState = None):
+        self.rating_variables = rating_variables
+        self.record = record
+        self.state = state
+        self.snapshots = None
+
+    @property
+    def rate(self):
+        return self.rating_variables['rate']
+
+    @property
+    def detailed_results(self) -> List[dict]:
+        if self.snapshots is None and self.record is not None:
+            self.snapshots = [{'step': step, 'rating_variables': copy_value(view)}
+                              for step, view, changes in replay(self.record)]
+        return self.snapshots
+
+    def check_output(self, rating_variable: str):
+        if rating_variable in self.rating_variables:
+            return self.rating_variables[rating_variable]
+        return None
+
+    def get_step_by_step_diff(self):
+        """The rating variables which each step changed, or which came into scope with it (e.g. within a loop)"""
+        diffed_results = []
+        for step, view, changes in replay(self.record):
+            if changes is None:
+                diffed_results.append({'step': step, 'rating_variables': copy_value(view)})
+                continue
+
+            names = changes if len(changes) < 2 else [name for name in view if name in changes]
+            diffed_vars = {}
+            for name in names:
+                if name not in view:
+                    continue
+                previous = changes[name]
+                if previous is MISSING or previous is CHANGED or previous != view[name]:
+                    diffed_vars[name] = copy_value(view[name])
+
+            diffed_results.append({'step': step, 'rating_variables': diffed_vars})
+        return diffed_results
+
+
+def replay(record: list):
+    """Rebuild the rating variables in scope after each step from a record of what each step wrote. Yields each step
+    with a live view of those variables, and the value (as of the previous step) of each one which may have changed."""
+    replayed = Replay()
+    for entry in record:
+        kind = entry[0]
+        if kind == INPUT:
+            replayed.start(copy_value(entry[1]))
+            yield {'name': 'Initial Input'}, replayed.view, None
+        elif kind == STEP:
+            changes = replayed.step(entry[1], entry[2])
+            yield entry[1], replayed.view, changes
+        elif kind == LOOP:
+            replayed.start_loop(entry[1])
+        elif kind == ITERATION:
+            replayed.next_iteration()
+
+
+class Replay(object):
+    """Applies recorded writes to dicts of rating variables, scoping loops just as rating steps run on dicts do, while
+    tracking which variables have changed since the last step was shown"""
+
+    def __init__(self):
+        self.view = {}
+        self.shown = {}
+        self.changes = {}
+        self.loops = []
+
+    def start(self, rating_variables: dict):
+        self.view = self.shown = rating_variables
+
+    def remember(self, name: str):
+        if name not in self.changes:
+            self.changes[name] = self.shown.get(name, MISSING)
+
+    def write(self, rating_variables: dict, name: str, value):
+        if rating_variables is self.view or rating_variables is self.shown:
+            self.remember(name)
+        rating_variables[name] = value
+
+    def switch(self, view: dict):
+        for name in view:
+            self.remember(name)
+        self.view = view
+
+    def step(self, rating_step, writes: dict) -> dict:
+        if self.loops and self.loops[-1][0] is rating_step:
+            self.end_loop()
+
+        for name, value in writes.items():
+            self.write(self.view, name, value)
+
+        changes = self.changes
+        self.changes = {}
+        self.shown = self.view
+        return changes
+
+    def start_loop(self, rating_step):
+        sub_risk_label = rating_step.sub_risk_label.evaluate(self.view)
+        # the loop replaces sub-risks in a copy of the list, leaving any list shown earlier as it was
+        self.write(self.view, sub_risk_label, list(self.view[sub_risk_label]))
+        self.loops.append([rating_step, self.view, sub_risk_label, -1])
+
+    def next_iteration(self):
+        loop = self.loops[-1]
+        if loop[3] >= 0:
+            self.end_iteration(loop)
+        loop[3] += 1
+        parent, sub_risk_label, i = loop[1:]
+        self.switch({**parent[sub_risk_label][i], **parent})
+
+    def end_iteration(self, loop: list):
+        parent, sub_risk_label, i = loop[1:]
+        scope = self.view
+        for name in parent.keys():
+            self.write(parent, name, scope[name])
+
+        sub_risks = parent[sub_risk_label]
+        sub_risk = {name: value for name, value in scope.items() if name not in parent}
+        if sub_risk != sub_risks[i]:
+            self.changes[sub_risk_label] = CHANGED
+        sub_risks[i] = sub_risk
+
+    def end_loop(self):
+        loop = self.loops.pop()
+        if loop[3] >= 0:
+            self.end_iteration(loop)
+        self.switch(loop[1])
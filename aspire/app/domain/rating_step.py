@@ -1,10 +1,14 @@
 from abc import ABC, abstractmethod
+from collections import ChainMap
 from enum import IntEnum
 from typing import List
 from ..repository.rating_factor_repository import AbstractRatingFactorRepository
-from .rating_step_parameter import RatingStepParameter
+from .rating_step_parameter import RatingStepParameter, RatingStepParameterType
 from functools import reduce
 from .rating_step_condition import AbstractRatingStepCondition
+from .rating_variable import convert_to_number
+from .rating_frame import FrameLayout, SCOPE, UNSET
+from functools import lru_cache
 import operator
 
 
@@ -27,6 +31,8 @@ class AbstractRatingStep(ABC):
     description: str = None
     conditions: AbstractRatingStepCondition
     target: str
+    # whether the step's result is worth remembering for the values it reads (see FrameLayout)
+    memoizable = False
 
     def __init__(self):
         pass
@@ -40,6 +46,53 @@ class AbstractRatingStep(ABC):
     def apply(self, rating_variables: dict):
         pass
 
+    def compile(self, layout: FrameLayout, native_types: bool = False):
+        """Bind this step (and its conditions) into a single callable which updates a frame of rating variables in
+        place. With `native_types`, calculated values are stored as numbers instead of being formatted as strings."""
+        execute = self.compile_apply(layout, native_types)
+        if self.memoizable and layout.memo_size:
+            execute = memoize(self, execute, layout)
+
+        check = None
+        if self.conditions:
+            # a condition on literals alone is decided here, once
+            constant = self.conditions.constant()
+            if constant is False:
+                return skip
+            if constant is None:
+                check = self.conditions.compile(layout)
+
+        if layout.tracer is not None:
+            execute = layout.tracer.trace_step(self, execute)
+        if layout.metrics is not None:
+            return layout.metrics.instrument_step(self, execute, check)
+        if check is None:
+            return execute
+
+        def run_if(frame: list):
+            if check(frame):
+                execute(frame)
+        return run_if
+
+    @abstractmethod
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        pass
+
+    def parameters(self) -> List[RatingStepParameter]:
+        return []
+
+    def reads(self):
+        """The names of the rating variables this step reads (including in its conditions), or None where they can't
+        be known before rating"""
+        names = set().union(*(parameter.reads() for parameter in self.parameters()))
+        if self.conditions:
+            names |= self.conditions.reads()
+        return names
+
+    def writes(self) -> set:
+        """The names of the rating variables this step may write"""
+        return {self.target}
+
     def label(self, name: str = None, description: str = None):
         self.name = name
         self.description = description
@@ -65,6 +118,9 @@ class BaseArithmeticRatingStep(AbstractRatingStep):
     def evaluate_operands(self, rating_variables: dict):
         return map(lambda operand: float(operand.evaluate(rating_variables)), self.operands)
 
+    def parameters(self) -> List[RatingStepParameter]:
+        return self.operands
+
     def apply(self, rating_variables: dict):
         operands = self.evaluate_operands(rating_variables)
         result = reduce(self.operation, operands)
@@ -72,6 +128,37 @@ class BaseArithmeticRatingStep(AbstractRatingStep):
         rating_variables[self.target] = str(result)
         return rating_variables
 
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        operation = self.operation
+        target = layout.slot(self.target)
+
+        numbers = [operand.literal_number() for operand in self.operands]
+        if None not in numbers:
+            try:
+                result = reduce(operation, numbers)
+            except ArithmeticError:
+                pass  # e.g. dividing by zero, which fails when rated, just as it always has
+            else:
+                return assign(target, result if native_types else str(result))
+
+        if len(self.operands) == 2 and numbers[1] is not None:
+            # the most common case: a variable and a literal factor
+            value, number = self.operands[0].compile_number(layout), numbers[1]
+
+            def apply(frame: list):
+                result = operation(value(frame), number)
+                frame[target] = result if native_types else str(result)
+            return apply
+
+        first, *rest = [operand.compile_number(layout) for operand in self.operands]
+
+        def apply(frame: list):
+            result = first(frame)
+            for operand in rest:
+                result = operation(result, operand(frame))
+            frame[target] = result if native_types else str(result)
+        return apply
+
 
 class Add(BaseArithmeticRatingStep):
     operation = operator.add
@@ -96,11 +183,31 @@ class Set(AbstractRatingStep):
         self.value = parameters[0]
         self.conditions = conditions
 
+    def parameters(self) -> List[RatingStepParameter]:
+        return [self.value]
+
     def apply(self, rating_variables: dict):
         value = self.value.evaluate(rating_variables)
         rating_variables[self.target] = str(value)
         return rating_variables
 
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        target = layout.slot(self.target)
+        value = self.value.compile(layout)
+
+        if self.value.parameter_type == RatingStepParameterType.LITERAL:
+            literal = self.value.value
+            return assign(target, convert_to_number(literal) if native_types else str(literal))
+
+        if native_types:
+            def apply(frame: list):
+                frame[target] = value(frame)
+            return apply
+
+        def apply(frame: list):
+            frame[target] = str(value(frame))
+        return apply
+
 
 class Round(AbstractRatingStep):
     def __init__(self, target: str, parameters: List[RatingStepParameter], conditions: AbstractRatingStepCondition = None):
@@ -110,14 +217,45 @@ class Round(AbstractRatingStep):
         self.places = parameters[1]
         self.conditions = conditions
 
+    def parameters(self) -> List[RatingStepParameter]:
+        return [self.value, self.places]
+
     def apply(self, rating_variables: dict):
         decimal_places = int(self.places.evaluate(rating_variables))
         value_to_round = float(self.value.evaluate(rating_variables))
         rating_variables[self.target] = str(round(value_to_round, decimal_places))
         return rating_variables
 
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        target = layout.slot(self.target)
+        value = self.value.compile_number(layout)
+        places = self.places.compile(layout)
+
+        if self.places.parameter_type == RatingStepParameterType.LITERAL:
+            try:
+                decimal_places = int(self.places.value)
+            except (TypeError, ValueError):
+                pass  # fails when rated, just as it always has
+            else:
+                number = self.value.literal_number()
+                if number is not None:
+                    result = round(number, decimal_places)
+                    return assign(target, result if native_types else str(result))
+
+                def apply(frame: list):
+                    result = round(value(frame), decimal_places)
+                    frame[target] = result if native_types else str(result)
+                return apply
+
+        def apply(frame: list):
+            result = round(value(frame), int(places(frame)))
+            frame[target] = result if native_types else str(result)
+        return apply
+
 
 class Lookup(AbstractRatingStep):
+    memoizable = True
+
     def __init__(self, target: str, parameters: List[RatingStepParameter],
                  rating_factor_repository: AbstractRatingFactorRepository,
                  conditions: AbstractRatingStepCondition = None):
@@ -127,21 +265,52 @@ class Lookup(AbstractRatingStep):
         self.rating_factor_repository = rating_factor_repository
         self.conditions = conditions
 
-    def apply(self, rating_variables: dict):
-        rating_factor_type = self.inputs.pop(0)
-        rating_factor_type = rating_factor_type.evaluate(rating_variables)
+    def parameters(self) -> List[RatingStepParameter]:
+        return self.inputs
 
-        options = None
-        if self.inputs[0].label == 'options':
-            options = self.parse_options(self.inputs.pop(0).value)
+    def apply(self, rating_variables: dict):
+        rating_factor_type = self.inputs[0].evaluate(rating_variables)
+        options, inputs = self.parse_inputs()
 
         evaluated_inputs = {}
-        for rating_step_parameter in self.inputs:
+        for rating_step_parameter in inputs:
             evaluated_inputs[rating_step_parameter.label] = rating_step_parameter.evaluate(rating_variables)
 
         rating_variables[self.target] = self.rating_factor_repository.lookup(rating_factor_type, evaluated_inputs, options)
         return rating_variables
 
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        target = layout.slot(self.target)
+        lookup = compile_repository(self, layout).lookup
+        rating_factor_type = self.inputs[0].compile(layout)
+        options, inputs = self.parse_inputs()
+        inputs = [(rating_step_parameter.label, rating_step_parameter.compile(layout)) for rating_step_parameter in inputs]
+
+        def apply(frame: list):
+            evaluated_inputs = {label: evaluate(frame) for label, evaluate in inputs}
+            result = lookup(rating_factor_type(frame), evaluated_inputs, options)
+            frame[target] = convert_to_number(result) if native_types else result
+        return apply
+
+    def compile_lookups(self, layout: FrameLayout):
+        """Bind the lookup this step makes into a callable giving its (type, params, options) for a frame"""
+        rating_factor_type = self.inputs[0].compile(layout)
+        options, inputs = self.parse_inputs()
+        inputs = [(rating_step_parameter.label, rating_step_parameter.compile(layout)) for rating_step_parameter in inputs]
+
+        def lookups(frame: list) -> list:
+            return [(rating_factor_type(frame), {label: evaluate(frame) for label, evaluate in inputs}, options)]
+        return lookups
+
+    def parse_inputs(self):
+        """Get the lookup options (if any), and the parameters to look up factors by"""
+        inputs = self.inputs[1:]
+        options = None
+        if inputs and inputs[0].label == 'options':
+            options = self.parse_options(inputs[0].value)
+            inputs = inputs[1:]
+        return options, inputs
+
     def parse_options(self, options: str):
         parsed = options.split(',')
         options = {}
@@ -152,6 +321,8 @@ class Lookup(AbstractRatingStep):
 
 
 class LinearInterpolate(AbstractRatingStep):
+    memoizable = True
+
     def __init__(self, target: str, parameters: List[RatingStepParameter],
                  rating_factor_repository: AbstractRatingFactorRepository,
                  conditions: AbstractRatingStepCondition = None):
@@ -161,61 +332,65 @@ class LinearInterpolate(AbstractRatingStep):
         self.conditions = conditions
         super().__init__()
 
+    def parameters(self) -> List[RatingStepParameter]:
+        return self.params
+
     def apply(self, rating_variables: dict):
-        rating_factor_type = self.params[0]
-        rating_factor_type = rating_factor_type.evaluate(rating_variables)
+        params, interpolate_column = self.parse_params()
+        if interpolate_column is None:
+            raise Exception("Missing input for interpolation")
 
-        options = None
-        params_index = 1
-        if self.params[1].label == 'options':
-            options = self.parse_options(self.params[1].value)
-            params_index = 2
+        evaluated_params = {p.label: p.evaluate(rating_variables) for p in params}
+        rating_variables[self.target] = str(self.rating_factor_repository.interpolate(
+            self.params[0].evaluate(rating_variables), evaluated_params, interpolate_column
+        ))
+        return rating_variables
 
-        interpolate_variable = options['interpolate']
-        interpolate_column = None
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        target = layout.slot(self.target)
+        rating_factor_type = self.params[0].compile(layout)
+        params, interpolate_column = self.parse_params()
+        params = [(rating_step_parameter.label, rating_step_parameter.compile(layout)) for rating_step_parameter in params]
+        interpolate = compile_repository(self, layout).interpolate
+
+        def apply(frame: list):
+            if interpolate_column is None:
+                raise Exception("Missing input for interpolation")
+
+            evaluated_params = {label: evaluate(frame) for label, evaluate in params}
+            result = interpolate(rating_factor_type(frame), evaluated_params, interpolate_column)
+            frame[target] = result if native_types else str(result)
+        return apply
+
+    def compile_lookups(self, layout: FrameLayout):
+        """Bind the lookups this step makes (those of the factors either side) into a callable giving their (type,
+        params, options) for a frame"""
+        rating_factor_type = self.params[0].compile(layout)
+        params, interpolate_column = self.parse_params()
+        params = [(rating_step_parameter.label, rating_step_parameter.compile(layout)) for rating_step_parameter in params]
+
+        def lookups(frame: list) -> list:
+            if interpolate_column is None:
+                return []
+            evaluated_type = rating_factor_type(frame)
+            evaluated_params = {label: evaluate(frame) for label, evaluate in params}
+            return [(evaluated_type, evaluated_params, {"step_down": interpolate_column}),
+                    (evaluated_type, evaluated_params, {"step_up": interpolate_column})]
+        return lookups
+
+    def parse_params(self):
+        """Get the parameters to look up factors by, and the label of the one to interpolate on (if any)"""
+        params = self.params[1:]
+        interpolate_variable = None
+        if params and params[0].label == 'options':
+            interpolate_variable = self.parse_options(params[0].value).get('interpolate')
+            params = params[1:]
 
-        evaluated_params = {}
-        x = None
-        for rating_step_parameter in self.params[params_index:]:
-            param = rating_step_parameter.evaluate(rating_variables)
-            evaluated_params[rating_step_parameter.label] = param
+        interpolate_column = None
+        for rating_step_parameter in params:
             if rating_step_parameter.value == interpolate_variable:
-                x = param
                 interpolate_column = rating_step_parameter.label
-
-        if x is None:
-            raise Exception("Missing input for interpolation")
-
-        lower = self.rating_factor_repository.get_factor(
-            rating_factor_type,
-            evaluated_params.copy(),
-            {"step_down": interpolate_column}
-        )
-        if lower is None:
-            raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
-        upper = self.rating_factor_repository.get_factor(
-            rating_factor_type,
-            evaluated_params.copy(),
-            {"step_up": interpolate_column}
-        )
-        if upper is None:
-            raise Exception("Interpolation Lookup failed to find upper value for %s!" % rating_factor_type)
-
-        x = float(x)
-        x0 = float(getattr(lower, interpolate_column))
-        x1 = float(getattr(upper, interpolate_column))
-        y0 = float(lower.value)
-        y1 = float(upper.value)
-
-        if x == x0:
-            y = y0
-        elif x == x1:
-            y = y1
-        else:
-            y = y0 + ((y1 - y0) / (x1 - x0) * (x - x0))
-
-        rating_variables[self.target] = str(y)
-        return rating_variables
+        return params, interpolate_column
 
     def parse_options(self, options: str):
         parsed = options.split(',')
@@ -226,6 +401,95 @@ class LinearInterpolate(AbstractRatingStep):
         return options
 
 
+def compile_repository(rating_step: AbstractRatingStep, layout: FrameLayout) -> AbstractRatingFactorRepository:
+    """The rating factor repository a compiled step should look factors up from"""
+    repository = rating_step.rating_factor_repository
+    if layout.prefetch is not None:
+        repository = layout.prefetch.repository(rating_step, repository)
+    if layout.tracer is not None:
+        repository = layout.tracer.trace_repository(rating_step, repository)
+    if layout.metrics is not None:
+        repository = layout.metrics.instrument_repository(rating_step, repository)
+    return repository
+
+
+def memoize(rating_step: AbstractRatingStep, execute, layout: FrameLayout):
+    """Wrap a compiled step so that it runs once per distinct combination of the values its parameters read (up to the
+    layout's memo size, least recently used first out), reusing its result otherwise"""
+    target = layout.slot(rating_step.target)
+    slots = sorted({layout.slot(name) for parameter in rating_step.parameters() for name in parameter.reads()})
+
+    @lru_cache(maxsize=layout.memo_size)
+    def evaluate(key: tuple):
+        frame = [UNSET] * len(layout)
+        for slot, value in zip(slots, key):
+            frame[slot] = value
+        execute(frame)
+        return frame[target]
+    # a step compiled more than once (e.g. within a loop) shares the one memo
+    evaluate = layout.memos.setdefault(rating_step, evaluate)
+
+    def apply(frame: list):
+        key = tuple([frame[slot] for slot in slots])
+        try:
+            hash(key)
+        except TypeError:
+            return execute(frame)
+        frame[target] = evaluate(key)
+    return apply
+
+
+def skip(frame: list):
+    """A compiled step whose conditions can never be met"""
+    pass
+
+
+def assign(target: int, value):
+    """A compiled step which always sets its target to the same value, e.g. one whose parameters are all literals"""
+    def apply(frame: list):
+        frame[target] = value
+    return apply
+
+
+def referenced_names(rating_step_parameter: RatingStepParameter):
+    """The name of the variable which a parameter refers to by name (such as a sub-risk label), where it is a literal"""
+    if rating_step_parameter.parameter_type == RatingStepParameterType.LITERAL:
+        return {rating_step_parameter.value}
+    return None
+
+
+def load_sub_risk(frame: list, sub_risk_vars: dict, slots: dict, local: set, parent_scope) -> list:
+    """Load a sub-risk's variables into the frame of its loop, dropping those its parent's variables shadow. Returns
+    the slots loaded which the loop doesn't write (and so which aren't cleared with those it does)."""
+    loaded = []
+    shadowed = []
+    for name, value in sub_risk_vars.items():
+        slot = slots.get(name)
+        if slot is None:
+            if name in parent_scope:
+                shadowed.append(name)
+        elif frame[slot] is UNSET:
+            frame[slot] = value
+            if slot not in local:
+                loaded.append(slot)
+        else:
+            shadowed.append(name)
+    for name in shadowed:
+        del sub_risk_vars[name]
+    return loaded
+
+
+def unload_sub_risk(frame: list, sub_risk_vars: dict, local_slots: list, loaded: list, names: list):
+    """Write the variables of a sub-risk back to it from the frame of its loop, and clear them from the frame"""
+    for slot in local_slots:
+        value = frame[slot]
+        if value is not UNSET:
+            sub_risk_vars[names[slot]] = value
+            frame[slot] = UNSET
+    for slot in loaded:
+        frame[slot] = UNSET
+
+
 class Loop(AbstractRatingStep):
     def __init__(self, parameters: List[RatingStepParameter], rating_steps: List[AbstractRatingStep], conditions: AbstractRatingStepCondition = None):
         super().__init__()
@@ -233,8 +497,86 @@ class Loop(AbstractRatingStep):
         self.rating_steps = rating_steps
         self.conditions = conditions
 
+    def reads(self):
+        body_reads = [rating_step.reads() for rating_step in self.rating_steps]
+        sub_risk_labels = referenced_names(self.sub_risk_label)
+        if sub_risk_labels is None or None in body_reads:
+            return None
+
+        names = sub_risk_labels.union(*body_reads)
+        if self.conditions:
+            names |= self.conditions.reads()
+        return names
+
+    def writes(self) -> set:
+        # sub-risks are updated in place, which writes to their list as a whole
+        return (referenced_names(self.sub_risk_label) or set()).union(
+            *(rating_step.writes() for rating_step in self.rating_steps)
+        )
+
     def apply(self, rating_variables: dict):
-        pass
+        def run_body(scope: dict):
+            for rating_step in self.rating_steps:
+                rating_step.run(scope)
+
+        self.run_sub_risks(rating_variables, run_body)
+        return rating_variables
+
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        iterate, body = self.compile_iteration(layout, native_types)
+
+        def run_body(frame: list):
+            for execute in body:
+                execute(frame)
+
+        return lambda frame: iterate(frame, run_body)
+
+    def compile_iteration(self, layout: FrameLayout, native_types: bool = False):
+        """Compile the loop body, and a function which runs a body once per sub-risk within a frame (or once for each of
+        the given sub-risks, which may be just some of them).
+
+        The frame is layered rather than copied: the body reads the parent's variables straight from the frame, while
+        any variable used in the loop which is not already set when it starts belongs to the sub-risks. Those are
+        loaded from each sub-risk into the frame before the body runs, then written back to the sub-risk's own dict
+        (and cleared from the frame) afterwards. Loops nested in the body see this sub-risk's variables as their
+        parent's."""
+        sub_risks = layout.reference(self.sub_risk_label)
+        with layout.recording() as loop_slots:
+            body = [rating_step.compile(layout, native_types) for rating_step in self.rating_steps]
+        body = [execute for execute in body if execute is not skip]
+        loop_slots = sorted(loop_slots)
+        nested = any(isinstance(rating_step, Loop) for rating_step in self.rating_steps)
+        slots = layout.slots
+        names = layout.names
+        tracer = layout.tracer
+
+        def iterate(frame: list, run_body, risks: List[dict] = None):
+            if tracer is not None:
+                run_body = tracer.trace_iterations(self, run_body)
+            local_slots = [slot for slot in loop_slots if frame[slot] is UNSET]
+            local = set(local_slots)
+            parent_scope = frame[SCOPE]
+            for sub_risk_vars in sub_risks(frame) if risks is None else risks:
+                loaded = load_sub_risk(frame, sub_risk_vars, slots, local, parent_scope)
+                if nested:
+                    frame[SCOPE] = ChainMap(sub_risk_vars, parent_scope)
+                run_body(frame)
+                unload_sub_risk(frame, sub_risk_vars, local_slots, loaded, names)
+            frame[SCOPE] = parent_scope
+
+        return iterate, body
+
+    def run_sub_risks(self, rating_variables: dict, run_body):
+        """Run the loop body once per sub-risk. Each iteration sees the sub-risk's variables merged beneath the
+        parent's; new variables are written back to the sub-risk and changes to existing ones to the parent."""
+        sub_risk_label = self.sub_risk_label.evaluate(rating_variables)
+        sub_risks = rating_variables[sub_risk_label]  # type: List[dict]
+        for i, sub_risk_vars in enumerate(sub_risks):
+            scope = {**sub_risk_vars, **rating_variables}
+            run_body(scope)
+            for k in rating_variables.keys():
+                rating_variables[k] = scope[k]
+            sub_risks[i] = {k: v for k, v in scope.items() if k not in rating_variables}
 
 
 class AbstractSubRiskReduce(AbstractRatingStep):
@@ -247,6 +589,16 @@ class AbstractSubRiskReduce(AbstractRatingStep):
         self.sub_risk_variable = parameters[1]
         self.conditions = conditions
 
+    def reads(self):
+        sub_risk_labels = referenced_names(self.sub_risk_label)
+        if sub_risk_labels is None:
+            return None
+
+        names = sub_risk_labels | self.sub_risk_variable.reads()
+        if self.conditions:
+            names |= self.conditions.reads()
+        return names
+
     def apply(self, rating_variables: dict):
         sub_risk_label = self.sub_risk_label.evaluate(rating_variables)
         sub_risk_variable = self.sub_risk_variable.evaluate(rating_variables)
@@ -256,6 +608,18 @@ class AbstractSubRiskReduce(AbstractRatingStep):
         rating_variables[self.target] = reduce(self.operation, operands)
         return rating_variables
 
+    def compile_apply(self, layout: FrameLayout, native_types: bool = False):
+        operation = self.operation
+        target = layout.slot(self.target)
+        sub_risks = layout.reference(self.sub_risk_label)
+        sub_risk_variable = self.sub_risk_variable.compile(layout)
+
+        def apply(frame: list):
+            name = sub_risk_variable(frame)
+            operands = [float(sub_risk[name]) for sub_risk in sub_risks(frame)]
+            frame[target] = reduce(operation, operands)
+        return apply
+
 
 class SubRiskSum(AbstractSubRiskReduce):
     operation = operator.add
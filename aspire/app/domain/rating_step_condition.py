@@ -1,27 +1,97 @@
-from typing import List
+from typing import List, Set
 from functools import reduce
 from abc import ABC, abstractmethod
-from .rating_step_parameter import RatingStepParameter
+from .rating_step_parameter import RatingStepParameter, RatingStepParameterType
+from .rating_variable import convert_to_number
+import operator
+
+NUMERIC_COMPARISONS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+EQUALITY_COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+}
 
 
 class AbstractRatingStepCondition(ABC):
     operator: str
+    compiled = None
 
     def __init__(self, operator: str, operands: List[__name__] = None):
         self.operator = operator
         self.operands = operands
 
-    @abstractmethod
     def check(self, rating_variables):
+        # compiled against a dict of rating variables when first checked
+        if self.compiled is None:
+            self.compiled = self.compile(None)
+        return self.compiled(rating_variables)
+
+    @abstractmethod
+    def compile(self, layout):
+        """Bind this condition into a predicate over a frame of rating variables (or, without a layout, a dict). The
+        operator is chosen once, here, and logical operations stop at the first operand which decides them."""
+        pass
+
+    def reads(self) -> Set[str]:
+        """The names of the rating variables this condition reads"""
+        return set().union(*(operand.reads() for operand in (self.operands or [])))
+
+    @abstractmethod
+    def constant(self):
+        """The result of this condition where it doesn't depend on any rating variable, otherwise None"""
         pass
 
 
 class ComparisonOperation(AbstractRatingStepCondition):
     operands: List[RatingStepParameter]
 
-    def check(self, rating_variables):
-        operands = list(map(lambda operand: operand.evaluate(rating_variables), self.operands))
-
+    def compile(self, layout):
+        operands = self.operands or []
+        if self.operator in NUMERIC_COMPARISONS and len(operands) == 2:
+            compare = NUMERIC_COMPARISONS[self.operator]
+            left, right = operands
+            if right.literal_number() is not None and left.parameter_type == RatingStepParameterType.VARIABLE:
+                get, number = left.compile(layout), right.literal_number()
+                return lambda frame: compare(float(get(frame)), number)
+
+            left, right = left.compile_number(layout), right.compile_number(layout)
+            return lambda frame: compare(left(frame), right(frame))
+
+        if self.operator in EQUALITY_COMPARISONS and len(operands) == 2:
+            left, right = [operand.compile(layout) for operand in operands]
+            if layout is not None and layout.native_types:
+                # literals are strings, where the variables they're compared with may be held as numbers
+                if self.operator == '==':
+                    return lambda frame: equal_values(left(frame), right(frame))
+                return lambda frame: not equal_values(left(frame), right(frame))
+
+            compare = EQUALITY_COMPARISONS[self.operator]
+            return lambda frame: compare(left(frame), right(frame))
+
+        if self.operator == 'BETWEEN' and len(operands) == 3:
+            value, lower, upper = [operand.compile_number(layout) for operand in operands]
+            return lambda frame: lower(frame) <= value(frame) <= upper(frame)
+
+        compare = self.compare
+        operands = [operand.compile(layout) for operand in operands]
+        return lambda frame: compare([operand(frame) for operand in operands])
+
+    def constant(self):
+        operands = self.operands or []
+        if any(operand.parameter_type != RatingStepParameterType.LITERAL for operand in operands):
+            return None
+        try:
+            return self.compare([operand.value for operand in operands])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def compare(self, operands: list):
         if self.operator == '<':
             return float(operands[0]) < float(operands[1])
         if self.operator == '<=':
@@ -50,12 +120,74 @@ class ComparisonOperation(AbstractRatingStepCondition):
         return '(' + padded.join(str(o) for o in self.operands) + ')'
 
 
+def equal_values(left, right) -> bool:
+    """Whether two values are equal, comparing a number with a string as numbers"""
+    if isinstance(left, str) != isinstance(right, str):
+        return convert_to_number(left) == convert_to_number(right)
+    return left == right
+
+
+def compile_all(operands: list):
+    """A predicate which checks each operand in turn, stopping at the first which isn't met"""
+    def check_all(frame):
+        for operand in operands:
+            result = operand(frame)
+            if not result:
+                return result
+        return result
+    return check_all
+
+
+def compile_any(operands: list):
+    """A predicate which checks each operand in turn, stopping at the first which is met"""
+    def check_any(frame):
+        for operand in operands:
+            result = operand(frame)
+            if result:
+                return result
+        return result
+    return check_any
+
+
 class LogicalOperation(AbstractRatingStepCondition):
     operands: List[AbstractRatingStepCondition]
 
-    def check(self, rating_variables):
-        results = list(map(lambda operation: operation.check(rating_variables), self.operands))
-
+    def compile(self, layout):
+        operands = [operand.compile(layout) for operand in (self.operands or [])]
+        if self.operator == 'NOT' and operands:
+            operand = operands[0]
+            return lambda frame: not operand(frame)
+
+        if self.operator in ('AND', 'OR') and len(operands) == 2:
+            first, second = operands
+            if self.operator == 'AND':
+                return lambda frame: first(frame) and second(frame)
+            return lambda frame: first(frame) or second(frame)
+
+        if self.operator == 'AND' and operands:
+            return compile_all(operands)
+
+        if self.operator == 'OR' and operands:
+            return compile_any(operands)
+
+        combine = self.combine
+        return lambda frame: combine([operand(frame) for operand in operands])
+
+    def constant(self):
+        results = [operand.constant() for operand in (self.operands or [])]
+        # one constant operand can decide the whole, whatever the others turn out to be
+        if self.operator == 'AND' and False in results:
+            return False
+        if self.operator == 'OR' and True in results:
+            return True
+        if None in results:
+            return None
+        try:
+            return self.combine(results)
+        except (TypeError, IndexError):
+            return None
+
+    def combine(self, results: list):
         if self.operator == 'AND':
             return reduce(lambda result1, result2: result1 and result2, results)
         if self.operator == 'OR':
@@ -1,4 +1,6 @@
 from enum import IntEnum
+from operator import itemgetter
+from typing import Set
 
 
 class RatingStepParameterType(IntEnum):
@@ -18,5 +20,41 @@ class RatingStepParameter:
         if self.parameter_type == RatingStepParameterType.LITERAL:
             return self.value
 
+    def compile(self, layout=None):
+        """A getter for this parameter's value, from a dict of rating variables or (given its layout) a frame"""
+        if self.parameter_type == RatingStepParameterType.VARIABLE:
+            return itemgetter(self.value if layout is None else layout.slot(self.value))
+
+        value = self.value
+        return lambda rating_variables: value
+
+    def compile_number(self, layout=None):
+        """A getter for this parameter's value as a float. A literal is converted once, here, rather than each time"""
+        if self.parameter_type == RatingStepParameterType.VARIABLE:
+            get = self.compile(layout)
+            return lambda rating_variables: float(get(rating_variables))
+
+        number = self.literal_number()
+        if number is None:
+            value = self.value
+            # fails when evaluated, just as it always has
+            return lambda rating_variables: float(value)
+        return lambda rating_variables: number
+
+    def literal_number(self):
+        """This parameter's value as a float where it is a literal number, otherwise None"""
+        if self.parameter_type != RatingStepParameterType.LITERAL:
+            return None
+        try:
+            return float(self.value)
+        except (TypeError, ValueError):
+            return None
+
+    def reads(self) -> Set[str]:
+        """The names of the rating variables this parameter reads"""
+        if self.parameter_type == RatingStepParameterType.VARIABLE:
+            return {self.value}
+        return set()
+
     def __str__(self):
         return self.label
@@ -18,6 +18,10 @@ class RatingVariable(object):
         self.is_input = is_input
         self.is_required = is_required
 
+    def coerce(self, value):
+        """Convert an input value to this variable's native type"""
+        return value
+
     def __str__(self):
         return self.name + ' (' + self.description + ')'
 
@@ -54,6 +58,12 @@ class DecimalRatingVariable(RatingVariable):
         self.min, self.max = map(convert_to_float, constraints.split(','))
         self.precision, self.scale = map(convert_to_int, length.split(','))
 
+    def coerce(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
 
 class IntegerRatingVariable(RatingVariable):
     min: int
@@ -66,6 +76,12 @@ class IntegerRatingVariable(RatingVariable):
         self.default = convert_to_int(default)
         self.min, self.max = map(convert_to_int, constraints.split(','))
 
+    def coerce(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
 
 class BoolRatingVariable(RatingVariable):
 
@@ -85,3 +101,23 @@ def convert_to_float(value):
     if value is not None and value != '':
         return float(value)
     return None
+
+
+def convert_to_number(value):
+    """Convert a value to a float where it holds a number, leaving any other value as it is"""
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def copy_value(value):
+    """Copy a rating variable's value, including any sub-risks (a list of dicts) it holds. Only the lists and dicts
+    are copied, the values within them never being changed in place."""
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    return value
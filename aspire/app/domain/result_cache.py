@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable
+import threading
+from .rating_manual import RatingManual
+from .rating_result import RatingResult
+from .rating_variable import copy_value
+
+
+def canonical_value(value) -> Hashable:
+    """A hashable equivalent of an input value, in which sub-risks (dicts) compare the same whatever their key order"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical_value(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(canonical_value(item) for item in value)
+    return value
+
+
+class ResultCache(object):
+    """A size-bounded, least-recently-used cache of rating results, keyed by a manual's id and version along with the
+    inputs it declares (`is_input` variables) as they were given. Other values in the inputs are ignored, unless the
+    manual declares none at all. Entries for a manual are dropped once a newer version of it is seen, as it is once the
+    manual or any of its parts (factors included) are saved changed, or `invalidate` drops them directly.
+
+    Results are copied as they're cached, so later changes to the rating variables they came from don't reach them.
+    Cached results are shared by every rating of the same inputs, so must not be changed."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.versions = {}  # type: Dict[int, int]
+        self.input_names = {}  # type: Dict[tuple, Dict[str, frozenset]]
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, rating_manual_id: int, version: int, rate_inputs: dict, rating_manual: RatingManual = None) -> tuple:
+        """The key for some inputs to a manual, or None when that version of the manual hasn't been given before"""
+        input_names = self.input_names.get((rating_manual_id, version))
+        if input_names is None:
+            if rating_manual is None:
+                return None
+            input_names = {}
+            for rating_variable in rating_manual.rating_variables:
+                if rating_variable is not None and rating_variable.is_input:
+                    input_names.setdefault(rating_variable.sub_risk_label, set()).add(rating_variable.name)
+            input_names = self.input_names[(rating_manual_id, version)] = {
+                sub_risk_label: frozenset(names) for sub_risk_label, names in input_names.items()
+            }
+
+        return rating_manual_id, version, self.canonical_inputs(rate_inputs, input_names)
+
+    @staticmethod
+    def canonical_inputs(rate_inputs: dict, input_names: Dict[str, frozenset]) -> tuple:
+        if not input_names:
+            return canonical_value(rate_inputs)
+
+        names = input_names.get(None, frozenset())
+        canonical = []
+        for name, value in rate_inputs.items():
+            if name in input_names:
+                # a list of sub-risks, of which only the declared inputs matter
+                sub_risk_names = input_names[name]
+                value = tuple(
+                    tuple(sorted((key, canonical_value(item)) for key, item in sub_risk.items() if key in sub_risk_names))
+                    for sub_risk in value
+                ) if isinstance(value, list) else canonical_value(value)
+            elif name in names:
+                value = canonical_value(value)
+            else:
+                continue
+            canonical.append((name, value))
+        return tuple(sorted(canonical))
+
+    def get(self, key: tuple, count_miss: bool = True) -> RatingResult:
+        with self.lock:
+            self.expire(key[0], key[1])
+            result = self.results.get(key)
+            if result is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+
+            self.hits += 1
+            self.results.move_to_end(key)
+            return result
+
+    def put(self, key: tuple, result: RatingResult):
+        # the rating variables are usually the caller's own inputs, rated in place, which it may go on to change
+        result = RatingResult(copy_value(result.rating_variables))
+        with self.lock:
+            self.expire(key[0], key[1])
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def expire(self, rating_manual_id: int, version: int):
+        if self.versions.get(rating_manual_id, version) != version:
+            self.drop(rating_manual_id, version)
+        self.versions[rating_manual_id] = version
+
+    def drop(self, rating_manual_id: int, keep_version: int = None):
+        for cached in (self.results, self.input_names):
+            stale = [key for key in cached
+                     if key[0] == rating_manual_id and (keep_version is None or key[1] != keep_version)]
+            for key in stale:
+                del cached[key]
+
+    def invalidate(self, rating_manual_ids: Iterable[int] = None):
+        """Drop the cached results for the given manuals, or for every manual"""
+        with self.lock:
+            if rating_manual_ids is None:
+                self.results.clear()
+                self.versions.clear()
+                self.input_names.clear()
+                return
+
+            for rating_manual_id in rating_manual_ids:
+                self.drop(rating_manual_id)
+                self.versions.pop(rating_manual_id, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self.results), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
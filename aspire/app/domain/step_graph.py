@@ -0,0 +1,42 @@
+from typing import Dict, Iterable, List
+from .rating_step import AbstractRatingStep, Loop
+
+
+class StepGraph(object):
+    """The data dependencies between a list of rating steps, as a DAG. Each step depends on the earlier steps which may
+    have last written a variable it reads: the last to write it unconditionally, and any conditional steps (or loops)
+    since. A step whose reads can't be known depends on every step before it."""
+    rating_steps: List[AbstractRatingStep]
+    dependencies: List[List[int]]
+    writers: Dict[str, List[int]]
+
+    def __init__(self, rating_steps: List[AbstractRatingStep]):
+        self.rating_steps = rating_steps
+        self.dependencies = []
+        self.writers = {}
+
+        for i, rating_step in enumerate(rating_steps):
+            reads = rating_step.reads()
+            if reads is None:
+                self.dependencies.append(list(range(i)))
+            else:
+                self.dependencies.append(sorted({j for name in reads for j in self.writers.get(name, [])}))
+
+            # a loop only writes anything if there are sub-risks
+            unconditional = not rating_step.conditions and not isinstance(rating_step, Loop)
+            for name in rating_step.writes():
+                if unconditional:
+                    self.writers[name] = [i]
+                else:
+                    self.writers.setdefault(name, []).append(i)
+
+    def required(self, outputs: Iterable[str]) -> List[int]:
+        """The indices (in order) of the steps which the given output variables depend on"""
+        required = set()
+        pending = [i for name in outputs for i in self.writers.get(name, [])]
+        while pending:
+            i = pending.pop()
+            if i not in required:
+                required.add(i)
+                pending.extend(self.dependencies[i])
+        return sorted(required)
@@ -1,6 +1,12 @@
 from .rating_step import Set, Add, Subtract, Multiply, Divide, Round, Lookup, LinearInterpolate, Loop, SubRiskSum
 
 from .rater import Rater
+from .parallel import ParallelLoops
+from .step_graph import StepGraph
+from .instrumentation import RatingMetrics
+from .tracing import Tracer, TraceSubscriber, JsonLinesSpanExporter
+from .rating_frame import FrameLayout
+from .compiled_manual import STEP
 
 from .rating_manual import RatingManual
 
@@ -12,17 +18,24 @@ from .rating_variable import \
     BoolRatingVariable, \
     DecimalRatingVariable, \
     IntegerRatingVariable, \
-    StringRatingVariable
+    StringRatingVariable, \
+    convert_to_number
 
 from aspire.app.repository.rating_factor_repository import AbstractRatingFactorRepository
 from aspire.app.repository.rating_manual_repository import AbstractRatingManualRepository
 
 from . import rater
 
+from .codegen import compile_rating_manual, load_rate_function
+
 from .rating_step_condition import ComparisonOperation, LogicalOperation
 
 from copy import deepcopy
+from functools import reduce
 
+import json
+import pytest
+import threading
 import unittest
 
 
@@ -643,3 +656,834 @@ def test_integer_rating_variable():
     )
     assert var.min == 100000
     assert var.max is None
+
+
+def test_compiled_manual_is_reusable():
+    rating_steps = [
+        Lookup(
+            'base_rate',
+            [
+                RatingStepParameter('factor_type', 'base_rate', RatingStepParameterType.LITERAL),
+                RatingStepParameter('coverage', 'coverage', RatingStepParameterType.VARIABLE),
+            ],
+            MockRatingFactorRepository()
+        ),
+        Add(
+            'rate',
+            [
+                RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('surcharge', '450', RatingStepParameterType.LITERAL),
+            ],
+            ComparisonOperation('>', [
+                RatingStepParameter('coverage', 'coverage', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('10', '10', RatingStepParameterType.LITERAL),
+            ])
+        ),
+    ]
+    compiled_manual = Rater.compile(RatingManual('test', 'test', rating_steps, []))
+
+    assert compiled_manual.rate({'coverage': 50}) == '700.0'
+    assert compiled_manual.rate({'coverage': 20}) == '550.0'
+    assert 'rate' not in compiled_manual.run({'coverage': 5})
+
+
+def test_generated_code_matches_rater():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '100', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)],
+            [
+                Multiply(
+                    'risk_prem',
+                    [
+                        RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                        RatingStepParameter('factor', 'age_factor', RatingStepParameterType.VARIABLE),
+                    ],
+                    LogicalOperation('NOT', [ComparisonOperation('==', [
+                        RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                        RatingStepParameter('0', '0', RatingStepParameterType.LITERAL),
+                    ])])
+                ),
+            ]
+        ),
+        SubRiskSum(
+            'risk_total',
+            [
+                RatingStepParameter('risks', 'risks', RatingStepParameterType.LITERAL),
+                RatingStepParameter('risk_prem', 'risk_prem', RatingStepParameterType.LITERAL),
+            ]
+        ),
+        Lookup(
+            'coverage_rate',
+            [
+                RatingStepParameter('factor_type', 'base_rate', RatingStepParameterType.LITERAL),
+                RatingStepParameter('coverage', 'coverage', RatingStepParameterType.VARIABLE),
+            ],
+            MockRatingFactorRepository()
+        ),
+        Add(
+            'rate',
+            [
+                RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('risk_total', 'risk_total', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('coverage_rate', 'coverage_rate', RatingStepParameterType.VARIABLE),
+            ]
+        ),
+        Round('rate', [
+            RatingStepParameter('rate', 'rate', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('places', '0', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    manual = RatingManual('test', 'test', rating_steps, [])
+    rate_function = load_rate_function(compile_rating_manual(manual), MockRatingFactorRepository())
+
+    inputs = {'age_factor': '10', 'coverage': 2, 'risks': [{'age': '5'}, {'age': '10'}]}
+    expected = Rater(manual).compiled_manual.run(deepcopy(inputs))
+    assert rate_function(deepcopy(inputs)) == expected
+    assert expected['rate'] == '260.0'
+
+
+def test_rate_batch():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '100', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)],
+            [
+                Multiply(
+                    'risk_prem',
+                    [
+                        RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                        RatingStepParameter('factor', 'age_factor', RatingStepParameterType.VARIABLE),
+                    ]
+                ),
+            ]
+        ),
+        SubRiskSum(
+            'risk_total',
+            [
+                RatingStepParameter('risks', 'risks', RatingStepParameterType.LITERAL),
+                RatingStepParameter('risk_prem', 'risk_prem', RatingStepParameterType.LITERAL),
+            ]
+        ),
+        Lookup(
+            'coverage_rate',
+            [
+                RatingStepParameter('factor_type', 'base_rate', RatingStepParameterType.LITERAL),
+                RatingStepParameter('coverage', 'coverage', RatingStepParameterType.VARIABLE),
+            ],
+            MockRatingFactorRepository()
+        ),
+        Add(
+            'rate',
+            [
+                RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('risk_total', 'risk_total', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('coverage_rate', 'coverage_rate', RatingStepParameterType.VARIABLE),
+            ],
+            ComparisonOperation('!=', [
+                RatingStepParameter('state', 'state', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('XX', 'XX', RatingStepParameterType.LITERAL),
+            ])
+        ),
+    ]
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+
+    results = rater.rate_batch({
+        'state': ['NY', 'XX', 'NJ'],
+        'age_factor': ['10', '10', '2'],
+        'coverage': [2, 2, 4],
+        'risks': [[{'age': '5'}, {'age': '10'}], [{'age': '1'}], [{'age': '3'}]],
+    })
+
+    assert list(results['rate']) == [260.0, None, 126.0]
+    assert list(results['risk_total']) == [150.0, 10.0, 6.0]
+    assert list(results['risks'][0]) == [{'age': '5', 'risk_prem': 50.0}, {'age': '10', 'risk_prem': 100.0}]
+
+    with pytest.raises(TypeError):
+        rater.rate_batch({'state': ['NY'], 'age_factor': ['10'], 'coverage': [2], 'risks': [[]]})
+
+
+def test_rate_batch_equality_conditions():
+    def equals(name: str, value: str, operator: str = '=='):
+        return ComparisonOperation(operator, [
+            RatingStepParameter(name, name, RatingStepParameterType.VARIABLE),
+            RatingStepParameter(value, value, RatingStepParameterType.LITERAL),
+        ])
+
+    rating_steps = [
+        Multiply('amt', [
+            RatingStepParameter('base', 'base', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('two', '2', RatingStepParameterType.LITERAL),
+        ]),
+        Set('rate', [RatingStepParameter('one', '1', RatingStepParameterType.LITERAL)]),
+        Set('rate', [RatingStepParameter('two', '2', RatingStepParameterType.LITERAL)], equals('amt', '200.0')),
+        Set('other', [RatingStepParameter('yes', 'yes', RatingStepParameterType.LITERAL)], equals('amt', '200.0', '!=')),
+        Set('count_matched', [RatingStepParameter('yes', 'yes', RatingStepParameterType.LITERAL)], equals('count', '3')),
+    ]
+    rating_manual = RatingManual('test', 'test', rating_steps, [
+        IntegerRatingVariable('count', 'test', 'integer', None, True, True, None, '0,10', None),
+    ])
+    inputs = [{'base': 100, 'count': 3}, {'base': 50, 'count': 4}, {'base': 100.0, 'count': 0}]
+
+    rater = Rater(rating_manual)
+    native_rater = Rater(rating_manual, native_types=True)
+    results = rater.rate_batch({name: [row[name] for row in inputs] for name in ('base', 'count')})
+    for i, row in enumerate(inputs):
+        # row by row, the inputs of a web form or CSV file are strings
+        expected = rater.compiled_manual.run({name: str(value) for name, value in row.items()})
+        native = native_rater.compiled_manual.run(dict(row))
+        for name in ('rate', 'other', 'count_matched'):
+            assert results[name][i] == expected.get(name)
+            assert convert_to_number(native.get(name)) == convert_to_number(expected.get(name))
+    assert list(results['rate']) == ['2', '1', '2']
+
+
+def test_rate_batch_updating_parent():
+    # each sub-risk adds to the parent's total, and sees the total of those before it
+    rating_steps = [
+        Set('total', [RatingStepParameter('zero', '0', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)],
+            [
+                Add('total', [
+                    RatingStepParameter('total', 'total', RatingStepParameterType.VARIABLE),
+                    RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                ]),
+                Set('running_total', [RatingStepParameter('total', 'total', RatingStepParameterType.VARIABLE)]),
+                Loop(
+                    [RatingStepParameter('loop variable', 'drivers', RatingStepParameterType.LITERAL)],
+                    [
+                        Add('total', [
+                            RatingStepParameter('total', 'total', RatingStepParameterType.VARIABLE),
+                            RatingStepParameter('points', 'points', RatingStepParameterType.VARIABLE),
+                        ]),
+                    ]
+                ),
+            ]
+        ),
+    ]
+    rating_manual = RatingManual('test', 'test', rating_steps, [])
+    inputs = [
+        {'risks': [{'age': '5', 'drivers': [{'points': '1'}, {'points': '2'}]}, {'age': '10', 'drivers': []}]},
+        {'risks': [{'age': '1', 'drivers': [{'points': '3'}]}]},
+        {'risks': []},
+    ]
+
+    results = Rater(rating_manual).rate_batch({'risks': [deepcopy(row['risks']) for row in inputs]})
+
+    for i, row in enumerate(inputs):
+        expected = reduce(lambda rating_variables, rating_step: rating_step.run(rating_variables), rating_steps,
+                          deepcopy(row))
+        assert float(results['total'][i]) == float(expected['total'])
+        assert [float(sub_risk['running_total']) for sub_risk in results['risks'][i]] == \
+            [float(sub_risk['running_total']) for sub_risk in expected['risks']]
+    assert [float(total) for total in results['total']] == [18.0, 4.0, 0.0]
+
+
+def test_native_types_rater():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '100', RatingStepParameterType.LITERAL)]),
+        Multiply(
+            'rate',
+            [
+                RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('square_feet', 'square_feet', RatingStepParameterType.VARIABLE),
+            ]
+        ),
+        Round('rate', [
+            RatingStepParameter('rate', 'rate', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('places', '1', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    rating_variables = [
+        IntegerRatingVariable('square_feet', 'test', 'integer', None, True, True, None, '0,5000', None),
+    ]
+    manual = RatingManual('test', 'test', rating_steps, rating_variables)
+
+    rater = Rater(manual, native_types=True)
+    assert rater.rate({'square_feet': '12'}) == 1200.0
+    assert rater.check_output('square_feet') == 12
+    assert rater.check_output('base_rate') == 100.0
+
+    assert Rater(manual).rate({'square_feet': '12'}) == '1200.0'
+
+
+def test_native_types_equality_conditions():
+    def variable(name):
+        return RatingStepParameter(name, name, RatingStepParameterType.VARIABLE)
+
+    def literal(value):
+        return RatingStepParameter(value, value, RatingStepParameterType.LITERAL)
+
+    rating_steps = [
+        Set('rate', [literal('100')]),
+        Set('x', [literal('5')]),
+        Multiply('rate', [variable('rate'), literal('0.9')],
+                 ComparisonOperation('==', [variable('deductible'), literal('1000')])),
+        Add('rate', [variable('rate'), literal('1')], ComparisonOperation('==', [variable('x'), literal('5')])),
+        Add('rate', [variable('rate'), literal('10')], ComparisonOperation('!=', [variable('tier'), literal('A')])),
+        Add('rate', [variable('rate'), literal('100')], ComparisonOperation('!=', [variable('x'), literal('5')])),
+    ]
+    rating_variables = [
+        IntegerRatingVariable('deductible', 'test', 'integer', None, True, True, None, '0,5000', None),
+        StringRatingVariable('tier', 'test', 'string', None, True, True, None, '["A", "B"]', None),
+    ]
+    manual = RatingManual('test', 'test', rating_steps, rating_variables)
+
+    for rate_inputs, expected in [({'deductible': '1000', 'tier': 'A'}, 91.0),
+                                  ({'deductible': '500', 'tier': 'B'}, 111.0)]:
+        assert float(Rater(manual).rate(dict(rate_inputs))) == expected
+        assert Rater(manual, native_types=True).rate(dict(rate_inputs)) == expected
+
+
+def test_rating_variable_coercion():
+    integer_variable = IntegerRatingVariable('age', 'test', 'integer', None, True, True, None, '0,250', None)
+    assert integer_variable.coerce('15') == 15
+    assert integer_variable.coerce('abc') == 'abc'
+
+    decimal_variable = DecimalRatingVariable('factor', 'test', 'decimal', None, True, True, '1', '0,5', '3,2')
+    assert decimal_variable.coerce('2.50') == 2.5
+
+
+def test_frame_loop_scoping():
+    rating_steps = [
+        Set('discount', [RatingStepParameter('discount', '0.5', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)],
+            [
+                Multiply('risk_prem', [
+                    RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                    RatingStepParameter('discount', 'discount', RatingStepParameterType.VARIABLE),
+                ]),
+                Add('count', [
+                    RatingStepParameter('count', 'count', RatingStepParameterType.VARIABLE),
+                    RatingStepParameter('one', '1', RatingStepParameterType.LITERAL),
+                ]),
+            ]
+        ),
+        SubRiskSum('rate', [
+            RatingStepParameter('risks', 'risks', RatingStepParameterType.LITERAL),
+            RatingStepParameter('risk_prem', 'risk_prem', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    rate_inputs = {
+        'count': 0,
+        'risks': [
+            {'age': 4, 'vin': 'A1', 'discount': '0.9'},
+            {'age': 8, 'vin': 'B2'},
+        ]
+    }
+
+    expected = deepcopy(rate_inputs)
+    for rating_step in rating_steps:
+        rating_step.run(expected)
+
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+    assert rater.rate(rate_inputs) == 6.0
+    assert rater.rating_variables == expected
+    assert rater.rating_variables['count'] == '2.0'
+    assert rater.rating_variables['risks'] == [
+        {'age': 4, 'vin': 'A1', 'risk_prem': '2.0'},
+        {'age': 8, 'vin': 'B2', 'risk_prem': '4.0'},
+    ]
+
+
+def test_rater_is_reentrant():
+    lookup_step = Lookup(
+        'rate',
+        [
+            RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+            RatingStepParameter('base_rate_1', 'x', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('base_rate_2', 3, RatingStepParameterType.LITERAL),
+        ],
+        MockRatingFactorRepository()
+    )
+    assert lookup_step.apply({'x': 2})['rate'] == 6
+    assert lookup_step.apply({'x': 4})['rate'] == 12
+    assert len(lookup_step.inputs) == 3
+
+    rater = Rater(RatingManual('test', 'test', [lookup_step], []))
+    results = {}
+
+    def rate_in_thread(x):
+        results[x] = (rater.rate({'x': x}, True), rater.check_output('x'), rater.evaluate({'x': x}).rate)
+
+    threads = [threading.Thread(target=rate_in_thread, args=(x,)) for x in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {x: (x * 3, x, x * 3) for x in range(20)}
+    assert rater.last_result is None
+
+
+def test_detail_capture_records_writes():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '100', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)],
+            [
+                Multiply('risk_prem', [
+                    RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                    RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                ]),
+            ]
+        ),
+        SubRiskSum('rate', [
+            RatingStepParameter('risks', 'risks', RatingStepParameterType.LITERAL),
+            RatingStepParameter('risk_prem', 'risk_prem', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+    result = rater.evaluate({'risks': [{'age': 1}, {'age': 2}]}, capture_details=True)
+
+    assert result.rate == 300.0
+    assert [entry[2] for entry in result.record if entry[0] == STEP] == [
+        {'base_rate': '100'}, {'risk_prem': '100.0'}, {'risk_prem': '200.0'}, {}, {'rate': 300.0}
+    ]
+    assert result.snapshots is None
+
+    assert [detail['rating_variables'] for detail in result.get_step_by_step_diff()] == [
+        {'risks': [{'age': 1}, {'age': 2}]},
+        {'base_rate': '100'},
+        {'age': 1, 'risk_prem': '100.0'},
+        {'age': 2, 'risks': [{'age': 1, 'risk_prem': '100.0'}, {'age': 2}], 'risk_prem': '200.0'},
+        {'risks': [{'age': 1, 'risk_prem': '100.0'}, {'age': 2, 'risk_prem': '200.0'}]},
+        {'rate': 300.0},
+    ]
+    assert result.detailed_results[2]['rating_variables'] == {
+        'age': 1, 'risk_prem': '100.0', 'base_rate': '100', 'risks': [{'age': 1}, {'age': 2}]
+    }
+    assert result.detailed_results[-1]['rating_variables'] == result.rating_variables
+
+
+def test_nested_loop_steps():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '10', RatingStepParameterType.LITERAL)]),
+        Loop(
+            [RatingStepParameter('loop variable', 'vehicles', RatingStepParameterType.LITERAL)],
+            [
+                Loop(
+                    [RatingStepParameter('loop variable', 'drivers', RatingStepParameterType.LITERAL)],
+                    [
+                        Multiply('driver_prem', [
+                            RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+                            RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+                        ]),
+                    ]
+                ),
+                SubRiskSum('vehicle_prem', [
+                    RatingStepParameter('drivers', 'drivers', RatingStepParameterType.LITERAL),
+                    RatingStepParameter('driver_prem', 'driver_prem', RatingStepParameterType.LITERAL),
+                ]),
+            ]
+        ),
+        SubRiskSum('rate', [
+            RatingStepParameter('vehicles', 'vehicles', RatingStepParameterType.LITERAL),
+            RatingStepParameter('vehicle_prem', 'vehicle_prem', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    rate_inputs = {
+        'vehicles': [
+            {'vin': 'A1', 'drivers': [{'age': 20}, {'age': 30}]},
+            {'vin': 'B2', 'base_rate': 'ignored', 'drivers': [{'age': 40}]},
+        ]
+    }
+
+    expected = deepcopy(rate_inputs)
+    for rating_step in rating_steps:
+        rating_step.run(expected)
+
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+    assert rater.rate(rate_inputs) == 900.0
+    assert rater.rating_variables == expected
+    assert rater.rating_variables['vehicles'][1] == {
+        'vin': 'B2', 'drivers': [{'age': 40, 'driver_prem': '400.0'}], 'vehicle_prem': 400.0
+    }
+
+
+def test_parallel_loops():
+    def loop_manual(rating_steps):
+        return RatingManual('test', 'test', [
+            Set('count', [RatingStepParameter('zero', '0', RatingStepParameterType.LITERAL)]),
+            Loop([RatingStepParameter('loop variable', 'risks', RatingStepParameterType.LITERAL)], rating_steps),
+            SubRiskSum('rate', [
+                RatingStepParameter('risks', 'risks', RatingStepParameterType.LITERAL),
+                RatingStepParameter('risk_prem', 'risk_prem', RatingStepParameterType.LITERAL),
+            ]),
+        ], [])
+
+    independent = loop_manual([
+        Multiply('risk_prem', [
+            RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('factor', '2', RatingStepParameterType.LITERAL),
+        ]),
+    ])
+    # counting in the parent makes each iteration depend on the last
+    dependent = loop_manual([
+        Add('count', [
+            RatingStepParameter('count', 'count', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('one', '1', RatingStepParameterType.LITERAL),
+        ]),
+        Multiply('risk_prem', [
+            RatingStepParameter('age', 'age', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('count', 'count', RatingStepParameterType.VARIABLE),
+        ]),
+    ])
+
+    for parallel in [ParallelLoops(4, min_sub_risks=10, chunk_size=7), ParallelLoops(2, use_processes=True, min_sub_risks=10)]:
+        for rating_manual in [independent, dependent]:
+            rate_inputs = {'risks': [{'age': age, 'id': 'risk %d' % age} for age in range(50)]}
+            expected = Rater(rating_manual).evaluate(deepcopy(rate_inputs)).rating_variables
+            assert Rater(rating_manual, parallel=parallel).evaluate(rate_inputs).rating_variables == expected
+        parallel.shutdown()
+
+    # workers are only forked again for a loop they don't know, and a manual's loops go once it's done with
+    import gc
+    from .parallel import LOOPS
+    parallel = ParallelLoops(2, use_processes=True, min_sub_risks=10)
+    rater = Rater(independent, parallel=parallel)
+    rater.evaluate({'risks': [{'age': age} for age in range(20)]})
+    executor = parallel.executor
+    unused = Rater(independent, parallel=parallel)
+    rater.evaluate({'risks': [{'age': age} for age in range(20)]})
+    assert parallel.executor is executor
+    key = unused.compiled_manual.loops.key
+    del unused
+    gc.collect()
+    assert key not in LOOPS
+    parallel.shutdown()
+
+    # nor can a worker process share the parent's database connection, nor threads a session
+    def lookup_manual(repository):
+        return loop_manual([Lookup('risk_prem', [
+            RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+            RatingStepParameter('base_rate_1', 'age', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+        ], repository)])
+
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    from aspire.app.repository.rating_factor_repository import IndexedRatingFactorRepository
+    repository = MockRatingFactorRepository()
+    repository.db_session = object()
+    with pytest.raises(Exception, match="worker processes"):
+        Rater(lookup_manual(repository), parallel=parallel)
+    threads = ParallelLoops(2, min_sub_risks=10)
+    with pytest.raises(Exception, match="threads"):
+        Rater(lookup_manual(repository), parallel=threads)
+
+    repository.db_session = scoped_session(sessionmaker())
+    rate_inputs = {'risks': [{'age': age} for age in range(20)]}
+    assert Rater(lookup_manual(repository), parallel=threads).evaluate(deepcopy(rate_inputs)).rating_variables == \
+        Rater(lookup_manual(repository)).evaluate(deepcopy(rate_inputs)).rating_variables
+    Rater(lookup_manual(IndexedRatingFactorRepository(1, object())), parallel=threads)
+    threads.shutdown()
+
+
+def test_rate_selected_outputs():
+    rating_steps = [
+        Set('base_rate', [RatingStepParameter('base', '100', RatingStepParameterType.LITERAL)]),
+        Lookup('territory_factor', [
+            RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+            RatingStepParameter('base_rate_1', 'territory', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+        ], MockRatingFactorRepository()),
+        Multiply('key_premium', [
+            RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('territory_factor', 'territory_factor', RatingStepParameterType.VARIABLE),
+        ]),
+        Set('surcharge', [RatingStepParameter('surcharge', '25', RatingStepParameterType.LITERAL)]),
+        Set('surcharge', [RatingStepParameter('surcharge', '50', RatingStepParameterType.LITERAL)], ComparisonOperation('>', [
+            RatingStepParameter('territory', 'territory', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('3', '3', RatingStepParameterType.LITERAL),
+        ])),
+        Add('rate', [
+            RatingStepParameter('key_premium', 'key_premium', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('surcharge', 'surcharge', RatingStepParameterType.VARIABLE),
+        ]),
+    ]
+
+    graph = StepGraph(rating_steps)
+    assert graph.dependencies == [[], [], [0, 1], [], [], [2, 3, 4]]
+    assert graph.required(['key_premium']) == [0, 1, 2]
+    assert graph.required(['surcharge']) == [3, 4]
+    assert graph.required(['territory']) == []
+
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+    assert rater.rate({'territory': 5}, outputs=['key_premium']) == {'key_premium': '1000.0'}
+    assert 'surcharge' not in rater.rating_variables
+    assert rater.rate({'territory': 5}, outputs=['surcharge', 'territory']) == {'surcharge': '50', 'territory': 5}
+    assert rater.rate({'territory': 5}) == '1050.0'
+
+
+def test_constant_folding():
+    rating_steps = [
+        Multiply('base_rate', [
+            RatingStepParameter('base', '100', RatingStepParameterType.LITERAL),
+            RatingStepParameter('factor', '1.5', RatingStepParameterType.LITERAL),
+        ]),
+        Round('rounded', [
+            RatingStepParameter('value', '3.14159', RatingStepParameterType.LITERAL),
+            RatingStepParameter('places', '2', RatingStepParameterType.LITERAL),
+        ]),
+        Set('surcharge', [RatingStepParameter('surcharge', '25', RatingStepParameterType.LITERAL)], ComparisonOperation('<', [
+            RatingStepParameter('1', '1', RatingStepParameterType.LITERAL),
+            RatingStepParameter('2', '2', RatingStepParameterType.LITERAL),
+        ])),
+        Set('discount', [RatingStepParameter('discount', '10', RatingStepParameterType.LITERAL)], LogicalOperation('AND', [
+            ComparisonOperation('==', [
+                RatingStepParameter('a', 'a', RatingStepParameterType.LITERAL),
+                RatingStepParameter('b', 'b', RatingStepParameterType.LITERAL),
+            ]),
+            ComparisonOperation('>', [
+                RatingStepParameter('territory', 'territory', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('3', '3', RatingStepParameterType.LITERAL),
+            ]),
+        ])),
+        Divide('rate', [
+            RatingStepParameter('base_rate', 'base_rate', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('divisor', '4', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+
+    assert rating_steps[2].conditions.constant() is True
+    assert rating_steps[3].conditions.constant() is False
+    assert rating_steps[3].conditions.operands[1].constant() is None
+    assert rating_steps[3].conditions.operands[0].constant() is False
+
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+    assert len(rater.compiled_manual.runnable) == 4
+    assert rater.rate({'territory': 5}) == '37.5'
+    assert rater.rating_variables == {
+        'territory': 5, 'base_rate': '150.0', 'rounded': '3.14', 'surcharge': '25', 'rate': '37.5'
+    }
+    assert rater.rating_variables == reduce(lambda rv, step: step.run(rv), rating_steps, {'territory': 5})
+
+
+def test_conditions_short_circuit():
+    x_is_5 = ComparisonOperation('==', [
+        RatingStepParameter('x', 'x', RatingStepParameterType.VARIABLE),
+        RatingStepParameter('5', 5, RatingStepParameterType.LITERAL),
+    ])
+    # checking y fails when it isn't set
+    y_above_1 = ComparisonOperation('>', [
+        RatingStepParameter('y', 'y', RatingStepParameterType.VARIABLE),
+        RatingStepParameter('1', '1', RatingStepParameterType.LITERAL),
+    ])
+
+    assert LogicalOperation('AND', [x_is_5, y_above_1]).check({'x': 4}) is False
+    assert LogicalOperation('OR', [x_is_5, y_above_1]).check({'x': 5}) is True
+    assert LogicalOperation('AND', [x_is_5, x_is_5, y_above_1]).check({'x': 4}) is False
+    assert LogicalOperation('OR', [y_above_1, x_is_5, x_is_5]).check({'x': 4, 'y': 2}) is True
+
+    layout = FrameLayout(['x', 'y'])
+    nested = LogicalOperation('OR', [LogicalOperation('AND', [x_is_5, y_above_1]), LogicalOperation('NOT', [x_is_5])])
+    check = nested.compile(layout)
+    assert check(layout.load({'x': 4})) is True
+    assert check(layout.load({'x': 5, 'y': 2})) is True
+    assert check(layout.load({'x': 5, 'y': 0})) is False
+
+
+def test_rerate_changed_inputs():
+    class CountingRatingFactorRepository(MockRatingFactorRepository):
+        lookups = 0
+
+        def lookup(self, rating_factor_type: str, params: dict, options: dict = None):
+            self.lookups += 1
+            return super().lookup(rating_factor_type, params, options)
+
+    repo = CountingRatingFactorRepository()
+    rating_steps = [
+        Lookup('territory_factor', [
+            RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+            RatingStepParameter('base_rate_1', 'territory', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+        ], repo),
+        Set('surcharge', [RatingStepParameter('surcharge', '0', RatingStepParameterType.LITERAL)]),
+        Set('surcharge', [RatingStepParameter('surcharge', '50', RatingStepParameterType.LITERAL)], ComparisonOperation('>', [
+            RatingStepParameter('deductible', 'deductible', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('1000', '1000', RatingStepParameterType.LITERAL),
+        ])),
+        Add('rate', [
+            RatingStepParameter('territory_factor', 'territory_factor', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('surcharge', 'surcharge', RatingStepParameterType.VARIABLE),
+        ]),
+    ]
+    rater = Rater(RatingManual('test', 'test', rating_steps, []))
+
+    result = rater.evaluate({'territory': 5, 'deductible': 500}, keep_state=True)
+    assert result.rate == '10.0'
+    assert repo.lookups == 1
+
+    result = rater.rerate(result, {'deductible': 5000})
+    assert result.rate == '60.0'
+    assert result.rating_variables == {'territory': 5, 'deductible': 5000, 'territory_factor': 10, 'surcharge': '50',
+                                       'rate': '60.0'}
+    assert repo.lookups == 1
+
+    result = rater.rerate(result, {'territory': 3, 'deductible': 5000})
+    assert result.rate == '56.0'
+    assert repo.lookups == 2
+
+    result = rater.rerate(result, {'deductible': 100})
+    assert result.rate == '6.0'
+    assert repo.lookups == 2
+
+
+def test_memoized_lookups():
+    class CountingRatingFactorRepository(MockRatingFactorRepository):
+        lookups = 0
+
+        def lookup(self, rating_factor_type: str, params: dict, options: dict = None):
+            self.lookups += 1
+            return super().lookup(rating_factor_type, params, options)
+
+    repo = CountingRatingFactorRepository()
+    rating_steps = [
+        Loop([RatingStepParameter('sub_risk_label', 'buildings', RatingStepParameterType.LITERAL)], [
+            Lookup('territory_factor', [
+                RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+                RatingStepParameter('base_rate_1', 'territory', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+            ], repo),
+        ]),
+        SubRiskSum('rate', [
+            RatingStepParameter('sub_risk_label', 'buildings', RatingStepParameterType.LITERAL),
+            RatingStepParameter('sub_risk_variable', 'territory_factor', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    rater = Rater(RatingManual('test', 'test', rating_steps, []), memo_size=2)
+
+    assert rater.rate({'buildings': [{'territory': 1}, {'territory': 2}, {'territory': 1}]}) == 8.0
+    assert rater.rate({'buildings': [{'territory': 2}, {'territory': 2}]}) == 8.0
+    assert repo.lookups == 2
+    assert rater.compiled_manual.memo_stats() == [
+        {'step': '', 'target': 'territory_factor', 'hits': 3, 'misses': 2, 'size': 2, 'max_size': 2}
+    ]
+
+    assert rater.rate({'buildings': [{'territory': 3}, {'territory': 1}]}) == 8.0
+    assert repo.lookups == 4
+
+    rater.compiled_manual.clear_memos()
+    assert rater.rate({'buildings': [{'territory': 2}]}) == 4.0
+    assert repo.lookups == 5
+
+
+def test_step_metrics():
+    rating_steps = [
+        Lookup('territory_factor', [
+            RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+            RatingStepParameter('base_rate_1', 'territory', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+        ], MockRatingFactorRepository()),
+        Set('surcharge', [RatingStepParameter('surcharge', '50', RatingStepParameterType.LITERAL)], ComparisonOperation('>', [
+            RatingStepParameter('territory', 'territory', RatingStepParameterType.VARIABLE),
+            RatingStepParameter('3', '3', RatingStepParameterType.LITERAL),
+        ])),
+    ]
+    rating_steps[0].label('Territory Factor')
+    rater = Rater(RatingManual('test', 'test', rating_steps, [], id=7, version=2), metrics=RatingMetrics())
+    for territory in (1, 4, 5):
+        rater.evaluate({'territory': territory})
+
+    metrics = rater.export_metrics()
+    assert json.loads(rater.metrics.to_json(rater.rating_manual)) == metrics
+    assert (metrics['manual_id'], metrics['manual'], metrics['version'], metrics['ratings']) == (7, 'test', 2, 3)
+
+    lookup, surcharge = metrics['steps']
+    assert (lookup['step'], lookup['target'], lookup['calls'], lookup['skipped'], lookup['lookups']) == \
+           ('Territory Factor', 'territory_factor', 3, 0, 3)
+    assert 0 < lookup['lookup_time'] <= lookup['time'] and lookup['max_time'] <= lookup['time']
+    assert (surcharge['target'], surcharge['calls'], surcharge['skipped'], surcharge['lookups']) == ('surcharge', 3, 1, 0)
+
+    assert Rater(RatingManual('test', 'test', rating_steps, [])).export_metrics() is None
+
+
+def test_tracing_hooks(tmp_path):
+    class RecordingSubscriber(TraceSubscriber):
+        def __init__(self):
+            self.calls = []
+
+        def before_step(self, rating_step):
+            self.calls.append(('step', getattr(rating_step, 'target', None)))
+
+        def before_lookup(self, rating_step, rating_factor_type: str, params: dict):
+            self.calls.append(('lookup', rating_factor_type, params))
+
+        def loop_iteration_start(self, rating_step, index: int):
+            self.calls.append(('iteration', index))
+
+    rating_steps = [
+        Loop([RatingStepParameter('sub_risk_label', 'buildings', RatingStepParameterType.LITERAL)], [
+            Lookup('territory_factor', [
+                RatingStepParameter('factor_type', 'multiply_test', RatingStepParameterType.LITERAL),
+                RatingStepParameter('base_rate_1', 'territory', RatingStepParameterType.VARIABLE),
+                RatingStepParameter('base_rate_2', 2, RatingStepParameterType.LITERAL),
+            ], MockRatingFactorRepository()),
+        ]),
+        SubRiskSum('rate', [
+            RatingStepParameter('sub_risk_label', 'buildings', RatingStepParameterType.LITERAL),
+            RatingStepParameter('sub_risk_variable', 'territory_factor', RatingStepParameterType.LITERAL),
+        ]),
+    ]
+    manual = RatingManual('test', 'test', rating_steps, [])
+    assert Rater(manual, tracer=Tracer()).compiled_manual.tracer is None
+
+    subscriber = RecordingSubscriber()
+    exporter = JsonLinesSpanExporter(str(tmp_path / 'trace.jsonl'))
+    rater = Rater(manual, tracer=Tracer([subscriber, exporter]))
+    assert rater.rate({'buildings': [{'territory': 1}, {'territory': 2}]}) == 6.0
+    exporter.close()
+
+    assert subscriber.calls == [
+        ('step', None),
+        ('iteration', 0), ('step', 'territory_factor'), ('lookup', 'multiply_test', {'base_rate_1': 1, 'base_rate_2': 2}),
+        ('iteration', 1), ('step', 'territory_factor'), ('lookup', 'multiply_test', {'base_rate_1': 2, 'base_rate_2': 2}),
+        ('step', 'rate'),
+    ]
+
+    spans = [json.loads(line) for line in (tmp_path / 'trace.jsonl').read_text().splitlines()]
+    assert [(span['cat'], span['name']) for span in spans] == [
+        ('lookup', 'multiply_test'), ('step', 'Lookup'), ('iteration', 'buildings [0]'),
+        ('lookup', 'multiply_test'), ('step', 'Lookup'), ('iteration', 'buildings [1]'),
+        ('step', 'Loop'), ('step', 'SubRiskSum'), ('manual', 'test'),
+    ]
+    manual_span, lookup_span = spans[-1], spans[0]
+    assert manual_span['ts'] <= lookup_span['ts'] and \
+        lookup_span['ts'] + lookup_span['dur'] <= manual_span['ts'] + manual_span['dur']
+    assert lookup_span['args'] == {'params': {'base_rate_1': 1, 'base_rate_2': 2}, 'result': 2}
+
+    exporter = JsonLinesSpanExporter(str(tmp_path / 'other.jsonl'))
+    rater = Rater(manual, tracer=Tracer([exporter]))
+    rating_variables, state = rater.compiled_manual.run_keeping_state({'buildings': [{'territory': 1}]})
+    rater.compiled_manual.rerate(state, {'buildings': [{'territory': 2}]})
+    rater.rate_batch({'buildings': [[{'territory': 1}], [{'territory': 2}]]})
+    exporter.close()
+
+    spans = [json.loads(line) for line in (tmp_path / 'other.jsonl').read_text().splitlines()]
+    assert [span['name'] for span in spans if span['cat'] == 'manual'] == ['test', 'test', 'test']
+
+
+def test_tracing_sql(tmp_path):
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+
+    exporter = JsonLinesSpanExporter(str(tmp_path / 'trace.jsonl'))
+    engine = create_engine('sqlite://')
+    exporter.trace_sql(engine)
+    engine.execute('SELECT 1')
+    with pytest.raises(OperationalError):
+        engine.execute('SELECT * FROM missing')
+
+    # no statement is run (nor span opened) when connecting fails, which mustn't hide the error
+    unreachable = create_engine('sqlite:///%s' % (tmp_path / 'missing' / 'aspire.db'))
+    exporter.trace_sql(unreachable)
+    with pytest.raises(OperationalError):
+        unreachable.execute('SELECT 1')
+    exporter.close()
+
+    spans = [json.loads(line) for line in (tmp_path / 'trace.jsonl').read_text().splitlines()]
+    assert [(span['cat'], span['args']['statement'], 'error' in span['args']) for span in spans] == [
+        ('sql', 'SELECT 1', False), ('sql', 'SELECT * FROM missing', True),
+    ]
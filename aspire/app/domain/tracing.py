@@ -0,0 +1,238 @@
+from time import perf_counter
+from typing import Callable, List
+import itertools
+import json
+import os
+import threading
+from ..repository.rating_factor_repository import AbstractRatingFactorRepository
+
+
+class TraceSubscriber(object):
+    """Receives the hooks a traced manual calls as it rates. Each `after_` hook is given the exception which ended
+    what it follows, if any. A batch rated at once is one rating, whose rating variables are the columns of its
+    inputs. Override whichever are needed."""
+
+    def before_rating(self, rating_manual, rating_variables: dict):
+        pass
+
+    def after_rating(self, rating_manual, rating_variables: dict, error: Exception = None):
+        pass
+
+    def before_step(self, rating_step):
+        pass
+
+    def after_step(self, rating_step, error: Exception = None):
+        pass
+
+    def before_lookup(self, rating_step, rating_factor_type: str, params: dict):
+        pass
+
+    def after_lookup(self, rating_step, rating_factor_type: str, params: dict, result=None, error: Exception = None):
+        pass
+
+    def loop_iteration_start(self, rating_step, index: int):
+        pass
+
+    def loop_iteration_end(self, rating_step, index: int, error: Exception = None):
+        pass
+
+
+class Tracer(object):
+    """Calls each subscriber's hooks around every rating, step, factor lookup and loop iteration of the manuals
+    compiled with it. Hooks are compiled into a manual only when the tracer has subscribers by then, so a tracer
+    without any costs nothing."""
+    subscribers: List[TraceSubscriber]
+
+    def __init__(self, subscribers: List[TraceSubscriber] = None):
+        self.subscribers = list(subscribers or [])
+
+    def subscribe(self, subscriber: TraceSubscriber) -> TraceSubscriber:
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def hooks(self, name: str) -> List[Callable]:
+        return [getattr(subscriber, name) for subscriber in self.subscribers]
+
+    def trace_rating(self, rating_manual, run: Callable) -> Callable:
+        before, after = self.hooks('before_rating'), self.hooks('after_rating')
+
+        def traced(rating_variables: dict, *args, **kwargs):
+            for hook in before:
+                hook(rating_manual, rating_variables)
+            try:
+                result = run(rating_variables, *args, **kwargs)
+            except Exception as error:
+                for hook in after:
+                    hook(rating_manual, rating_variables, error)
+                raise
+            for hook in after:
+                hook(rating_manual, rating_variables)
+            return result
+        return traced
+
+    def trace_step(self, rating_step, execute: Callable) -> Callable:
+        before, after = self.hooks('before_step'), self.hooks('after_step')
+
+        def traced(frame: list):
+            for hook in before:
+                hook(rating_step)
+            try:
+                execute(frame)
+            except Exception as error:
+                for hook in after:
+                    hook(rating_step, error)
+                raise
+            for hook in after:
+                hook(rating_step)
+        return traced
+
+    def trace_iterations(self, rating_step, run_body: Callable) -> Callable:
+        """Wrap one run of a loop's body over its sub-risks, numbering each iteration"""
+        start, end = self.hooks('loop_iteration_start'), self.hooks('loop_iteration_end')
+        indices = itertools.count()
+
+        def traced(frame: list):
+            index = next(indices)
+            for hook in start:
+                hook(rating_step, index)
+            try:
+                run_body(frame)
+            except Exception as error:
+                for hook in end:
+                    hook(rating_step, index, error)
+                raise
+            for hook in end:
+                hook(rating_step, index)
+        return traced
+
+    def trace_repository(self, rating_step, repository: AbstractRatingFactorRepository):
+        return TracedRatingFactorRepository(repository, rating_step, self.hooks('before_lookup'),
+                                            self.hooks('after_lookup'))
+
+
+class TracedRatingFactorRepository(AbstractRatingFactorRepository):
+    """Calls the lookup hooks around each factor one rating step looks up from a repository"""
+
+    def __init__(self, repository: AbstractRatingFactorRepository, rating_step, before: List[Callable],
+                 after: List[Callable]):
+        super().__init__()
+        self.repository = repository
+        self.rating_step = rating_step
+        self.before = before
+        self.after = after
+
+    def lookup(self, rating_factor_type: str, params: dict, options=None):
+        return self.traced(self.repository.lookup, rating_factor_type, params, options)
+
+    def get_factor(self, rating_factor_type: str, params: dict, options=None):
+        return self.traced(self.repository.get_factor, rating_factor_type, params, options)
+
+    def interpolate(self, rating_factor_type: str, params: dict, interpolate_column: str) -> float:
+        return self.traced(self.repository.interpolate, rating_factor_type, params, interpolate_column)
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    def traced(self, method: Callable, rating_factor_type: str, params: dict, *args):
+        for hook in self.before:
+            hook(self.rating_step, rating_factor_type, params)
+        try:
+            result = method(rating_factor_type, params, *args)
+        except Exception as error:
+            for hook in self.after:
+                hook(self.rating_step, rating_factor_type, params, None, error)
+            raise
+        for hook in self.after:
+            hook(self.rating_step, rating_factor_type, params, result)
+        return result
+
+
+class JsonLinesSpanExporter(TraceSubscriber):
+    """Writes a span for each rating, step, factor lookup, loop iteration and (given an engine to `trace_sql`) SQL
+    statement to a file, one JSON object per line. Each is a complete event in the Chrome trace event format, and
+    spans on the same thread nest by time (manual, step, lookup, SQL), so wrapping the lines in `[` and `]` (with
+    commas between) gives a file chrome://tracing or Perfetto can show."""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = os.getpid()
+        self.origin = perf_counter()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def open_span(self, args: dict = None):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append((perf_counter(), args))
+
+    def close_span(self, name: str, category: str, args: dict, error: Exception = None):
+        end = perf_counter()
+        start, opening_args = self.local.stack.pop()
+        if opening_args:
+            args = dict(opening_args, **args)
+        if error is not None:
+            args['error'] = repr(error)
+        span = {
+            'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+            'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'args': args,
+        }
+        line = json.dumps(span, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def before_rating(self, rating_manual, rating_variables: dict):
+        self.open_span()
+
+    def after_rating(self, rating_manual, rating_variables: dict, error: Exception = None):
+        self.close_span(rating_manual.name, 'manual', {'id': rating_manual.id, 'version': rating_manual.version}, error)
+
+    def before_step(self, rating_step):
+        self.open_span()
+
+    def after_step(self, rating_step, error: Exception = None):
+        self.close_span(str(rating_step) or type(rating_step).__name__, 'step',
+                        {'target': getattr(rating_step, 'target', None)}, error)
+
+    def before_lookup(self, rating_step, rating_factor_type: str, params: dict):
+        # the repository may change the params it's given
+        self.open_span({'params': dict(params)})
+
+    def after_lookup(self, rating_step, rating_factor_type: str, params: dict, result=None, error: Exception = None):
+        self.close_span(rating_factor_type, 'lookup', {'result': result}, error)
+
+    def loop_iteration_start(self, rating_step, index: int):
+        self.open_span()
+
+    def loop_iteration_end(self, rating_step, index: int, error: Exception = None):
+        self.close_span('%s [%d]' % (rating_step.sub_risk_label.value, index), 'iteration', {'index': index}, error)
+
+    def trace_sql(self, engine):
+        """Also write a span for each SQL statement run on the given SQLAlchemy engine"""
+        from sqlalchemy import event
+
+        # each statement's context notes the exporters which opened a span for it, so that an error raised before
+        # any was opened (e.g. on connecting) doesn't close someone else's
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self.open_span()
+            context.__dict__.setdefault('traced_by', set()).add(self)
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context.traced_by.discard(self)
+            self.close_span('SQL', 'sql', {'statement': statement, 'parameters': parameters})
+
+        def handle_error(exception_context):
+            context = exception_context.execution_context
+            if context is None or self not in getattr(context, 'traced_by', ()):
+                return
+            context.traced_by.discard(self)
+            self.close_span('SQL', 'sql', {'statement': exception_context.statement},
+                            exception_context.original_exception)
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'handle_error', handle_error)
@@ -1,27 +1,105 @@
 import os
 import sys
 from .domain.rater import Rater
+from .domain.rating_manual import RatingManual
+from .domain.rating_result import RatingResult
+from .domain.result_cache import ResultCache
+from .domain import codegen
 from .repository import rating_manual_repository
+from .repository.compiled_code_repository import AbstractCompiledCodeRepository, CompiledCodeRepository
 from aspire.app.database.engine import ConnectionManager
 
 
-def rate(rating_manual_id, rating_manual_repository, rating_inputs, report_detail=False):
+def rate(rating_manual_id, rating_manual_repository, rating_inputs, report_detail=False,
+         result_cache: ResultCache = None, raters: dict = None):
+    """Rate inputs against a manual. Given a `result_cache`, a rate already calculated for the same inputs to the
+    manual's current version is returned without loading the manual. Given `raters` (shared between calls, as for
+    `get_rater`), the manual is compiled once per version; otherwise its steps are run one by one, which costs less
+    than compiling it for a single rating."""
+    if result_cache is not None and not report_detail:
+        version = rating_manual_repository.get_version(rating_manual_id)
+        key = result_cache.key(rating_manual_id, version, rating_inputs)
+        # a miss is counted once the manual is loaded
+        result = result_cache.get(key, count_miss=False) if key is not None else None
+        if result is not None:
+            return result.rate
+
+    if raters is not None:
+        rater = get_rater(rating_manual_id, rating_manual_repository, raters, result_cache)
+        return rate_with_rater(rater, rating_inputs, report_detail)
+
     rating_manual = rating_manual_repository.get(rating_manual_id)
+    if report_detail:
+        # step detail is recorded as a compiled manual runs
+        return rate_with_rater(Rater(rating_manual), rating_inputs, report_detail)
+    return rate_once(rating_manual, rating_inputs, result_cache)
+
+
+def rate_once(rating_manual: RatingManual, rating_inputs, result_cache: ResultCache = None):
+    """Rate inputs by running each of a manual's steps in turn, without compiling it"""
+    key = None
+    if result_cache is not None:
+        key = result_cache.key(rating_manual.id, rating_manual.version, rating_inputs, rating_manual)
+        result = result_cache.get(key)
+        if result is not None:
+            return result.rate
+
+    try:
+        for rating_step in rating_manual.rating_steps:
+            rating_step.run(rating_inputs)
+        rate = rating_inputs['rate']
+    except:
+        return unexpected_error()
+
+    if key is not None:
+        result_cache.put(key, RatingResult(rating_inputs))
+    return rate
+
 
-    rater = Rater(rating_manual)
+def rate_with_rater(rater: Rater, rating_inputs, report_detail=False):
     try:
-        rate_result = rater.rate(rating_inputs, report_detail)
+        rate = rater.rate(rating_inputs, report_detail)
     except:
-        import traceback
-        traceback.print_tb(sys.exc_info()[2])
-        return "Unexpected error:", sys.exc_info()[0]
+        return unexpected_error()
 
     if report_detail:
         return rater.get_step_by_step_diff()
-    return rate_result
+    return rate
 
 
-def rate_from_csv(rating_manual_id, file_path):
+def unexpected_error():
+    import traceback
+    traceback.print_tb(sys.exc_info()[2])
+    return "Unexpected error:", sys.exc_info()[0]
+
+
+def get_rater(rating_manual_id, rating_manual_repository, raters: dict, result_cache: ResultCache = None) -> Rater:
+    """Get a rater for the current version of a manual from `raters`, which is shared between requests. The manual is
+    only loaded and compiled again when its version changes, which it does whenever it or any of its parts are saved
+    changed."""
+    version = rating_manual_repository.get_version(rating_manual_id)
+    cached = raters.get(rating_manual_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    rater = Rater(rating_manual_repository.get(rating_manual_id), result_cache=result_cache)
+    raters[rating_manual_id] = (version, rater)
+    return rater
+
+
+def get_rate_function(rating_manual_id, rating_manual_repository, code_repository: AbstractCompiledCodeRepository):
+    """Get a generated rating function for a manual. When the manual's current version has already been compiled,
+    the cached code is used and neither the manual nor its steps are loaded from the database."""
+    version = rating_manual_repository.get_version(rating_manual_id)
+    code = code_repository.get(rating_manual_id, version)
+    if code is None:
+        code = codegen.compile_rating_manual(rating_manual_repository.get(rating_manual_id))
+        code_repository.store(rating_manual_id, version, code)
+
+    return codegen.load_rate_function(code, rating_manual_repository.get_rating_factor_repository(rating_manual_id))
+
+
+def rate_from_csv(rating_manual_id, file_path, code_cache_dir=None):
     import csv
 
     if not os.path.isfile(file_path):
@@ -32,15 +110,23 @@ def rate_from_csv(rating_manual_id, file_path):
         rows = [row for row in reader]
 
     session = ConnectionManager().get_session()
-    repository = rating_manual_repository.RatingManualRepository(session)
+    repository = rating_manual_repository.RatingManualRepository(session, cache_factors=True)
 
     if not rows or len(rows) == 0:
         raise Exception("No Data To Process!")
 
+    if code_cache_dir is not None:
+        rate_function = get_rate_function(rating_manual_id, repository, CompiledCodeRepository(code_cache_dir))
+        rate_row = lambda row_inputs: rate_function(row_inputs)['rate']
+    else:
+        # rows share their lookups' factors
+        rater = Rater(repository.get(rating_manual_id), memo_size=4096)
+        rate_row = lambda row_inputs: rate_with_rater(rater, row_inputs)
+
     keys = {}
     for i, row in enumerate(rows):
         print("Processing Row #" + str(i))
-        row['rate'] = rate(rating_manual_id, repository, row.copy())
+        row['rate'] = rate_row(row.copy())
         if i == 1:
             keys = row.keys()
 
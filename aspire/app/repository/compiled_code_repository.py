@@ -0,0 +1,56 @@
+import marshal
+import os
+import sys
+from abc import ABC, abstractmethod
+from types import CodeType
+from aspire.app.domain.codegen import GENERATOR_FINGERPRINT
+
+
+class AbstractCompiledCodeRepository(ABC):
+    def __init__(self):
+        pass
+
+    @abstractmethod
+    def get(self, rating_manual_id, version):
+        pass
+
+    @abstractmethod
+    def store(self, rating_manual_id, version, code: CodeType):
+        pass
+
+
+class CompiledCodeRepository(AbstractCompiledCodeRepository):
+    """Stores the generated code for rating manuals on disk (via marshal), keyed by manual id and version, which
+    changes whenever the manual does. Files are also keyed by the interpreter's cache tag, since marshalled bytecode is
+    only readable by the same Python version, and by a fingerprint of the code generator, so that code generated
+    differently before an upgrade isn't run after it."""
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+
+    def path(self, rating_manual_id, version):
+        filename = 'rating_manual_%s_v%s.%s.%s.marshal' % (rating_manual_id, version, GENERATOR_FINGERPRINT,
+                                                           sys.implementation.cache_tag)
+        return os.path.join(self.directory, filename)
+
+    def get(self, rating_manual_id, version):
+        path = self.path(rating_manual_id, version)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as f:
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return None
+
+    def store(self, rating_manual_id, version, code: CodeType):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(rating_manual_id, version)
+
+        # write to a temporary file first so that concurrently starting workers never read a partial file
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            marshal.dump(code, f)
+        os.replace(temp_path, path)
@@ -1,10 +1,23 @@
+import threading
 from abc import ABC, abstractmethod
-from sqlalchemy import asc, desc
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from typing import Dict, List
+from sqlalchemy import asc, desc, column, text, Integer, Numeric
+from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy.orm import session
 from aspire.app.database.models import RatingFactor as RatingFactorModel, get_custom_rating_factors_model
 
 
+class RatingFactorsNotFound(Exception):
+    """A lookup names a custom rating factors table, or a column, which doesn't exist"""
+
+
 class AbstractRatingFactorRepository(ABC):
+    # whether each lookup is a round trip to the database, so that making many at once is worth the while
+    batches_lookups = False
+
     def __init__(self):
         pass
 
@@ -16,8 +29,65 @@ class AbstractRatingFactorRepository(ABC):
     def get_factor(self, rating_factor_type: str, params: dict, options=None):
         pass
 
+    def get_factors_many(self, rating_factor_type: str, params_list: List[dict], options=None) -> list:
+        """Get the factor for each of a list of params (or None, where there's none), as `get_factor` would"""
+        return [self.get_factor(rating_factor_type, dict(params), options) for params in params_list]
+
+    def lookup_many(self, rating_factor_type: str, params_list: List[dict], options=None) -> list:
+        return [self.lookup(rating_factor_type, dict(params), options) for params in params_list]
+
+    def get_factors_batch(self, lookups: List[tuple]) -> list:
+        """Get the factor for each of a list of (type, params, options) lookups (or None, where there's none), as
+        `get_factor` would"""
+        return [self.get_factor(rating_factor_type, dict(params), options)
+                for rating_factor_type, params, options in lookups]
+
+    def interpolate(self, rating_factor_type: str, params: dict, interpolate_column: str) -> float:
+        """Interpolate linearly between the factors either side of the interpolated column's value, among those
+        matching the other params"""
+        x = params[interpolate_column]
+        lower = self.get_factor(rating_factor_type, params.copy(), {"step_down": interpolate_column})
+        if lower is None:
+            raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
+        upper = self.get_factor(rating_factor_type, params.copy(), {"step_up": interpolate_column})
+        return interpolate_between(rating_factor_type, x, lower, upper, interpolate_column)
+
+    def interpolate_many(self, rating_factor_type: str, params: dict, interpolate_column: str, xs) -> list:
+        """Interpolate each of a sequence of values of the interpolated column, all matching the same other params"""
+        distinct = list(dict.fromkeys(xs))
+        params_list = [dict(params, **{interpolate_column: x}) for x in distinct]
+        lowers = self.get_factors_many(rating_factor_type, params_list, {"step_down": interpolate_column})
+        uppers = self.get_factors_many(rating_factor_type, params_list, {"step_up": interpolate_column})
+
+        results = {}
+        for x, lower, upper in zip(distinct, lowers, uppers):
+            if lower is None:
+                raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
+            results[x] = interpolate_between(rating_factor_type, x, lower, upper, interpolate_column)
+        return [results[x] for x in xs]
+
+
+def interpolate_between(rating_factor_type: str, x, lower, upper, interpolate_column: str) -> float:
+    """Interpolate linearly between the factors either side of a value"""
+    if upper is None:
+        raise Exception("Interpolation Lookup failed to find upper value for %s!" % rating_factor_type)
+
+    x = float(x)
+    x0 = float(getattr(lower, interpolate_column))
+    x1 = float(getattr(upper, interpolate_column))
+    y0 = float(lower.value)
+    y1 = float(upper.value)
+
+    if x == x0:
+        return y0
+    if x == x1:
+        return y1
+    return y0 + ((y1 - y0) / (x1 - x0) * (x - x0))
+
 
 class RatingFactorRepository(AbstractRatingFactorRepository):
+    batches_lookups = True
+
     def __init__(self, rating_manual_id, db_session: session):
         super().__init__()
         self.rating_manual_id = rating_manual_id
@@ -32,7 +102,7 @@ class RatingFactorRepository(AbstractRatingFactorRepository):
 
         if "table" in options.keys():
             custom_model = True
-            rating_factor_model = get_custom_rating_factors_model(options['table'], self.db_session.get_bind())
+            rating_factor_model = custom_rating_factors_model(options['table'], self.db_session.get_bind())
         else:
             custom_model = False
             rating_factor_model = RatingFactorModel
@@ -61,3 +131,350 @@ class RatingFactorRepository(AbstractRatingFactorRepository):
 
         result = query.filter_by(**params).first()
         return result  # Todo hydrate into something other than a RatingFactorModel - this should be a domain entity
+
+    def lookup_many(self, rating_factor_type: str, params_list: List[dict], options: dict = None) -> list:
+        return [result.value for result in self.get_factors_many(rating_factor_type, params_list, options)]
+
+    def get_factors_many(self, rating_factor_type: str, params_list: List[dict], options: dict = None) -> list:
+        """Get the factor for each of a list of params in one query (per `max_lookups_per_query` distinct params), as
+        `get_factors_batch` does"""
+        return self.get_factors_batch([(rating_factor_type, params, options) for params in params_list])
+
+    def get_factors_batch(self, lookups: List[tuple]) -> list:
+        """Get the factor for each of a list of (type, params, options) lookups in one query per table (and per
+        `max_lookups_per_query` distinct lookups): a union of the query `get_factor` would make for each, so each finds
+        just the same factor. Factors are rows rather than models."""
+        keys = []
+        tables = {}
+        for rating_factor_type, params, options in lookups:
+            options = {} if not options else options
+            key = (rating_factor_type, tuple(sorted(params.items())), tuple(sorted(options.items())))
+            keys.append(key)
+            tables.setdefault(options.get('table'), {})[key] = None
+
+        results = {}
+        for table_name, distinct in tables.items():
+            if table_name is not None:
+                table = custom_rating_factors_model(table_name, self.db_session.get_bind()).__table__
+            else:
+                table = RatingFactorModel.__table__
+
+            distinct = list(distinct)
+            for start in range(0, len(distinct), self.max_lookups_per_query):
+                chunk = distinct[start:start + self.max_lookups_per_query]
+                bind_params = {'rating_manual_id': self.rating_manual_id}
+                selects = [self.select_factor(table, rating_factor_type, dict(params), dict(options), start + i,
+                                              bind_params)
+                           for i, (rating_factor_type, params, options) in enumerate(chunk)]
+                # the statement is written out, as building it as an expression takes longer than running it
+                query = text(' UNION ALL '.join(selects)).columns(column('lookup_index', Integer), *table.columns)
+                for row in self.db_session.execute(query, bind_params):
+                    results[distinct[row.lookup_index]] = row
+        return [results.get(key) for key in keys]
+
+    # SQLite allows at most 500 selects in a union, and older versions just 999 parameters in a query
+    max_lookups_per_query = 100
+
+    def select_factor(self, table, rating_factor_type: str, params: dict, options: dict, lookup_index: int,
+                      bind_params: dict) -> str:
+        """The SQL for one lookup within a union, adding its parameters to those given"""
+        quote = self.db_session.get_bind().dialect.identifier_preparer.quote
+        conditions = []
+        if "table" not in options.keys():
+            bind_params['p%d_type' % lookup_index] = rating_factor_type
+            conditions += ['rating_manual_id = :rating_manual_id', 'type = :p%d_type' % lookup_index]
+
+        order_by = ''
+        for option, comparison, direction in [('step_up', '>=', 'ASC'), ('step_down', '<=', 'DESC')]:
+            if option in options.keys():
+                col_to_step = factor_column(table, options[option])
+                name = 'p%d_step' % lookup_index
+                bind_params[name] = params.pop(options[option])
+                conditions.append('%s %s :%s' % (quote(col_to_step.name), comparison, name))
+                order_by = ' ORDER BY %s %s' % (quote(col_to_step.name), direction)
+                break
+
+        for i, (name, value) in enumerate(params.items()):
+            factor_column_name = quote(factor_column(table, name).name)
+            if value is None:
+                conditions.append('%s IS NULL' % factor_column_name)
+            else:
+                bind_params['p%d_%d' % (lookup_index, i)] = value
+                conditions.append('%s = :p%d_%d' % (factor_column_name, lookup_index, i))
+
+        columns = ', '.join('factor.%s' % quote(table_column.name) for table_column in table.columns)
+        return 'SELECT %d AS lookup_index, %s FROM (SELECT * FROM %s%s%s LIMIT 1) AS factor' % (
+            lookup_index, columns, quote(table.name), ' WHERE ' + ' AND '.join(conditions) if conditions else '',
+            order_by
+        )
+
+
+def factor_column(table, name: str):
+    if name not in table.c:
+        raise RatingFactorsNotFound("Rating factors have no column '%s'" % name)
+    return table.c[name]
+
+
+def custom_rating_factors_model(table_name: str, engine):
+    try:
+        return get_custom_rating_factors_model(table_name, engine)
+    except NoSuchTableError:
+        raise RatingFactorsNotFound("Rating factors have no table '%s'" % table_name)
+
+
+# a parameter which no value in its column can equal, e.g. text where the column is numeric
+UNMATCHABLE = object()
+
+
+class IndexedRatingFactorRepository(AbstractRatingFactorRepository):
+    """Looks factors up in memory, having loaded all of a manual's rating factors at once (on the first lookup),
+    finding the same factor a `RatingFactorRepository` would. Factors are grouped by type, then indexed as they're
+    first looked up by a combination of columns (see FactorIndex). Each custom table is loaded and indexed the same
+    way on its first lookup, unless `custom_tables` is False, when lookups in them go to the database.
+
+    Factors changed in the database after they're loaded aren't seen, so it should be replaced along with the manual
+    whenever the manual's version changes: as it does when factors are saved through the ORM, or when
+    `RatingManualRepository.increment_version` is called after changing them (or a custom table) any other way."""
+
+    def __init__(self, rating_manual_id, db_session: session, custom_tables: bool = True):
+        super().__init__()
+        self.rating_manual_id = rating_manual_id
+        self.db_session = db_session
+        self.custom_tables = custom_tables
+        self.repository = RatingFactorRepository(rating_manual_id, db_session)
+        self.factors = None  # type: Dict[str, FactorIndex]
+        self.tables = {}  # type: Dict[str, FactorIndex]
+        self.lock = threading.Lock()
+
+    def lookup(self, rating_factor_type: str, params: dict, options: dict = None):
+        result = self.get_factor(rating_factor_type, params, options)
+        return result.value
+
+    def get_factor(self, rating_factor_type: str, params: dict, options: dict = None):
+        options = {} if not options else options
+
+        if "table" in options.keys():
+            if not self.custom_tables:
+                return self.repository.get_factor(rating_factor_type, params, options)
+            index = self.table_index(options['table'])
+        else:
+            index = self.type_index(rating_factor_type)
+
+        if "step_up" in options.keys():
+            return index.step(params, options['step_up'], True)
+        if "step_down" in options.keys():
+            return index.step(params, options['step_down'], False)
+        return index.exact(params)
+
+    def interpolate(self, rating_factor_type: str, params: dict, interpolate_column: str) -> float:
+        curve = self.type_index(rating_factor_type).curve(params, interpolate_column)
+        if curve is None:
+            return super().interpolate(rating_factor_type, params, interpolate_column)
+        return curve.interpolate(self.interpolation_key(rating_factor_type, interpolate_column,
+                                                        params[interpolate_column]), rating_factor_type)
+
+    def interpolate_many(self, rating_factor_type: str, params: dict, interpolate_column: str, xs) -> list:
+        curve = self.type_index(rating_factor_type).curve(params, interpolate_column)
+        if curve is None:
+            return super().interpolate_many(rating_factor_type, params, interpolate_column, xs)
+        return curve.interpolate_many([self.interpolation_key(rating_factor_type, interpolate_column, x) for x in xs],
+                                      rating_factor_type)
+
+    def interpolation_key(self, rating_factor_type: str, interpolate_column: str, x):
+        x = self.type_index(rating_factor_type).key(interpolate_column, x)
+        # text sorts after any number, as SQLite sorts them
+        return float('inf') if x is UNMATCHABLE else x
+
+    def load(self) -> Dict[str, 'FactorIndex']:
+        with self.lock:
+            if self.factors is None:
+                factors = {}
+                query = self.db_session.query(*RatingFactorModel.__table__.columns) \
+                    .filter(RatingFactorModel.rating_manual_id == self.rating_manual_id) \
+                    .order_by(RatingFactorModel.id)
+                for factor in query:
+                    factors.setdefault(factor.type, []).append(factor)
+                self.factors = {rating_factor_type: FactorIndex(RatingFactorModel.__table__, type_factors)
+                                for rating_factor_type, type_factors in factors.items()}
+        return self.factors
+
+    def type_index(self, rating_factor_type: str) -> 'FactorIndex':
+        factors = self.factors if self.factors is not None else self.load()
+        index = factors.get(rating_factor_type)
+        if index is None:
+            # no factors of the type, so that every lookup finds nothing
+            index = factors[rating_factor_type] = FactorIndex(RatingFactorModel.__table__, [])
+        return index
+
+    def table_index(self, table_name: str) -> 'FactorIndex':
+        index = self.tables.get(table_name)
+        if index is None:
+            with self.lock:
+                index = self.tables.get(table_name)
+                if index is None:
+                    table = custom_rating_factors_model(table_name, self.db_session.get_bind()).__table__
+                    # in the order the database finds them in, as near as can be
+                    query = self.db_session.query(*table.columns).order_by(*table.primary_key.columns)
+                    index = self.tables[table_name] = FactorIndex(table, query.all())
+        return index
+
+
+class FactorIndex(object):
+    """Factors (rows of a table) held in memory, indexed as they're first looked up by a combination of columns:
+    exact matches by hash, and stepping up or down by bisecting the factors sorted by the stepped column, so as to
+    find the same factor the database would"""
+
+    def __init__(self, table, factors: list):
+        self.factors = factors
+        self.columns = {column.name for column in table.columns}
+        self.numeric_columns = {column.name for column in table.columns if isinstance(column.type, (Integer, Numeric))}
+        self.indexes = {}
+
+    def exact(self, params: dict):
+        columns = tuple(sorted(params))
+        key = tuple(self.key(column, params[column]) for column in columns)
+        if UNMATCHABLE in key:
+            return None
+        return self.exact_index(columns).get(key)
+
+    def step(self, params: dict, col_to_step: str, step_up: bool):
+        target = params.pop(col_to_step)
+        columns = tuple(sorted(params))
+        key = tuple(self.key(column, params[column]) for column in columns)
+        if UNMATCHABLE in key:
+            return None
+
+        target = self.key(col_to_step, target)
+        if target is UNMATCHABLE:
+            # text sorts after any number, as SQLite sorts them
+            target = float('inf')
+        steps = self.step_index(columns, col_to_step).get(key)
+        if steps is None or target is None:
+            return None
+
+        values, factors = steps
+        if step_up:
+            i = bisect_left(values, target)
+            return factors[i] if i < len(values) else None
+
+        i = bisect_right(values, target)
+        # the first of any factors with the same value, as when stepping up
+        return factors[bisect_left(values, values[i - 1])] if i > 0 else None
+
+    def curve(self, params: dict, interpolate_column: str):
+        """The piecewise-linear function of the interpolated column which the factors matching the other params make
+        up, or None where it can't be made, e.g. as a factor's value isn't a number"""
+        columns = tuple(sorted(column for column in params if column != interpolate_column))
+        key = tuple(self.key(column, params[column]) for column in columns)
+        curves = self.indexes.get((columns, interpolate_column, PiecewiseLinear))
+        if curves is None:
+            curves = self.indexes[(columns, interpolate_column, PiecewiseLinear)] = {}
+
+        if key not in curves:
+            steps = self.step_index(columns, interpolate_column).get(key) if UNMATCHABLE not in key else None
+            curves[key] = PiecewiseLinear.from_factors(*steps) if steps is not None else PiecewiseLinear([], [])
+        return curves[key]
+
+    def key(self, column: str, value):
+        """A value as it compares with those in a column, as the database would compare them"""
+        if column not in self.columns:
+            raise RatingFactorsNotFound("Rating factors have no column '%s'" % column)
+        if value is None:
+            return None
+        if column in self.numeric_columns:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return UNMATCHABLE
+        return value if isinstance(value, str) else str(value)
+
+    def exact_index(self, columns: tuple) -> dict:
+        """The first factor (by id) for each combination of values in the given columns"""
+        index = self.indexes.get(columns)
+        if index is None:
+            index = {}
+            for factor in self.factors:
+                index.setdefault(tuple(self.key(column, getattr(factor, column)) for column in columns), factor)
+            self.indexes[columns] = index
+        return index
+
+    def step_index(self, columns: tuple, col_to_step: str) -> dict:
+        """The factors for each combination of values in the given columns, sorted by the stepped column's value (then
+        by id), along with those values"""
+        index = self.indexes.get((columns, col_to_step))
+        if index is None:
+            groups = {}
+            for factor in self.factors:
+                value = self.key(col_to_step, getattr(factor, col_to_step))
+                if value is not None:
+                    key = tuple(self.key(column, getattr(factor, column)) for column in columns)
+                    groups.setdefault(key, []).append((value, factor))
+
+            index = {}
+            for key, group in groups.items():
+                group.sort(key=itemgetter(0))
+                index[key] = ([value for value, factor in group], [factor for value, factor in group])
+            self.indexes[(columns, col_to_step)] = index
+        return index
+
+
+class PiecewiseLinear(object):
+    """Factors as a piecewise-linear function of one column: its values (x) as sorted breakpoints, with the factors'
+    values (y) and the slopes between them, all as arrays of floats. The same value is found by one bisection as by
+    looking up the factors either side of it."""
+
+    def __init__(self, xs: List[float], ys: List[float]):
+        self.xs = array('d', xs)
+        self.ys = array('d', ys)
+        self.slopes = array('d', [(ys[i + 1] - ys[i]) / (xs[i + 1] - xs[i]) for i in range(len(xs) - 1)])
+
+    @classmethod
+    def from_factors(cls, values: List[float], factors: list):
+        """From factors sorted by their values in the interpolated column, taking the first of any with the same
+        value, or None if any factor's value isn't a number"""
+        xs, ys = [], []
+        for x, factor in zip(values, factors):
+            if not xs or x != xs[-1]:
+                try:
+                    ys.append(float(factor.value))
+                except (TypeError, ValueError):
+                    return None
+                xs.append(x)
+        return cls(xs, ys)
+
+    def interpolate(self, x: float, rating_factor_type: str = None) -> float:
+        if x is None or not self.xs or x < self.xs[0]:
+            raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
+
+        i = bisect_right(self.xs, x) - 1
+        if x == self.xs[i]:
+            return self.ys[i]
+        if i == len(self.slopes):
+            raise Exception("Interpolation Lookup failed to find upper value for %s!" % rating_factor_type)
+        return self.ys[i] + self.slopes[i] * (x - self.xs[i])
+
+    def interpolate_many(self, xs, rating_factor_type: str = None):
+        """Interpolate a sequence of values at once, as an array"""
+        import numpy as np
+
+        if any(x is None for x in xs):
+            raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
+        xs = np.asarray(xs, dtype=np.float64)
+        if not len(xs):
+            return xs
+
+        breakpoints = np.asarray(self.xs, dtype=np.float64)
+        i = np.searchsorted(breakpoints, xs, side='right') - 1
+        if (i < 0).any():
+            raise Exception("Interpolation Lookup failed to find lower value for %s!" % rating_factor_type)
+
+        exact = breakpoints[i] == xs
+        if (~exact & (i == len(self.slopes))).any():
+            raise Exception("Interpolation Lookup failed to find upper value for %s!" % rating_factor_type)
+
+        ys = np.asarray(self.ys, dtype=np.float64)
+        if not len(self.slopes):
+            return ys[i]
+        slopes = np.asarray(self.slopes, dtype=np.float64)
+        between = np.minimum(i, len(self.slopes) - 1)
+        return np.where(exact, ys[i], ys[i] + slopes[between] * (xs - breakpoints[i]))
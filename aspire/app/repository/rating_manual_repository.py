@@ -27,10 +27,14 @@ class AbstractRatingManualRepository(ABC):
 
 
 class RatingManualRepository(AbstractRatingManualRepository):
+    """Loads manuals from the database. With `cache_factors`, each manual's steps share an index of its rating factors
+    in memory, loaded on its first lookup, rather than querying the database for each one. The index lasts as long as
+    the manual it's loaded with, which should be replaced when the manual's version changes."""
 
-    def __init__(self, db_session):
+    def __init__(self, db_session, cache_factors: bool = False):
         super().__init__()
         self.db_session = db_session
+        self.cache_factors = cache_factors
 
     def get(self, rating_manual_id):
         rating_step_alias = aliased(RatingStepModel)
@@ -43,12 +47,31 @@ class RatingManualRepository(AbstractRatingManualRepository):
             outerjoin(RatingManualModel.rating_variables).\
             one()
 
-        rating_steps = [self.factory_rating_step(rs, rating_manual_id) for rs in manual.rating_steps]
+        # every step shares the one repository (so lookups can be batched across steps), and when factors are cached,
+        # the one index of them
+        factor_repository = self.get_rating_factor_repository(rating_manual_id)
+        rating_steps = [self.factory_rating_step(rs, rating_manual_id, factor_repository)
+                        for rs in manual.rating_steps]
         rating_variables = [factory_rating_variable(rv) for rv in manual.rating_variables]
 
-        rating_manual = RatingManual(manual.name, manual.description, rating_steps, rating_variables)
+        rating_manual = RatingManual(manual.name, manual.description, rating_steps, rating_variables,
+                                     id=manual.id, version=manual.version)
         return rating_manual
 
+    def get_version(self, rating_manual_id):
+        return self.db_session.query(RatingManualModel.version). \
+            filter(RatingManualModel.id == rating_manual_id). \
+            scalar()
+
+    def increment_version(self, rating_manual_id):
+        """Mark a manual as changed, so that whatever is cached for its current version (raters, their indexes of its
+        factors, compiled code and results) is replaced. Changes saved through the ORM do so already, but changes made
+        any other way, such as to a custom factor table, need this."""
+        self.db_session.query(RatingManualModel). \
+            filter(RatingManualModel.id == rating_manual_id). \
+            update({RatingManualModel.version: RatingManualModel.version + 1}, synchronize_session='evaluate')
+        self.db_session.commit()
+
     def list(self):
         manuals = [{"id": row.id, "name": row.name, "description": row.description}
                    for row in self.db_session.query(RatingManualModel).all()]
@@ -57,8 +80,17 @@ class RatingManualRepository(AbstractRatingManualRepository):
     def store(self, rating_manual_id=None):
         pass
 
-    def factory_rating_step(self, data: RatingStepModel, rating_manual_id: int):
+    def get_rating_factor_repository(self, rating_manual_id: int):
+        if self.cache_factors:
+            return rating_factor_repository.IndexedRatingFactorRepository(rating_manual_id, self.db_session)
+        return rating_factor_repository.RatingFactorRepository(rating_manual_id, self.db_session)
+
+    def factory_rating_step(self, data: RatingStepModel, rating_manual_id: int,
+                            factor_repository: rating_factor_repository.AbstractRatingFactorRepository = None):
         rating_step_type = rating_step.RatingStepType(data.rating_step_type_id)
+        if factor_repository is None and rating_step_type in (rating_step.RatingStepType.LOOKUP,
+                                                              rating_step.RatingStepType.LINEAR_INTERPOLATE):
+            factor_repository = self.get_rating_factor_repository(rating_manual_id)
 
         params = create_rating_step_parameters(data.rating_step_parameters)
         conditions = create_rating_step_conditions(data.conditions)
@@ -76,16 +108,12 @@ class RatingManualRepository(AbstractRatingManualRepository):
         elif rating_step_type == rating_step.RatingStepType.ROUND:
             step = rating_step.Round(data.target, params, conditions)
         elif rating_step_type == rating_step.RatingStepType.LOOKUP:
-            step = rating_step.Lookup(data.target, params,
-                                      rating_factor_repository.RatingFactorRepository(rating_manual_id, self.db_session),
-                                      conditions)
+            step = rating_step.Lookup(data.target, params, factor_repository, conditions)
         elif rating_step_type == rating_step.RatingStepType.LINEAR_INTERPOLATE:
-            step = rating_step.LinearInterpolate(data.target, params,
-                                                 rating_factor_repository.RatingFactorRepository(rating_manual_id,
-                                                                                                 self.db_session),
-                                                 conditions)
+            step = rating_step.LinearInterpolate(data.target, params, factor_repository, conditions)
         elif rating_step_type == rating_step.RatingStepType.LOOP:
-            loop_rating_steps = [self.factory_rating_step(rs, rating_manual_id) for rs in data.loop_rating_steps]
+            loop_rating_steps = [self.factory_rating_step(rs, rating_manual_id, factor_repository)
+                                 for rs in data.loop_rating_steps]
             step = rating_step.Loop(params, loop_rating_steps, conditions)
         elif rating_step_type == rating_step.RatingStepType.SUB_RISK_SUM:
             step = rating_step.SubRiskSum(data.target, params, conditions)
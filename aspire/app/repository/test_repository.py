@@ -5,6 +5,7 @@ from aspire.app.database.models import RatingFactor as RatingFactorModel, \
     RatingStepParameter as RatingStepParameterModel, \
     RatingVariable as RatingVariableModel
 from aspire.app.repository import rating_factor_repository
+from aspire.app.repository.compiled_code_repository import CompiledCodeRepository
 from aspire.app.repository.rating_manual_repository import RatingManualRepository, parse_structured_conditions
 from aspire.app.database.engine import setup_test_db_session
 from aspire.app.domain.rating_step import RatingStepType
@@ -282,3 +283,512 @@ def test_custom_rating_factor_table_lookup():
     assert result == '0.25'
     result = repository.lookup('test_factor', {'num_col_1': 1}, {'table': 'other_rating_factors'})
     assert result == '0.99'
+
+
+def test_compiled_code_repository(tmp_path):
+    session = setup_test_db_session()
+    manual_model = RatingManualModel(name='Test Manual')
+    session.add(manual_model)
+    session.commit()
+
+    repository = RatingManualRepository(session)
+    version = repository.get_version(manual_model.id)
+    assert version == 1
+    assert repository.get(manual_model.id).version == version
+
+    code_repository = CompiledCodeRepository(str(tmp_path))
+    assert code_repository.get(manual_model.id, version) is None
+
+    code = compile('result = 42', '<test>', 'exec')
+    code_repository.store(manual_model.id, version, code)
+    namespace = {}
+    exec(code_repository.get(manual_model.id, version), namespace)
+    assert namespace['result'] == 42
+    assert code_repository.get(manual_model.id, version + 1) is None
+
+
+def test_rating_manual_versions():
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.rating import get_rater
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session)
+    assert repository.get_version(2) == 1
+
+    def vehicles():
+        return {'vehicles': [{'vehicle_age': '5', 'primary_driver_age': '30'}]}
+
+    raters = {}
+    rater = get_rater(2, repository, raters)
+    assert get_rater(2, repository, raters) is rater
+    before = rater.rate(vehicles())
+
+    # a parameter of a step within a loop belongs to the manual through the loop
+    parameter = session.query(RatingStepParameterModel).filter(RatingStepParameterModel.value == '300').one()
+    assert parameter.rating_manual_id is None
+    parameter.value = '400'
+    session.commit()
+    assert repository.get_version(2) == 2 and repository.get_version(1) == 1
+
+    rater = get_rater(2, repository, raters)
+    assert rater.rating_manual.version == 2
+    assert float(rater.rate(vehicles())) > float(before)
+
+    session.query(RatingVariableModel).filter(RatingVariableModel.rating_manual_id == 1).first().description = 'edited'
+    session.add(RatingStepModel(rating_manual_id=1, name='Added', rating_step_type_id=RatingStepType.SET))
+    session.commit()
+    # once per flush, however many of its parts change
+    assert repository.get_version(1) == 2
+
+
+def test_compiled_code_follows_versions(tmp_path):
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.rating import get_rate_function
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session)
+    code_repository = CompiledCodeRepository(str(tmp_path))
+
+    def vehicles():
+        return {'vehicles': [{'vehicle_age': '5', 'primary_driver_age': '30'}]}
+
+    before = get_rate_function(2, repository, code_repository)(vehicles())['rate']
+    assert get_rate_function(2, repository, code_repository)(vehicles())['rate'] == before
+
+    session.query(RatingStepParameterModel).filter(RatingStepParameterModel.value == '300').one().value = '400'
+    session.commit()
+    assert code_repository.get(2, 2) is None
+    assert float(get_rate_function(2, repository, code_repository)(vehicles())['rate']) > float(before)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_single_ratings(monkeypatch):
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.domain.rater import Rater
+    from aspire.app.rating import rate
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session)
+    rate_inputs = {'vehicles': [{'vehicle_age': '5', 'primary_driver_age': '30'},
+                                {'vehicle_age': '12', 'primary_driver_age': '70'}]}
+    expected = Rater(repository.get(2)).rate(json.loads(json.dumps(rate_inputs)))
+
+    compiled = []
+    compile_manual = Rater.compile
+    monkeypatch.setattr(Rater, 'compile', staticmethod(lambda *args: compiled.append(1) or compile_manual(*args)))
+
+    # a single rating isn't worth compiling the manual for
+    assert rate(2, repository, json.loads(json.dumps(rate_inputs))) == expected
+    assert compiled == []
+
+    # unless it's kept for the next
+    raters = {}
+    for _ in range(3):
+        assert rate(2, repository, json.loads(json.dumps(rate_inputs)), raters=raters) == expected
+    assert compiled == [1]
+
+    # a manual which never sets a rate is reported as an error, whether or not it's compiled
+    from aspire.app.domain.rating_manual import RatingManual
+    from aspire.app.domain.rating_step import Set
+    from aspire.app.domain.rating_step_parameter import RatingStepParameter
+
+    class NoRateRepository(object):
+        def get(self, rating_manual_id):
+            return RatingManual('no rate', 'no rate', [
+                Set('other', [RatingStepParameter('one', '1', RatingStepParameterType.LITERAL)])
+            ], [])
+
+        def get_version(self, rating_manual_id):
+            return 1
+
+    assert rate(3, NoRateRepository(), {})[0] == "Unexpected error:"
+    assert rate(3, NoRateRepository(), {}, raters={})[0] == "Unexpected error:"
+
+
+def test_cached_rates():
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.domain.result_cache import ResultCache
+    from aspire.app.rating import rate
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session)
+    result_cache = ResultCache(max_size=2)
+
+    def vehicles(*ages):
+        return {'vehicles': [{'vehicle_age': age, 'primary_driver_age': '30'} for age in ages]}
+
+    first = rate(2, repository, vehicles('5', '10'), result_cache=result_cache)
+    assert result_cache.stats() == {'size': 1, 'max_size': 2, 'hits': 0, 'misses': 1}
+
+    # values which aren't declared inputs are ignored
+    repeat = vehicles('5', '10')
+    repeat['vehicles'][0]['notes'] = 'ignored'
+    repeat['quote_id'] = 'ignored'
+    assert rate(2, repository, repeat, result_cache=result_cache) == first
+    assert result_cache.hits == 1
+
+    rate(2, repository, vehicles('6'), result_cache=result_cache)
+    rate(2, repository, vehicles('7'), result_cache=result_cache)
+    assert result_cache.stats() == {'size': 2, 'max_size': 2, 'hits': 1, 'misses': 3}
+    rate(2, repository, vehicles('5', '10'), result_cache=result_cache)
+    assert result_cache.misses == 4
+
+    # editing any part of the manual replaces its cached results
+    session.query(RatingStepParameterModel).filter(RatingStepParameterModel.value == '300').one().value = '400'
+    session.commit()
+    assert float(rate(2, repository, vehicles('5', '10'), result_cache=result_cache)) > float(first)
+    assert result_cache.stats() == {'size': 1, 'max_size': 2, 'hits': 1, 'misses': 5}
+
+    result_cache.invalidate([2])
+    assert result_cache.stats()['size'] == 0
+
+    # changing inputs once they've been rated (in place) doesn't change the results cached for them
+    from aspire.app.domain.rater import Rater
+    for rate_with_cache in (lambda rate_inputs: rate(2, repository, rate_inputs, result_cache=result_cache),
+                            Rater(repository.get(2), result_cache=result_cache).rate):
+        result_cache.invalidate()
+        rate_inputs = vehicles('8')
+        expected = rate_with_cache(rate_inputs)
+        rate_inputs['rate'] = 'garbage'
+        rate_inputs['vehicles'][0]['vehicle_rate'] = 'garbage'
+        hits = result_cache.hits
+        assert rate_with_cache(vehicles('8')) == expected
+        assert result_cache.hits == hits + 1
+
+
+def test_synthetic_inputs(tmp_path):
+    import csv
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.domain.rater import Rater
+    from aspire.app.synthetic import InputGenerator
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session)
+    homeowners, auto = repository.get(1), repository.get(2)
+
+    rows = list(InputGenerator(homeowners, seed=1).rows(200))
+    assert rows == list(InputGenerator(homeowners, seed=1).rows(200))
+    assert all(1 <= int(row['territory']) <= 5 and row['deductible'] in ['250', '500', '1000', '5000'] and
+               row['new_home'] in ['yes', 'no'] and int(row['amount_of_insurance']) >= 80000 for row in rows)
+    rater = Rater(homeowners)
+    assert all(float(rater.rate(row)) > 0 for row in rows[:10])
+
+    generator = InputGenerator(auto, seed=2, sub_risk_counts={'vehicles': (2, 3)},
+                               distributions={'vehicle_age': {'1': 3, '20': 1}})
+    rows = list(generator.rows(100))
+    assert all(2 <= len(row['vehicles']) <= 3 for row in rows)
+    ages = [vehicle['vehicle_age'] for row in rows for vehicle in row['vehicles']]
+    assert set(ages) == {'1', '20'} and ages.count('1') > ages.count('20')
+    assert all(18 <= int(vehicle['primary_driver_age']) <= 100 for row in rows for vehicle in row['vehicles'])
+
+    generator.write_csv(str(tmp_path / 'auto.csv'), 10)
+    with open(str(tmp_path / 'auto.csv')) as csv_file:
+        written = list(csv.DictReader(csv_file))
+    assert len(written) == 10
+    assert 'vehicles[2]primary_driver_age' in written[0]
+
+    generator.write_json_lines(str(tmp_path / 'auto.jsonl'), 10)
+    assert len((tmp_path / 'auto.jsonl').read_text().splitlines()) == 10
+
+    # sub-risks looped over within another loop are nested in each of its sub-risks
+    from aspire.app.demo import seed_stress_manual
+    nested = repository.get(seed_stress_manual(session, steps=12, loop_depth=2, factor_tables=1, factor_rows=5,
+                                               zip_rows=0, territories=2))
+    generator = InputGenerator(nested, seed=3, sub_risk_counts={'level_1': (2, 2), 'level_2': (1, 3)})
+    rows = list(generator.rows(20))
+    assert not any('level_2' in row for row in rows)
+    assert all(len(row['level_1']) == 2 and all(1 <= len(level_1['level_2']) <= 3 and
+                                                'level_2_input_0' in level_1['level_2'][0] for level_1 in row['level_1'])
+               for row in rows)
+
+    generator.write_csv(str(tmp_path / 'nested.csv'), 5)
+    with open(str(tmp_path / 'nested.csv')) as csv_file:
+        written = list(csv.DictReader(csv_file))
+    assert 'level_1[1]level_2[2]level_2_input_0' in written[0] and 'level_2[0]level_2_input_0' not in written[0]
+
+
+def test_stress_manual():
+    import copy
+    from sqlalchemy import Text, inspect
+    from aspire.app.demo import seed_stress_manual
+    from aspire.app.domain.rater import Rater
+    from aspire.app.domain.rating_step import Loop
+    from aspire.app.synthetic import InputGenerator
+
+    session = setup_test_db_session()
+    rating_manual_id = seed_stress_manual(session, steps=60, condition_depth=6, loop_depth=2, factor_tables=3,
+                                          factor_rows=20, zip_rows=1000, territories=5)
+    assert session.query(RatingFactorModel).filter(RatingFactorModel.rating_manual_id == rating_manual_id).count() \
+        == 1000 + 5 + 3 * 20
+
+    rating_manual = RatingManualRepository(session).get(rating_manual_id)
+    outer = [rating_step for rating_step in rating_manual.rating_steps if isinstance(rating_step, Loop)]
+    assert len(outer) == 1
+    inner = [rating_step for rating_step in outer[0].rating_steps if isinstance(rating_step, Loop)]
+    assert len(inner) == 1 and len(inner[0].rating_steps) == 21
+    assert sum(rating_step.conditions is not None for rating_step in rating_manual.rating_steps) == 12
+    # conditions this deep are longer than the column used to allow
+    assert max(len(conditions) for conditions, in session.query(RatingStepModel.conditions)
+               .filter(RatingStepModel.rating_manual_id == rating_manual_id)
+               .filter(RatingStepModel.conditions.isnot(None))) > 512
+    columns = {column['name']: column['type'] for column in inspect(session.bind).get_columns('rating_steps')}
+    assert isinstance(columns['conditions'], Text)
+
+    rater = Rater(rating_manual)
+    for rate_inputs in InputGenerator(rating_manual, seed=3, sub_risk_counts=(1, 2)).rows(5):
+        assert all(level_1['level_2'] for level_1 in rate_inputs['level_1'])
+        interpreted = copy.deepcopy(rate_inputs)
+        for rating_step in rating_manual.rating_steps:
+            rating_step.run(interpreted)
+        assert rater.rate(rate_inputs) == interpreted['rate']
+
+    # the same seed gives the same manual
+    again = RatingManualRepository(session).get(seed_stress_manual(session, steps=60, condition_depth=6, loop_depth=2,
+                                                                   factor_tables=3, factor_rows=20, zip_rows=1000,
+                                                                   territories=5))
+    assert [str(rating_step) for rating_step in again.rating_steps] == \
+        [str(rating_step) for rating_step in rating_manual.rating_steps]
+
+    # with no steps but the rates of each level, a sub-risk's rate is 100 plus the sum of those within it
+    nested = RatingManualRepository(session).get(seed_stress_manual(session, steps=0, loop_depth=2, zip_rows=0,
+                                                                    territories=3))
+    territory_factors = {int(num_col_1): float(value) for num_col_1, value in session.query(
+        RatingFactorModel.num_col_1, RatingFactorModel.value
+    ).filter(RatingFactorModel.rating_manual_id == nested.id, RatingFactorModel.type == 'territory')}
+    rater = Rater(nested)
+    for territory, level_2_counts in [(1, [1]), (2, [3, 1]), (3, [2, 2, 4])]:
+        rate_inputs = {'territory': str(territory), 'level_1': [
+            {'level_2': [{} for _ in range(count)]} for count in level_2_counts
+        ]}
+        expected = 100 * territory_factors[territory] + sum(100 + 100 * count for count in level_2_counts)
+        assert float(rater.rate(rate_inputs)) == round(expected, 2)
+
+
+def test_indexed_rating_factor_repository():
+    session = setup_test_db_session()
+    session.add_all([
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=10, str_col_1='a', value='0.25'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=20, str_col_1='a', value='0.50'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=30, str_col_1='a', value='0.75'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=20, str_col_1='b', value='0.60'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=20, str_col_1='b', value='0.70'),
+        RatingFactorModel(rating_manual_id=1, type='codes', str_col_1='100', value='1.5'),
+        RatingFactorModel(rating_manual_id=2, type='test', num_col_1=20, str_col_1='a', value='0.99'),
+    ])
+    session.commit()
+
+    database = rating_factor_repository.RatingFactorRepository(1, session)
+    indexed = rating_factor_repository.IndexedRatingFactorRepository(1, session)
+    lookups = [
+        ('test', {'num_col_1': 20}, None),
+        ('test', {'num_col_1': '20', 'str_col_1': 'b'}, None),
+        ('test', {'num_col_1': '20.0', 'str_col_1': 'a'}, None),
+        ('test', {'num_col_1': 15, 'str_col_1': 'a'}, {'step_up': 'num_col_1'}),
+        ('test', {'num_col_1': '15', 'str_col_1': 'a'}, {'step_down': 'num_col_1'}),
+        ('test', {'num_col_1': 30}, {'step_down': 'num_col_1'}),
+        ('test', {'num_col_1': 31}, {'step_up': 'num_col_1'}),
+        ('test', {'num_col_1': 5}, {'step_down': 'num_col_1'}),
+        ('test', {'num_col_1': 'x'}, None),
+        ('test', {'str_col_1': 'c'}, None),
+        ('codes', {'str_col_1': 100}, None),
+        ('missing', {'num_col_1': 20}, None),
+    ]
+    for rating_factor_type, params, options in lookups:
+        expected = database.get_factor(rating_factor_type, dict(params), options)
+        result = indexed.get_factor(rating_factor_type, dict(params), options)
+        assert (result and result.value) == (expected and expected.value)
+    assert indexed.lookup('test', {'num_col_1': 20, 'str_col_1': 'b'}) == '0.60'
+
+    # a manual's steps share the one index, loaded on the first lookup
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.domain.rater import Rater
+    seed_demo_data(session)
+    rate_inputs = {'vehicles': [{'vehicle_age': '12', 'primary_driver_age': '30'},
+                                {'vehicle_age': '3', 'primary_driver_age': '70'}]}
+    manual = RatingManualRepository(session, cache_factors=True).get(2)
+    loop = manual.rating_steps[1]
+    assert loop.rating_steps[1].rating_factor_repository is loop.rating_steps[2].rating_factor_repository
+    assert Rater(manual).rate(json.loads(json.dumps(rate_inputs))) == \
+        Rater(RatingManualRepository(session).get(2)).rate(json.loads(json.dumps(rate_inputs)))
+
+
+def test_indexed_factors_follow_versions():
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.rating import get_rater
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    repository = RatingManualRepository(session, cache_factors=True)
+    rate_inputs = {'vehicles': [{'vehicle_age': '5', 'primary_driver_age': '30'}]}
+
+    raters = {}
+    before = get_rater(2, repository, raters).rate(json.loads(json.dumps(rate_inputs)))
+    for factor in session.query(RatingFactorModel).filter(RatingFactorModel.rating_manual_id == 2):
+        factor.value = str(float(factor.value) * 2)
+    session.commit()
+    assert float(get_rater(2, repository, raters).rate(json.loads(json.dumps(rate_inputs)))) > float(before)
+
+    # changes made outside the ORM are marked by hand
+    rater = get_rater(2, repository, raters)
+    repository.increment_version(2)
+    assert repository.get_version(2) == 3
+    assert get_rater(2, repository, raters) is not rater
+
+
+def test_indexed_interpolation():
+    session = setup_test_db_session()
+    session.add_all([
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=80000, str_col_1='A', value='0.56'),
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=95000, str_col_1='A', value='0.63'),
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=95000, str_col_1='A', value='9.99'),
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=110000, str_col_1='A', value='0.69'),
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=80000, str_col_1='B', value='1'),
+        RatingFactorModel(rating_manual_id=1, type='aoi', num_col_1=90000, str_col_1='B', value='2'),
+    ])
+    session.commit()
+
+    database = rating_factor_repository.RatingFactorRepository(1, session)
+    indexed = rating_factor_repository.IndexedRatingFactorRepository(1, session)
+    xs = [80000, '87500', 95000, 100000.5, 110000]
+    for x in xs:
+        params = {'num_col_1': x, 'str_col_1': 'A'}
+        assert indexed.interpolate('aoi', dict(params), 'num_col_1') == \
+            database.interpolate('aoi', dict(params), 'num_col_1')
+    assert list(indexed.interpolate_many('aoi', {'str_col_1': 'A'}, 'num_col_1', xs)) == \
+        database.interpolate_many('aoi', {'str_col_1': 'A'}, 'num_col_1', xs)
+    assert list(indexed.interpolate_many('aoi', {'str_col_1': 'B'}, 'num_col_1', [85000, 90000])) == [1.5, 2.0]
+
+    for x, error in [(79999, 'lower'), (110001, 'upper'), ('x', 'upper')]:
+        for interpolate in (lambda: indexed.interpolate('aoi', {'num_col_1': x, 'str_col_1': 'A'}, 'num_col_1'),
+                            lambda: indexed.interpolate_many('aoi', {'str_col_1': 'A'}, 'num_col_1', [95000, x])):
+            try:
+                interpolate()
+                assert False
+            except Exception as e:
+                assert str(e) == 'Interpolation Lookup failed to find %s value for aoi!' % error
+
+
+def test_batched_rating_factor_lookups():
+    from sqlalchemy import event
+
+    session = setup_test_db_session()
+    session.add_all([
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=10, str_col_1='a', value='0.25'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=20, str_col_1='a', value='0.50'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=30, str_col_1='a', value='0.75'),
+        RatingFactorModel(rating_manual_id=1, type='test', num_col_1=20, str_col_1=None, value='0.60'),
+        RatingFactorModel(rating_manual_id=2, type='test', num_col_1=20, str_col_1='a', value='0.99'),
+    ])
+    session.commit()
+    with session.get_bind().begin() as connection:
+        connection.execute("CREATE TABLE zip_codes (id INTEGER NOT NULL, zip VARCHAR(5), value VARCHAR, PRIMARY KEY (id))")
+        connection.execute("INSERT INTO zip_codes (id, zip, value) VALUES (1, '02134', '3'), (2, '90210', '7')")
+
+    statements = []
+    event.listen(session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    repository = rating_factor_repository.RatingFactorRepository(1, session)
+    for params_list, options in [
+        ([{'num_col_1': 20, 'str_col_1': 'a'}, {'num_col_1': '10', 'str_col_1': 'a'}, {'num_col_1': 20, 'str_col_1': 'b'},
+          {'num_col_1': 20, 'str_col_1': None}, {'num_col_1': 20, 'str_col_1': 'a'}], None),
+        ([{'num_col_1': 15, 'str_col_1': 'a'}, {'num_col_1': 30, 'str_col_1': 'a'}, {'num_col_1': 31, 'str_col_1': 'a'}],
+         {'step_up': 'num_col_1'}),
+        ([{'num_col_1': 15}, {'num_col_1': 5}, {'num_col_1': 25}], {'step_down': 'num_col_1'}),
+        ([{'zip': '90210'}, {'zip': '02134'}, {'zip': '10001'}], {'table': 'zip_codes'}),
+    ]:
+        del statements[:]
+        factors = repository.get_factors_many('test', params_list, options)
+        # (besides reflecting a custom table)
+        assert len([statement for statement in statements if 'lookup_index' in statement]) == 1
+        expected = [repository.get_factor('test', dict(params), options) for params in params_list]
+        assert [factor and factor.value for factor in factors] == [factor and factor.value for factor in expected]
+
+    assert repository.lookup_many('test', [{'num_col_1': 25}, {'num_col_1': 10}], {'step_down': 'num_col_1'}) == \
+        ['0.50', '0.25']
+    assert repository.interpolate_many('test', {'str_col_1': 'a'}, 'num_col_1', [10, '15', 25, 15]) == \
+        [0.25, 0.375, 0.625, 0.375]
+
+
+def test_prefetched_lookups():
+    import copy
+    from sqlalchemy import event
+    from aspire.app.demo import seed_demo_data
+    from aspire.app.domain.rater import Rater
+    from aspire.app.synthetic import InputGenerator
+
+    session = setup_test_db_session()
+    seed_demo_data(session)
+    manual = RatingManualRepository(session).get(1)
+    rater = Rater(manual)
+    assert len(rater.compiled_manual.prefetch.steps) == 7
+
+    statements = []
+    event.listen(session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    for rate_inputs in InputGenerator(manual, seed=1).rows(10):
+        interpreted = copy.deepcopy(rate_inputs)
+        for rating_step in manual.rating_steps:
+            rating_step.run(interpreted)
+
+        # every lookup is made in the one query, before any step runs
+        del statements[:]
+        assert rater.rate(rate_inputs) == interpreted['rate']
+        assert len(statements) == 1 and 'lookup_index' in statements[0]
+
+    # where the factors can't be found, each step looks them up for itself, but other errors aren't hidden
+    repository = next(iter(rater.compiled_manual.prefetch.steps)).rating_factor_repository
+    for error in [rating_factor_repository.RatingFactorsNotFound("Rating factors have no table 'zip_codes'"),
+                  RuntimeError("database is unavailable")]:
+        def get_factors_batch(lookups):
+            raise error
+        repository.get_factors_batch = get_factors_batch
+        del statements[:]
+        try:
+            assert rater.rate(rate_inputs) == interpreted['rate']
+            assert isinstance(error, rating_factor_repository.RatingFactorsNotFound) and len(statements) > 1
+        except RuntimeError as e:
+            assert e is error
+    del repository.get_factors_batch
+
+    # lookups which are remembered aren't prefetched
+    assert Rater(manual, memo_size=16).compiled_manual.prefetch is None
+
+
+def test_custom_rating_factor_tables():
+    from aspire.app.database.models import get_custom_rating_factors_model
+
+    sessions = [setup_test_db_session(), setup_test_db_session()]
+    for session, columns in zip(sessions, ['zip VARCHAR(5), value VARCHAR', 'zip VARCHAR(5), band INTEGER, value VARCHAR']):
+        with session.get_bind().begin() as connection:
+            connection.execute("CREATE TABLE zip_codes (id INTEGER NOT NULL, %s, PRIMARY KEY (id))" % columns)
+            connection.execute("INSERT INTO zip_codes (id, zip, value) VALUES (1, '02134', '3'), (2, '90210', '7'), "
+                               "(3, '02134', '9')")
+
+    # reflected once per engine, each as it is there
+    first, second = (get_custom_rating_factors_model('zip_codes', session.get_bind()) for session in sessions)
+    assert get_custom_rating_factors_model('zip_codes', sessions[0].get_bind()) is first
+    assert 'band' not in first.__table__.c and 'band' in second.__table__.c
+
+    session = sessions[1]
+    repository = rating_factor_repository.RatingFactorRepository(1, session)
+    indexed = rating_factor_repository.IndexedRatingFactorRepository(1, session)
+    for params, options in [
+        ({'zip': '02134'}, {'table': 'zip_codes'}),
+        ({'zip': '10001'}, {'table': 'zip_codes'}),
+        ({'zip': '02134', 'band': None}, {'table': 'zip_codes'}),
+        ({'zip': '5'}, {'table': 'zip_codes', 'step_up': 'zip'}),
+        ({'zip': '5'}, {'table': 'zip_codes', 'step_down': 'zip'}),
+    ]:
+        expected = repository.get_factor('test', dict(params), options)
+        factor = indexed.get_factor('test', dict(params), options)
+        assert (factor and factor.id) == (expected and expected.id)
+
+    # loaded once, on the first lookup
+    with session.get_bind().begin() as connection:
+        connection.execute("DELETE FROM zip_codes")
+    assert indexed.lookup('test', {'zip': '90210'}, {'table': 'zip_codes'}) == '7'
+    assert rating_factor_repository.IndexedRatingFactorRepository(1, session, custom_tables=False).get_factor(
+        'test', {'zip': '90210'}, {'table': 'zip_codes'}) is None
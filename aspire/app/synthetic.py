@@ -0,0 +1,173 @@
+"""Synthetic rating inputs, generated from a manual's rating variable definitions, for load testing without real
+customer data"""
+import csv
+import json
+import random
+from bisect import bisect
+from itertools import accumulate
+from typing import Callable, Dict, Iterator, List, Union
+from .domain.rating_manual import RatingManual
+from .domain.rating_step import AbstractRatingStep, Loop
+from .domain.rating_step_parameter import RatingStepParameterType
+from .domain.rating_variable import RatingVariable, StringRatingVariable, IntegerRatingVariable, \
+    DecimalRatingVariable, BoolRatingVariable
+
+# a distribution is a function of a random number generator, a list of values to choose between evenly, or a dict of
+# values to their relative weights
+Distribution = Union[Callable[[random.Random], object], list, dict]
+
+
+def sampler(distribution: Distribution) -> Callable[[random.Random], object]:
+    if callable(distribution):
+        return distribution
+
+    if isinstance(distribution, dict):
+        values = list(distribution.keys())
+        cumulative = list(accumulate(distribution.values()))
+        total = cumulative[-1]
+        return lambda rng: values[bisect(cumulative, rng.random() * total)]
+
+    values = list(distribution)
+    count = len(values)
+    return lambda rng: values[int(rng.random() * count)]
+
+
+def uniform_integers(minimum: int, maximum: int) -> Callable[[random.Random], str]:
+    span = maximum - minimum + 1
+    return lambda rng: str(minimum + int(rng.random() * span))
+
+
+def uniform_decimals(minimum: float, maximum: float, scale: int) -> Callable[[random.Random], str]:
+    span = maximum - minimum
+    return lambda rng: str(round(minimum + rng.random() * span, scale))
+
+
+class InputGenerator(object):
+    """Streams rows of synthetic inputs to a manual, seeded so the same rows can be generated again. By default, each
+    `is_input` variable gets a value spread evenly over what its definition allows: between an integer or decimal's
+    min and max, or among a string's options. Values are strings, as they would be from a form or a CSV.
+
+    `distributions` replaces the default for any variable, by name. Each sub-risk gets between the given min and max
+    sub-risks per row, `sub_risk_counts` being a (min, max) tuple for them all or a dict of them by sub-risk label.
+    Sub-risks looped over within a loop over other sub-risks are nested in each of those, as the manual rates them.
+    An integer or decimal without a max is given one `open_range` times its min."""
+
+    def __init__(self, rating_manual: RatingManual, seed: int = None, distributions: Dict[str, Distribution] = None,
+                 sub_risk_counts=(1, 4), boolean_values=('yes', 'no'), open_range: int = 10):
+        self.rng = random.Random(seed)
+        self.boolean_values = boolean_values
+        self.open_range = open_range
+        distributions = distributions or {}
+
+        self.samplers = {}  # type: Dict[str, List[tuple]]
+        for sub_risk_label, rating_variables in rating_manual.get_rating_variables_by_sub_risk().items():
+            samplers = []
+            for rating_variable in rating_variables:
+                if rating_variable is None or not rating_variable.is_input:
+                    continue
+                distribution = distributions.get(rating_variable.name)
+                samplers.append((rating_variable.name, sampler(distribution) if distribution is not None
+                                 else self.default_sampler(rating_variable)))
+            self.samplers[sub_risk_label] = samplers
+
+        self.sub_risk_counts = {}
+        for sub_risk_label in self.samplers:
+            if sub_risk_label is not None:
+                counts = sub_risk_counts.get(sub_risk_label, (1, 4)) if isinstance(sub_risk_counts, dict) \
+                    else sub_risk_counts
+                self.sub_risk_counts[sub_risk_label] = counts
+
+        # the sub-risks directly within each sub-risk (or, under None, the risk itself)
+        parents = loop_parents(rating_manual.rating_steps)
+        self.children = {None: []}  # type: Dict[str, List[str]]
+        for sub_risk_label in self.sub_risk_counts:
+            self.children.setdefault(parents.get(sub_risk_label), []).append(sub_risk_label)
+            self.children.setdefault(sub_risk_label, [])
+
+    def default_sampler(self, rating_variable: RatingVariable) -> Callable[[random.Random], object]:
+        if isinstance(rating_variable, IntegerRatingVariable):
+            minimum = rating_variable.min if rating_variable.min is not None else 0
+            maximum = rating_variable.max if rating_variable.max is not None else max(minimum, 1) * self.open_range
+            return uniform_integers(minimum, maximum)
+
+        if isinstance(rating_variable, DecimalRatingVariable):
+            minimum = rating_variable.min if rating_variable.min is not None else 0.0
+            maximum = rating_variable.max if rating_variable.max is not None else max(minimum, 1.0) * self.open_range
+            return uniform_decimals(minimum, maximum, rating_variable.scale or 0)
+
+        if isinstance(rating_variable, BoolRatingVariable):
+            return sampler(list(self.boolean_values))
+
+        if isinstance(rating_variable, StringRatingVariable) and getattr(rating_variable, 'options', None):
+            return sampler(rating_variable.options)
+
+        raise Exception("No distribution for rating variable '%s'" % rating_variable.name)
+
+    def row(self) -> dict:
+        return self.risk(None)
+
+    def risk(self, sub_risk_label: str = None) -> dict:
+        """The variables of a risk, or of one sub-risk with the given label, including the sub-risks within it"""
+        rng = self.rng
+        risk = {name: sample(rng) for name, sample in self.samplers.get(sub_risk_label, [])}
+        for child in self.children.get(sub_risk_label, []):
+            minimum, maximum = self.sub_risk_counts[child]
+            risk[child] = [self.risk(child) for _ in range(rng.randint(minimum, maximum))]
+        return risk
+
+    def rows(self, count: int) -> Iterator[dict]:
+        for _ in range(count):
+            yield self.row()
+
+    def columns(self, count: int) -> dict:
+        """Generate rows as columns, as `Rater.rate_batch` takes them"""
+        rows = list(self.rows(count))
+        return {name: [row[name] for row in rows] for name in (rows[0] if rows else {})}
+
+    def write_json_lines(self, file_path: str, count: int):
+        with open(file_path, 'w') as output:
+            for row in self.rows(count):
+                output.write(json.dumps(row) + '\n')
+
+    def write_csv(self, file_path: str, count: int):
+        """Write rows to a CSV, with each sub-risk's variables flattened into columns named as the web form names
+        them (e.g. `vehicles[0]vehicle_age`, or `buildings[0]rooms[1]area` for nested sub-risks), for up to the most
+        sub-risks a row can have"""
+        fieldnames = self.fieldnames()
+        with open(file_path, 'w', newline='') as output:
+            writer = csv.DictWriter(output, fieldnames)
+            writer.writeheader()
+            for row in self.rows(count):
+                writer.writerow(flatten_sub_risks(row))
+
+    def fieldnames(self, sub_risk_label: str = None, prefix: str = '') -> List[str]:
+        fieldnames = [prefix + name for name, sample in self.samplers.get(sub_risk_label, [])]
+        for child in self.children.get(sub_risk_label, []):
+            minimum, maximum = self.sub_risk_counts[child]
+            for i in range(maximum):
+                fieldnames += self.fieldnames(child, '%s%s[%d]' % (prefix, child, i))
+        return fieldnames
+
+
+def loop_parents(rating_steps: List[AbstractRatingStep], parent: str = None) -> Dict[str, str]:
+    """The label of the sub-risks each loop's sub-risks are within (None for the risk itself), by their label"""
+    parents = {}
+    for rating_step in rating_steps:
+        if isinstance(rating_step, Loop) and rating_step.sub_risk_label.parameter_type == RatingStepParameterType.LITERAL:
+            sub_risk_label = rating_step.sub_risk_label.value
+            parents.setdefault(sub_risk_label, parent)
+            for label, label_parent in loop_parents(rating_step.rating_steps, sub_risk_label).items():
+                parents.setdefault(label, label_parent)
+    return parents
+
+
+def flatten_sub_risks(risk: dict, prefix: str = '') -> dict:
+    """A risk's variables, with those of its sub-risks (at any depth) named as the web form names them"""
+    flattened = {}
+    for name, value in risk.items():
+        if isinstance(value, list):
+            for i, sub_risk in enumerate(value):
+                flattened.update(flatten_sub_risks(sub_risk, '%s%s[%d]' % (prefix, name, i)))
+        else:
+            flattened[prefix + name] = value
+    return flattened
@@ -0,0 +1,152 @@
+"""Benchmarks of rating the demo homeowners and auto manuals, written as JSON so that runs can be compared across
+commits"""
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+from time import perf_counter
+from typing import Callable, List
+from aspire.app.database.engine import setup_test_db_session
+from aspire.app.database.models import RatingManual as RatingManualModel
+from aspire.app.demo import seed_auto_manual, seed_homeowners_manual
+from aspire.app.domain.rater import Rater
+from aspire.app.repository.rating_manual_repository import RatingManualRepository
+
+HOMEOWNERS_INPUTS = {
+    'amount_of_insurance': ['80000', '100000', '215000', '350000', '525000'],
+    'territory': ['1', '2', '3', '4', '5'],
+    'protection_class': [str(protection_class) for protection_class in range(1, 11)],
+    'construction_type': ['Frame', 'Masonry'],
+    'underwriting_tier': ['A', 'B', 'C', 'D'],
+    'deductible': ['250', '500', '1000', '5000'],
+    'new_home': ['yes', 'no'],
+    'five_years_claims_free': ['yes', 'no'],
+    'multi_policy': ['yes', 'no'],
+    'jewelry_coverage': ['2500', '5000', '10000'],
+    'liability_medical_coverage': ['100000/500', '300000/1000', '500000/2500'],
+}
+
+
+def seed_database(path: str):
+    """Seed the demo manuals into a new SQLite database, returning a session on it and the manuals' ids"""
+    session = setup_test_db_session('sqlite:///' + path)
+    seed_homeowners_manual(session)
+    seed_auto_manual(session)
+    ids = dict(session.query(RatingManualModel.name, RatingManualModel.id))
+    return session, ids['Demo HO Manual'], ids['Demo Auto Manual']
+
+
+def homeowners_inputs(rng: random.Random, count: int) -> List[dict]:
+    return [{name: rng.choice(values) for name, values in HOMEOWNERS_INPUTS.items()} for _ in range(count)]
+
+
+def auto_inputs(rng: random.Random, count: int, vehicles: int) -> List[dict]:
+    return [{'vehicles': [
+        {'vehicle_age': str(rng.randint(0, 30)), 'primary_driver_age': str(rng.randint(18, 90))} for _ in range(vehicles)
+    ]} for _ in range(count)]
+
+
+def percentile(times: List[float], fraction: float) -> float:
+    """The given fraction's percentile of some sorted times, by the nearest rank"""
+    return times[min(len(times) - 1, max(0, int(round(fraction * len(times))) - 1))]
+
+
+def latencies(rate: Callable, inputs: List[dict], warmup: int = 5) -> dict:
+    """Time rating each of the given inputs one at a time, in milliseconds"""
+    for rate_inputs in inputs[:warmup]:
+        rate(copy.deepcopy(rate_inputs))
+
+    times = []
+    for rate_inputs in inputs:
+        rate_inputs = copy.deepcopy(rate_inputs)
+        start = perf_counter()
+        rate(rate_inputs)
+        times.append((perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        'quotes': len(times),
+        'p50_ms': percentile(times, 0.5),
+        'p99_ms': percentile(times, 0.99),
+        'mean_ms': sum(times) / len(times),
+        'quotes_per_second': len(times) / (sum(times) / 1000),
+    }
+
+
+def batch_throughput(rater: Rater, inputs: List[dict]) -> dict:
+    """Time rating all the given inputs at once, as columns"""
+    columns = {name: [rate_inputs[name] for rate_inputs in inputs] for name in inputs[0]}
+    start = perf_counter()
+    rater.rate_batch(copy.deepcopy(columns))
+    seconds = perf_counter() - start
+    return {'rows': len(inputs), 'seconds': seconds, 'rows_per_second': len(inputs) / seconds}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(quotes: int = 1000, batch_rows: int = 10000, fleets=(1, 10, 100, 1000), seed: int = 0) -> dict:
+    """Seed the demo manuals into a temporary SQLite database and rate them: single quotes (with and without step
+    detail), batches of rows, and auto quotes for fleets of each given size"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        session, homeowners_id, auto_id = seed_database(os.path.join(directory, 'benchmark.db'))
+        repository = RatingManualRepository(session)
+        homeowners = Rater(repository.get(homeowners_id))
+        auto = Rater(repository.get(auto_id))
+
+        def rate_with_details(rater: Rater):
+            return lambda rate_inputs: rater.evaluate(rate_inputs, capture_details=True).get_step_by_step_diff()
+
+        homeowners_quotes = homeowners_inputs(rng, quotes)
+        results = {
+            'homeowners': {
+                'single_quote': latencies(homeowners.rate, homeowners_quotes),
+                'single_quote_with_details': latencies(rate_with_details(homeowners), homeowners_quotes),
+                'batch': batch_throughput(homeowners, homeowners_inputs(rng, batch_rows)),
+            },
+            'auto': {
+                'batch': batch_throughput(auto, auto_inputs(rng, batch_rows, 2)),
+                'fleets': {},
+            },
+        }
+        for vehicles in fleets:
+            # fewer quotes for bigger fleets, so that each size takes about as long
+            fleet_quotes = auto_inputs(rng, max(5, quotes // vehicles), vehicles)
+            warmup = max(1, 5 // vehicles)
+            results['auto']['fleets'][str(vehicles)] = {
+                'vehicles': vehicles,
+                'single_quote': latencies(auto.rate, fleet_quotes, warmup),
+                'single_quote_with_details': latencies(rate_with_details(auto), fleet_quotes, warmup),
+            }
+        session.close()
+
+    results['meta'] = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'quotes': quotes,
+        'batch_rows': batch_rows,
+    }
+    return results
+
+
+def write_results(results: dict, path: str = None):
+    """Write benchmark results as JSON to a file, or to stdout"""
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if path is None:
+        print(output)
+        return
+
+    with open(path, 'w') as results_file:
+        results_file.write(output + '\n')
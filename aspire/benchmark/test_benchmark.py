@@ -0,0 +1,19 @@
+import json
+from .benchmarks import run_benchmarks, write_results
+
+
+def test_run_benchmarks(tmp_path):
+    results = run_benchmarks(quotes=5, batch_rows=5, fleets=(1, 3))
+
+    single_quote = results['homeowners']['single_quote']
+    assert single_quote['quotes'] == 5
+    assert 0 < single_quote['p50_ms'] <= single_quote['p99_ms']
+    assert results['homeowners']['batch']['rows'] == 5
+    assert results['auto']['batch']['rows_per_second'] > 0
+    assert sorted(results['auto']['fleets']) == ['1', '3']
+    assert results['auto']['fleets']['3']['single_quote_with_details']['quotes'] == 5
+    assert results['meta']['seed'] == 0
+
+    path = tmp_path / 'results.json'
+    write_results(results, str(path))
+    assert json.loads(path.read_text()) == results
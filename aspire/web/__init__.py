@@ -6,7 +6,7 @@ from werkzeug.utils import secure_filename
 from sqlalchemy.orm import scoped_session
 from aspire.app.database.engine import ConnectionManager
 from aspire.app.database.models import RatingStep, RatingStepType, RatingStepParameter, RatingManual, RatingVariable
-from aspire.app.rating import rate as rater_rate, rate_from_csv
+from aspire.app.rating import get_rater, rate_with_rater, rate_from_csv
 from aspire.app.repository.rating_manual_repository import RatingManualRepository
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
@@ -40,6 +40,9 @@ def create_webapp(test_config=None):
         print("Unexpected error creating web directories:", sys.exc_info()[0])
         pass
 
+    # compiled raters are shared between requests, keyed by rating manual id
+    app.raters = {}
+
     admin = Admin(app, name='Flask Rater Admin', template_mode='bootstrap3')
     admin.add_view(ModelView(RatingManual, app.session))
     admin.add_view(ModelView(RatingStep, app.session))
@@ -85,28 +88,31 @@ def create_webapp(test_config=None):
 
     @app.route('/rate/<int:rating_manual_id>', methods=['POST'])
     def rate(rating_manual_id: int):
-        repository = RatingManualRepository(app.session)
-        manual = repository.get(rating_manual_id)
+        # the rater is kept until the manual's version changes, and its factors along with it
+        repository = RatingManualRepository(app.session, cache_factors=True)
+        rater = get_rater(rating_manual_id, repository, app.raters)
 
         request_data = request.form.to_dict()
         inputs = {}
 
         for field, value in request_data.items():
-            m = match(r"(\w+)\[(\d+)](\w+)", field)
-            if m:
+            # sub-risks' fields are prefixed with their label and index, once per level they're nested at
+            risk, variable = inputs, field
+            m = match(r"(\w+)\[(\d+)](\w.*)", variable)
+            while m:
                 sub_risk, loop_index, variable = m.group(1, 2, 3)
-                if sub_risk not in inputs:
-                    inputs[sub_risk] = []
-                while len(inputs[sub_risk]) < int(loop_index)+1:
-                    inputs[sub_risk].append({})
-                inputs[sub_risk][int(loop_index)][variable] = value
-                continue
-            inputs[field] = value
-
-        results = rater_rate(rating_manual_id, repository, inputs, report_detail=True)
+                if sub_risk not in risk:
+                    risk[sub_risk] = []
+                while len(risk[sub_risk]) < int(loop_index)+1:
+                    risk[sub_risk].append({})
+                risk = risk[sub_risk][int(loop_index)]
+                m = match(r"(\w+)\[(\d+)](\w.*)", variable)
+            risk[variable] = value
+
+        results = rate_with_rater(rater, inputs, report_detail=True)
         final_rate = results[-1]['rating_variables']['rate']
-        return render_template('rate_results.html', manual=manual, rating_manual_id=rating_manual_id, results=results,
-                               final_rate=final_rate)
+        return render_template('rate_results.html', manual=rater.rating_manual, rating_manual_id=rating_manual_id,
+                               results=results, final_rate=final_rate)
 
     @app.route('/rating/csv', methods=['GET', 'POST'])
     def csv_rating():